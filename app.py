@@ -1,3 +1,8 @@
-from leaderboard import app, start_logging
+from leaderboard import app, start_logging, start_invalidation_listener, \
+    start_ingest, start_cooperative, start_metrics
 
 start_logging()
+start_cooperative()
+start_invalidation_listener()
+start_ingest()
+start_metrics()
@@ -0,0 +1,298 @@
+"""
+    bench.analytics
+    ===============
+
+    Benchmark the vectorized analytics path against the best users and best
+    teams endpoints, on a competition seeded in the database configured for
+    the app with 10^4 and 10^5 efforts, and removed again afterwards. Both
+    sides include loading from the database.
+
+    A second table compares only the in-memory ranking, the analytics path
+    against a Python loop equivalent to the endpoints', for 10^4 to 10^7
+    efforts generated at random; it's loop against loop, with no database,
+    repositories or rendering. Sizes for the first table may be given on
+    the command line instead.
+
+    :author: Michael Browning
+"""
+
+from itertools import izip
+import os
+import sys
+import time
+import timeit
+
+import numpy
+
+from leaderboard import app, get_connection, response_cache
+from leaderboard.analytics import EffortArrays, top_k, ranks
+
+SEEDED_SIZES = (10 ** 4, 10 ** 5)
+SIZES = (10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7)
+REPEAT = 3
+TOP = 10
+
+
+def make_efforts(n, seed=0):
+    """Return :class:`EffortArrays` for `n` random efforts, spread over one
+    user per hundred efforts and one team per ten users.
+
+    :param n: the number of efforts
+    :param seed: the random seed
+    """
+    random = numpy.random.RandomState(seed)
+    num_users = max(10, n // 100)
+    num_teams = max(1, num_users // 10)
+    user_ids = numpy.arange(1, num_users + 1)
+    team_ids = numpy.arange(1, num_teams + 1)
+
+    return EffortArrays(
+        users=random.randint(1, num_users + 1, n),
+        starts=random.randint(1356998400, 1388534400, n).astype(float),
+        durations=random.randint(1, 8, n) * 1800.0,
+        locations=random.randint(1, 100, n),
+        user_ids=user_ids,
+        team_ids=team_ids,
+        memberships=izip(user_ids, user_ids % num_teams + 1)
+    )
+
+
+def loop_best(users, durations, team_of_user, k):
+    """Rank users and teams the way the endpoints do: total each user's
+    efforts in Python, add the totals up by team and sort both.
+
+    :param users: a list of the user id of each effort
+    :param durations: a list of the duration of each effort
+    :param team_of_user: a dictionary of team ids by user id
+    :param k: the number of users and teams to return
+    """
+    user_totals = {}
+    for u, d in izip(users, durations):
+        user_totals[u] = user_totals.get(u, 0) + d
+
+    team_totals = {}
+    for u, total in user_totals.iteritems():
+        t = team_of_user[u]
+        team_totals[t] = team_totals.get(t, 0) + total
+
+    by_total = lambda x: x[1]
+    return (
+        sorted(user_totals.items(), key=by_total, reverse=True)[:k],
+        sorted(team_totals.items(), key=by_total, reverse=True)[:k],
+    )
+
+
+def vectorized_best(efforts, k):
+    """Rank users and teams with the analytics path.
+
+    :param efforts: the :class:`EffortArrays`
+    :param k: the number of users and teams to return
+    """
+    user_ids, user_totals = efforts.user_totals()
+    team_ids, team_totals = efforts.team_totals()
+
+    return (
+        top_k(user_ids, user_totals, k),
+        top_k(team_ids, team_totals, k),
+        ranks(user_totals),
+    )
+
+
+def best(fn):
+    """The best of :data:`REPEAT` timings of a callable, in milliseconds.
+
+    :param fn: the callable to time
+    """
+    return min(timeit.repeat(fn, number=1, repeat=REPEAT)) * 1000
+
+
+def seed(n):
+    """Seed a competition with `n` efforts, spread over one user per hundred
+    efforts and one team per ten users, and return its id. No two of a
+    user's efforts overlap.
+
+    :param n: the number of efforts
+    """
+    num_users = max(10, n // 100)
+    num_teams = max(1, num_users // 10)
+    name = 'bench %d %d' % (os.getpid(), n)
+
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            'INSERT INTO competitions (name) VALUES (%s) RETURNING id',
+            (name,)
+        )
+        competition_id = cursor.fetchone()[0]
+        cursor.execute(
+            'INSERT INTO teams (name, competition) '
+            "SELECT 'team ' || i, %s FROM generate_series(1, %s) AS i",
+            (competition_id, num_teams)
+        )
+        cursor.execute(
+            'INSERT INTO users '
+            '(email, first_name, last_name, username, competition) '
+            "SELECT 'user' || i || '@example.com', 'First', 'Last', "
+            "'user' || i, %s FROM generate_series(1, %s) AS i",
+            (competition_id, num_users)
+        )
+        # The i-th user, by id, joins the team of rank i % num_teams.
+        cursor.execute(
+            'INSERT INTO users2teams ("user", team) '
+            'SELECT u.id, t.id FROM '
+            '(SELECT id, row_number() OVER (ORDER BY id) AS i FROM users '
+            ' WHERE competition = %(c)s) AS u JOIN '
+            '(SELECT id, row_number() OVER (ORDER BY id) AS i FROM teams '
+            ' WHERE competition = %(c)s) AS t '
+            'ON u.i %% %(teams)s + 1 = t.i',
+            {'c': competition_id, 'teams': num_teams}
+        )
+        cursor.execute(
+            'INSERT INTO locations (latitude, longitude) '
+            'VALUES (%s, %s) RETURNING id',
+            (-90 + competition_id % 180, time.time() % 360 - 180)
+        )
+        location_id = cursor.fetchone()[0]
+        # The i-th effort is the user of rank i % num_users's (i /
+        # num_users)-th, four hours after the one before and at most three
+        # and a half hours long.
+        cursor.execute(
+            'INSERT INTO efforts '
+            '(start_time, duration, "user", location, competition) '
+            "SELECT timestamp '2013-01-01' + (e.i / %(users)s) "
+            "* interval '4 hours', (1 + e.i %% 7) * interval '30 minutes', "
+            'u.id, %(location)s, %(c)s '
+            'FROM generate_series(0, %(n)s - 1) AS e(i) JOIN '
+            '(SELECT id, row_number() OVER (ORDER BY id) - 1 AS i FROM users '
+            ' WHERE competition = %(c)s) AS u '
+            'ON e.i %% %(users)s = u.i',
+            {'c': competition_id, 'users': num_users,
+             'location': location_id, 'n': n}
+        )
+        connection.commit()
+    finally:
+        connection.close()
+
+    return competition_id
+
+
+def unseed(competition_id):
+    """Remove a competition seeded by :func:`seed`, and everything in it.
+
+    :param competition_id: the competition's id
+    """
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            'DELETE FROM efforts WHERE competition = %s RETURNING location',
+            (competition_id,)
+        )
+        location_ids = list(set(r[0] for r in cursor.fetchall()))
+        cursor.execute('DELETE FROM locations WHERE id = ANY(%s)',
+                       (location_ids,))
+        cursor.execute(
+            'DELETE FROM users2teams WHERE "user" IN '
+            '(SELECT id FROM users WHERE competition = %s)',
+            (competition_id,)
+        )
+        for table in ('users', 'teams'):
+            cursor.execute(
+                'DELETE FROM %s WHERE competition = %%s' % table,
+                (competition_id,)
+            )
+        cursor.execute('DELETE FROM competitions WHERE id = %s',
+                       (competition_id,))
+        connection.commit()
+    finally:
+        connection.close()
+
+
+def endpoints_best(client, competition_id, k):
+    """Rank users and teams through the best users and best teams endpoints,
+    with their cached responses cleared first.
+
+    :param client: a test client for the app
+    :param competition_id: the competition's id
+    :param k: the number of users and teams to return
+    """
+    response_cache.clear()
+    for url in ('/users/best?num_users=%d&competition=%d',
+                '/teams/best?num_teams=%d&competition=%d'):
+        response = client.get(url % (k, competition_id))
+        assert response.status_code == 200, response.data
+
+
+def loaded_best(competition_id, k):
+    """Rank users and teams with the analytics path, loading the efforts
+    from the database.
+
+    :param competition_id: the competition's id
+    :param k: the number of users and teams to return
+    """
+    with app.test_request_context():
+        return vectorized_best(
+            EffortArrays.load(competition_id=competition_id), k
+        )
+
+
+def bench_seeded(n):
+    """Print the cost of ranking a seeded competition of `n` efforts through
+    the endpoints and through the analytics path.
+
+    :param n: the number of efforts
+    """
+    competition_id = seed(n)
+    try:
+        client = app.test_client()
+        endpoint_ms = best(
+            lambda: endpoints_best(client, competition_id, TOP)
+        )
+        vector_ms = best(lambda: loaded_best(competition_id, TOP))
+    finally:
+        unseed(competition_id)
+
+    print '%10d %14.2f %12.2f %9.1fx' % (
+        n, endpoint_ms, vector_ms, endpoint_ms / vector_ms
+    )
+
+
+def bench(n):
+    """Print the cost of ranking `n` efforts in memory both ways.
+
+    :param n: the number of efforts
+    """
+    efforts = make_efforts(n)
+    users = efforts.users.tolist()
+    durations = efforts.durations.tolist()
+    team_of_user = dict(enumerate(efforts.team_of_user.tolist()))
+
+    loop_ms = best(lambda: loop_best(users, durations, team_of_user, TOP))
+    vector_ms = best(lambda: vectorized_best(efforts, TOP))
+
+    print '%10d %12.2f %12.2f %9.1fx' % (
+        n, loop_ms, vector_ms, loop_ms / vector_ms
+    )
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or SEEDED_SIZES
+    print 'Seeded database, endpoints against analytics:'
+    print '%10s %14s %12s %10s' % (
+        'efforts', 'endpoint (ms)', 'numpy (ms)', 'speedup'
+    )
+    for n in sizes:
+        bench_seeded(n)
+
+    print
+    print 'In memory only, loop against loop:'
+    print '%10s %12s %12s %10s' % (
+        'efforts', 'loop (ms)', 'numpy (ms)', 'speedup'
+    )
+    for n in SIZES:
+        bench(n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+"""
+    bench.model
+    ===========
+
+    Benchmark the domain model's value types against the previous
+    `__dict__`-based implementation, and the columnar effort store against a
+    set of efforts, for users with thousands of efforts, and the ways of
+    constructing and serializing efforts.
+
+    :author: Michael Browning
+"""
+
+from datetime import datetime, timedelta
+import sys
+import timeit
+
+from leaderboard.model import type_validator
+from leaderboard.model.model import Model
+from leaderboard.model.columns import EffortColumns
+from leaderboard.model.effort import Effort
+from leaderboard.model.location import Location
+from leaderboard.helpers import DATETIME_FORMAT
+
+SIZES = (1000, 10000)
+REPEAT = 5
+
+
+class DictValue(Model):
+    """The previous value implementation, which kept its fields in a
+    per-instance `__dict__` and rebuilt its hash on every call.
+    """
+
+    def __init__(self, **kwargs):
+        super(DictValue, self).__init__(**kwargs)
+        self._set = True
+
+    def __setattr__(self, name, value):
+        if name != 'id' and hasattr(self, '_set') and self._set:
+            raise TypeError()
+        object.__setattr__(self, name, value)
+
+    def __eq__(self, other):
+        if other:
+            if isinstance(other, type(self)) or isinstance(self, type(other)):
+                self_dict = self.__dict__.copy()
+                self_dict.pop('id', None)
+                other_dict = other.__dict__.copy()
+                other_dict.pop('id', None)
+
+                return self_dict == other_dict
+            else:
+                return False
+        else:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        dict = self.__dict__.copy()
+        dict.pop('id', None)
+        return hash(
+           tuple([(k, getattr(self, k)) for k in sorted(dict)])
+        )
+
+
+class DictLocation(DictValue):
+    _validation_rules = Location._validation_rules
+
+
+class DictEffort(DictValue):
+    _validation_rules = dict(
+        Effort._validation_rules, location=type_validator(DictLocation)
+    )
+
+
+def make_efforts(effort_cls, location_cls, n):
+    """Return `n` non-overlapping efforts spread over a handful of
+    locations.
+
+    :param effort_cls: the effort class to instantiate
+    :param location_cls: the location class to instantiate
+    :param n: the number of efforts
+    """
+    locations = [
+        location_cls(latitude=41.5 + i, longitude=71.5) for i in range(10)
+    ]
+    start = datetime(2013, 1, 1)
+
+    return [
+        effort_cls(
+            start_time=start + timedelta(hours=i),
+            duration=timedelta(minutes=30),
+            location=locations[i % len(locations)]
+        )
+        for i in range(n)
+    ]
+
+
+def instance_size(obj):
+    """The bytes held by an object itself, including any instance dictionary
+    but not the field values, which both implementations share.
+
+    :param obj: the object to measure
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+
+    return size
+
+
+def best(fn):
+    """The best of :data:`REPEAT` timings of a callable, in milliseconds.
+
+    :param fn: the callable to time
+    """
+    return min(timeit.repeat(fn, number=1, repeat=REPEAT)) * 1000
+
+
+def bench(label, effort_cls, location_cls, n):
+    """Print the memory and CPU cost of a user's efforts for one
+    implementation.
+
+    :param label: the implementation's name
+    :param effort_cls: the effort class
+    :param location_cls: the location class
+    :param n: the number of efforts
+    """
+    efforts = make_efforts(effort_cls, location_cls, n)
+    # Equal but distinct objects, as a reloaded user would have.
+    twins = make_efforts(effort_cls, location_cls, n + 1)
+    existing = set(efforts)
+
+    def diff():
+        # What saving a user does: load the stored efforts into a set and
+        # compare it with the user's.
+        stored = set(twins[1:])
+        return stored - existing, existing - stored
+
+    print '%-8s %6d %10d %12.2f %12.2f %12.2f' % (
+        label,
+        n,
+        instance_size(efforts[0]),
+        best(lambda: set(efforts)),
+        best(diff),
+        best(lambda: [e == t for e, t in zip(efforts, twins)]),
+    )
+
+
+def set_size(efforts):
+    """The bytes held by a set of efforts and the objects making them up.
+
+    :param efforts: the set of efforts
+    """
+    size = sys.getsizeof(efforts)
+    for e in efforts:
+        size += (
+            instance_size(e) + sys.getsizeof(e.start_time) +
+            sys.getsizeof(e.duration)
+        )
+
+    return size + sum(
+        instance_size(l) for l in set(e.location for e in efforts)
+    )
+
+
+def bench_store(label, store, n):
+    """Print the memory and CPU cost of one way of holding a user's efforts.
+
+    :param label: the store's name
+    :param store: the type of the store
+    :param n: the number of efforts
+    """
+    efforts = store(make_efforts(Effort, Location, n))
+    if isinstance(efforts, EffortColumns):
+        total = efforts.total_seconds
+    else:
+        total = lambda: sum(e.duration.total_seconds() for e in efforts)
+
+    print '%-8s %6d %12d %12.2f %12.2f' % (
+        label,
+        n,
+        sys.getsizeof(efforts) if store is EffortColumns else set_size(efforts),
+        best(total),
+        best(lambda: list(efforts)),
+    )
+
+
+class GenericEffort(Effort):
+    """An effort validated by looping over its rules, as every model was
+    before rules were compiled per class.
+    """
+
+    __slots__ = ()
+    _validate = Model.__dict__['_validate']
+
+
+def bench_construct(n):
+    """Print the cost of constructing efforts with generic validation, with
+    compiled validation and from trusted rows.
+
+    :param n: the number of efforts
+    """
+    location = Location(latitude=41.5, longitude=71.5)
+    start = datetime(2013, 1, 1)
+    rows = [
+        dict(
+            start_time=start + timedelta(hours=i),
+            duration=timedelta(minutes=30),
+            location=location
+        )
+        for i in range(n)
+    ]
+
+    print '%-8s %6d %12.2f %12.2f %12.2f' % (
+        'effort',
+        n,
+        best(lambda: [GenericEffort(**r) for r in rows]),
+        best(lambda: [Effort(**r) for r in rows]),
+        best(lambda: [Effort.from_row(**r) for r in rows]),
+    )
+
+
+def loop_to_dict(obj):
+    """Serialize a model the way every model was before serialization was
+    compiled per class: a loop over its fields, then fixing up the ones that
+    need converting.
+
+    :param obj: the model object
+    """
+    obj_dict = dict((kw, getattr(obj, kw)) for kw in obj._validation_rules)
+    if isinstance(obj, Effort):
+        obj_dict['start_time'] = (
+            datetime.strftime(obj_dict['start_time'], DATETIME_FORMAT)
+        )
+        obj_dict['duration'] = int(obj_dict['duration'].total_seconds())
+        obj_dict['location'] = loop_to_dict(obj_dict['location'])
+
+    return obj_dict
+
+
+def bench_serialize(n):
+    """Print the cost of serializing a user's efforts by looping over each
+    effort's fields, with the compiled serializers the first time, and from
+    the memoized forms after that.
+
+    :param n: the number of efforts
+    """
+    efforts = make_efforts(Effort, Location, n)
+    # Each timing of the first serialization needs a store that hasn't
+    # serialized anything yet.
+    fresh = [EffortColumns(efforts) for _ in range(REPEAT)]
+    memoized = EffortColumns(efforts)
+    memoized.to_dicts()
+
+    print '%-8s %6d %12.2f %12.2f %12.2f' % (
+        'user',
+        n,
+        best(lambda: [loop_to_dict(e) for e in memoized]),
+        best(lambda: fresh.pop().to_dicts()),
+        best(memoized.to_dicts),
+    )
+
+
+def main():
+    print '%-8s %6s %10s %12s %12s %12s' % (
+        'impl', 'n', 'bytes/obj', 'set (ms)', 'diff (ms)', 'eq (ms)'
+    )
+    for n in SIZES:
+        bench('dict', DictEffort, DictLocation, n)
+        bench('slots', Effort, Location, n)
+
+    print
+    print '%-8s %6s %12s %12s %12s' % (
+        'store', 'n', 'bytes', 'total (ms)', 'iter (ms)'
+    )
+    for n in SIZES:
+        bench_store('set', set, n)
+        bench_store('columns', EffortColumns, n)
+
+    print
+    print '%-8s %6s %12s %12s %12s' % (
+        'model', 'n', 'generic (ms)', 'compiled', 'from_row'
+    )
+    for n in SIZES:
+        bench_construct(n)
+
+    print
+    print '%-8s %6s %12s %12s %12s' % (
+        'to_dict', 'n', 'loop (ms)', 'compiled', 'memoized'
+    )
+    for n in SIZES:
+        bench_serialize(n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+    bench.serving
+    =============
+
+    Benchmark cooperative serving under gevent against a synchronous worker
+    on the read endpoints, for 1 to 32 concurrent clients. Each server is a
+    single process of its own on the database configured for the app; the
+    clients are threads in this one. Client counts may be given on the
+    command line instead.
+
+    :author: Michael Browning
+"""
+
+from threading import Thread
+import httplib
+import socket
+import subprocess
+import sys
+import time
+
+CLIENTS = (1, 8, 32)
+REQUESTS = 400
+PORTS = {'sync': 5101, 'cooperative': 5102}
+URLS = ('/users/3', '/teams', '/teams/1', '/users/best', '/teams/best')
+
+
+def serve(mode, port):
+    """Serve the app on a port until killed, one request at a time or
+    cooperatively.
+
+    :param mode: `'sync'` or `'cooperative'`
+    :param port: the port to listen on
+    """
+    if mode == 'cooperative':
+        from gevent import monkey
+        monkey.patch_all()
+        from gevent.pywsgi import WSGIServer
+        from leaderboard import app, start_cooperative
+
+        start_cooperative()
+        WSGIServer(('127.0.0.1', port), app, log=None).serve_forever()
+    else:
+        from wsgiref.simple_server import make_server, WSGIRequestHandler
+        from leaderboard import app
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        make_server(
+            '127.0.0.1', port, app, handler_class=QuietHandler
+        ).serve_forever()
+
+
+def start(mode):
+    """Start a server process, and return it once it's accepting requests.
+
+    :param mode: `'sync'` or `'cooperative'`
+    """
+    port = PORTS[mode]
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'bench.serving', '--serve', mode, str(port)]
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError('the %s server did not start' % mode)
+
+
+def client(port, count, latencies):
+    """Request the read endpoints in turn, recording each request's
+    latency.
+
+    :param port: the server's port
+    :param count: how many requests to make
+    :param latencies: the list to append latencies to, in seconds
+    """
+    for n in range(count):
+        started = time.time()
+        connection = httplib.HTTPConnection('127.0.0.1', port)
+        connection.request('GET', URLS[n % len(URLS)])
+        connection.getresponse().read()
+        connection.close()
+        latencies.append(time.time() - started)
+
+
+def bench(mode, clients):
+    """Print the throughput and latency of a server for each number of
+    concurrent clients.
+
+    :param mode: `'sync'` or `'cooperative'`
+    :param clients: a list of client counts
+    """
+    server = start(mode)
+    try:
+        for n in clients:
+            latencies = []
+            threads = [
+                Thread(
+                    target=client,
+                    args=(PORTS[mode], REQUESTS // n, latencies)
+                )
+                for _ in range(n)
+            ]
+            started = time.time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            elapsed = time.time() - started
+
+            latencies.sort()
+            print '%12s %8d %10.1f %10.2f %10.2f' % (
+                mode, n, len(latencies) / elapsed,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[int(len(latencies) * 0.99)] * 1000
+            )
+    finally:
+        server.kill()
+        server.wait()
+
+
+def main():
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2], int(sys.argv[3]))
+        return
+
+    clients = [int(a) for a in sys.argv[1:]] or CLIENTS
+    print '%12s %8s %10s %10s %10s' % (
+        'server', 'clients', 'req/s', 'p50 (ms)', 'p99 (ms)'
+    )
+    bench('sync', clients)
+    try:
+        import gevent
+    except ImportError:
+        print 'gevent is not installed; skipping cooperative serving'
+    else:
+        bench('cooperative', clients)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,18 +7,44 @@
     :author: Michael Browning
 """
 
+import atexit
 import os
 import urlparse
 from ConfigParser import ConfigParser
 
-from flask import Flask
+from flask import Flask, has_request_context
 from psycopg2 import connect
 
+from .cache import LRUCache
+from .versions import VersionTable
+from .invalidation import InvalidationBus
+from .compression import CompressionMiddleware
+from .ingest import WriteBehindQueue
+from .fanout import FanOut
+from .pool import ConnectionPool
+from .profiling import ProfilingMiddleware, ProfileStore
+from .metrics import Registry
+
 config = ConfigParser()
 config.read('config.ini')
 
 app = Flask(__name__)
 
+
+def get_setting(section, option, default):
+    """Return an optional setting from config.ini, or a default if it isn't
+    set.
+
+    :param section: the config section
+    :param option: the option name
+    :param default: the value to use if the option isn't set
+    """
+    if config.has_option(section, option):
+        return config.get(section, option)
+
+    return default
+
+
 def get_connection():
     urlparse.uses_netloc.append('postgres')
     try:
@@ -43,8 +69,320 @@ def get_connection():
 
 connection = get_connection()
 
+# Lends each request a connection of its own, when serving cooperatively.
+request_connections = None
+
+
+def current_connection():
+    """The connection the app's repositories use by default: the current
+    request's own, if requests are lent connections, or else the one every
+    request shares.
+    """
+    if request_connections is not None and has_request_context():
+        return request_connections.get()
+
+    return connection
+
+
+def is_app_connection(conn):
+    """Return `True` if a connection is the one every request shares, or the
+    current request's own.
+
+    :param conn: the connection
+    """
+    if conn is connection:
+        return True
+
+    return (
+        request_connections is not None and has_request_context() and
+        request_connections.lent(conn)
+    )
+
+# Counts and times requests and samples the app's other counters for
+# /metrics, summed over the workers sharing the directory, if one is set.
+registry = Registry(
+    directory=get_setting('metrics', 'directory', None),
+    interval=float(get_setting('metrics', 'interval', 5))
+)
+registry.counter(
+    'leaderboard_requests_total', 'Requests served, by route and status.'
+)
+registry.counter(
+    'leaderboard_request_errors_total',
+    'Requests that failed, by route and whether the endpoint answered with '
+    'an error response or raised.'
+)
+registry.histogram(
+    'leaderboard_request_duration_seconds',
+    'Time taken to produce responses, by route.'
+)
+registry.histogram(
+    'leaderboard_request_db_seconds',
+    'Time spent in database transactions per request, by route.'
+)
+
+# Caches the output of the leaderboard views until a write invalidates it.
+response_cache = LRUCache(
+    max_size=int(get_setting('cache', 'response_size', 256)),
+    ttl=float(get_setting('cache', 'response_ttl', 60))
+)
+# Tracks which data each write touched, for conditional GETs.
+versions = VersionTable()
+
+from .persistence.user import aggregate_size
+
+# Keeps recently loaded user aggregates, so hot profiles skip the database.
+# Other workers' writes reach it over the bus; the time-to-live bounds how
+# long one whose notification was lost can go unseen.
+user_cache = LRUCache(
+    max_size=int(get_setting('cache', 'user_size', 1024)),
+    ttl=float(get_setting('cache', 'user_ttl', 30)),
+    max_bytes=int(get_setting('cache', 'user_bytes', 64 * 1024 * 1024)),
+    sizeof=aggregate_size
+)
+
+# Tells other workers about our writes, and us about theirs.
+bus = InvalidationBus(get_connection)
+
+# Keeps compressed copies of versioned responses, so that clients polling
+# unchanged data don't have it compressed for them every time.
+compression_cache = LRUCache(
+    max_size=int(get_setting('compression', 'cache_size', 256)),
+    max_bytes=int(get_setting('compression', 'cache_bytes', 16 * 1024 * 1024)),
+    sizeof=len
+)
+
+app.wsgi_app = CompressionMiddleware(
+    app.wsgi_app,
+    min_size=int(get_setting('compression', 'min_size', 1024)),
+    level=int(get_setting('compression', 'level', 6)),
+    cache=compression_cache
+)
+
+# Authorizes the admin endpoints, and profiling on demand, if it's set.
+admin_token = get_setting('admin', 'token', None)
+
+# Profiles requests the admin asks for, or a sample of them, if profiling is
+# configured, except in workers gevent has patched.
+profile_store = None
+if config.has_section('profiling'):
+    profile_store = ProfileStore(
+        keep=int(get_setting('profiling', 'keep', 50)),
+        top=int(get_setting('profiling', 'top', 30)),
+        directory=get_setting('profiling', 'directory', None)
+    )
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app,
+        profile_store,
+        token=admin_token,
+        sample_percent=float(get_setting('profiling', 'sample_percent', 0))
+    )
+
+from .idempotency import IdempotencyStore
+
+# Keeps the responses to writes made with an Idempotency-Key, so that retries
+# get them back without the writes being made again.
+idempotency_ttl = float(get_setting('idempotency', 'ttl', 24 * 60 * 60))
+idempotency_cache = LRUCache(
+    max_size=int(get_setting('idempotency', 'cache_size', 4096)),
+    ttl=idempotency_ttl
+)
+idempotency_store = IdempotencyStore(
+    idempotency_cache,
+    ttl=idempotency_ttl,
+    lease=float(get_setting('idempotency', 'lease', 60))
+)
+
+# Journals effort entries and saves them in batches behind the requests that
+# add them, if a journal directory is configured.
+entry_queue = None
+if config.has_option('ingest', 'journal_dir'):
+    entry_queue = WriteBehindQueue(
+        config.get('ingest', 'journal_dir'),
+        get_connection,
+        batch_size=int(get_setting('ingest', 'batch_size', 500)),
+        max_pending=int(get_setting('ingest', 'max_pending', 10000)),
+        block=float(get_setting('ingest', 'block', 0.5)),
+        sync=get_setting('ingest', 'sync', 'true').lower() == 'true'
+    )
+
+# Loads the related objects of listed users and teams concurrently, if more
+# than one load at a time is configured.
+fanout = None
+if int(get_setting('fanout', 'parallelism', 1)) > 1:
+    fanout = FanOut(
+        get_connection,
+        parallelism=int(get_setting('fanout', 'parallelism', 1))
+    )
+
+from .stream import Publisher, Standings
+
+# Pushes leaderboard changes to the clients streaming them.
+publisher = Publisher(
+    history=int(get_setting('stream', 'history', 256)),
+    queue_size=int(get_setting('stream', 'queue_size', 64)),
+    heartbeat=float(get_setting('stream', 'heartbeat', 15)),
+    retry=int(get_setting('stream', 'retry', 3000))
+)
+standings = Standings(
+    publisher,
+    get_connection,
+    max_pending=int(get_setting('stream', 'max_pending', 1000))
+)
+atexit.register(
+    standings.close, float(get_setting('stream', 'shutdown_timeout', 5))
+)
+
+
+def collect_stats():
+    """Sample the caches', pools' and queues' counters for :data:`registry`.
+    """
+    caches = (
+        ('responses', response_cache),
+        ('users', user_cache),
+        ('compression', compression_cache),
+        ('idempotency', idempotency_cache),
+    )
+    for name, cache in caches:
+        stats = cache.stats()
+        labels = {'cache': name}
+        yield 'leaderboard_cache_hits_total', labels, stats['hits']
+        yield 'leaderboard_cache_misses_total', labels, stats['misses']
+        yield 'leaderboard_cache_evictions_total', labels, stats['evictions']
+        yield 'leaderboard_cache_entries', labels, stats['size']
+        yield 'leaderboard_cache_bytes', labels, stats['bytes']
+
+    pools = []
+    if request_connections is not None:
+        pools.append(('requests', request_connections.pool.stats()))
+    if fanout is not None:
+        pools.append(('fanout', fanout.stats()))
+    for name, stats in pools:
+        labels = {'pool': name}
+        yield 'leaderboard_pool_size', labels, stats['size']
+        yield 'leaderboard_pool_connections', labels, stats['connections']
+        yield 'leaderboard_pool_busy', labels, stats['busy']
+        yield 'leaderboard_pool_waiting', labels, stats['waiting']
+        yield 'leaderboard_pool_waits_total', labels, stats['waits']
+        yield 'leaderboard_pool_timeouts_total', labels, stats['timeouts']
+
+    yield (
+        'leaderboard_stream_subscribers', {},
+        publisher.stats()['subscribers']
+    )
+    if entry_queue is not None:
+        stats = entry_queue.stats()
+        yield 'leaderboard_ingest_pending', {}, stats['pending']
+        yield 'leaderboard_ingest_rejected_total', {}, stats['rejected']
+
+registry.counter('leaderboard_cache_hits_total', 'Cache hits, by cache.')
+registry.counter('leaderboard_cache_misses_total', 'Cache misses, by cache.')
+registry.counter(
+    'leaderboard_cache_evictions_total', 'Cache evictions, by cache.'
+)
+registry.gauge('leaderboard_cache_entries', 'Entries cached, by cache.')
+registry.gauge('leaderboard_cache_bytes', 'Approximate bytes cached, by cache.')
+registry.ratio(
+    'leaderboard_cache_hit_ratio', 'The share of lookups that hit, by cache.',
+    'leaderboard_cache_hits_total',
+    ('leaderboard_cache_hits_total', 'leaderboard_cache_misses_total')
+)
+registry.gauge(
+    'leaderboard_pool_size', 'The most connections a pool may open, by pool.'
+)
+registry.gauge(
+    'leaderboard_pool_connections', 'Connections a pool has open, by pool.'
+)
+registry.gauge('leaderboard_pool_busy', 'Connections lent out, by pool.')
+registry.gauge(
+    'leaderboard_pool_waiting', 'Callers waiting for a connection, by pool.'
+)
+registry.counter(
+    'leaderboard_pool_waits_total',
+    'Times a caller had to wait for a connection, by pool.'
+)
+registry.counter(
+    'leaderboard_pool_timeouts_total',
+    'Times a caller gave up waiting for a connection, by pool.'
+)
+registry.ratio(
+    'leaderboard_pool_saturation', 'The share of a pool lent out, by pool.',
+    'leaderboard_pool_busy', ('leaderboard_pool_size',)
+)
+registry.gauge(
+    'leaderboard_stream_subscribers', 'Clients streaming leaderboard changes.'
+)
+registry.gauge(
+    'leaderboard_ingest_pending', 'Effort entries waiting to be saved.'
+)
+registry.counter(
+    'leaderboard_ingest_rejected_total',
+    'Queued effort entries set aside because they could not be saved.'
+)
+registry.collect(collect_stats)
+
 from .endpoints import *
 
+def start_invalidation_listener():
+    """Start applying other workers' writes to this worker's caches. Call this
+    once per worker process, after forking.
+    """
+    from . import actions
+
+    bus.subscribe(actions.apply_invalidation)
+    bus.on_reconnect(actions.drop_caches)
+    bus.start()
+
+
+def start_ingest():
+    """Start saving journaled effort entries behind the requests that add
+    them, if write-behind ingestion is configured, and make sure they're all
+    saved when the process exits. Call this once per worker process, after
+    forking.
+    """
+    if entry_queue is None:
+        return
+
+    from . import actions
+
+    entry_queue.start(actions.write_entries)
+    atexit.register(
+        entry_queue.close,
+        float(get_setting('ingest', 'shutdown_timeout', 30))
+    )
+
+
+def start_cooperative():
+    """Serve requests cooperatively, if this process has been patched by
+    gevent, as under `gunicorn -k gevent`: have psycopg2 let other requests
+    run while one waits on the database, and lend each request a connection
+    of its own from a pool. Call this once per worker process, after forking;
+    otherwise it does nothing.
+    """
+    global request_connections
+
+    from .cooperative import patched, patch_psycopg, RequestConnections
+
+    if request_connections is not None or not patched():
+        return
+
+    patch_psycopg()
+    request_connections = RequestConnections(ConnectionPool(
+        get_connection,
+        size=int(get_setting('cooperative', 'pool_size', 10)),
+        timeout=float(get_setting('cooperative', 'pool_timeout', 5))
+    ))
+    request_connections.init_app(app)
+
+
+def start_metrics():
+    """Start writing this worker's metrics where the other workers' can be
+    read, if a metrics directory is configured. Call this once per worker
+    process, after forking.
+    """
+    registry.start()
+
+
 def start_logging():
     if not app.debug:
         import os
@@ -7,13 +7,48 @@
     :author: Michael Browning
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from leaderboard.model import User, Team
-from leaderboard.persistence import UserRepository, TeamRepository
+from leaderboard import response_cache, user_cache, versions, bus, \
+    entry_queue, publisher, standings, fanout
+from leaderboard.model import User, Team, Competition
+from leaderboard.persistence import UserRepository, TeamRepository, \
+    CompetitionRepository
+from leaderboard.persistence.repository import DEFAULT_COMPETITION_ID
+from leaderboard.model.columns import to_epoch, from_epoch
+from leaderboard.exceptions import ConstraintError
 
 
-def add_user(username, first_name, last_name, email, team_id):
+def add_competition(name):
+    """Add a new competition.
+
+    :param name: the competition name
+    """
+    competition = Competition(name=name)
+    CompetitionRepository().save(competition)
+
+    return competition.id
+
+
+def archive_competition(competition_id):
+    """Archive a competition, making it read-only.
+
+    :param competition_id: the integer id of the competition
+    """
+    competition_repository = CompetitionRepository()
+    competition = competition_repository.get(competition_id=competition_id)
+    if competition is None:
+        raise ConstraintError('competition %s does not exist' % competition_id)
+    competition_repository.archive(competition)
+
+
+def get_competitions():
+    """Get all competitions that haven't been archived."""
+    return CompetitionRepository().live()
+
+
+def add_user(username, first_name, last_name, email, team_id,
+             competition_id=None):
     """Add a new user to a given team.
 
     :param first_name: the user's first name
@@ -21,34 +56,49 @@ def add_user(username, first_name, last_name, email, team_id):
     :param username: the user's unique username
     :param email: the user's email
     :param team_id: the user's integer team id
+    :param competition_id: the integer id of the competition the user is
+                           competing in; the default competition if `None`
     """
+    _check_live(competition_id)
+    _check_team(team_id, competition_id)
+
     user = User(
         username=username,
         first_name=first_name,
         last_name=last_name,
         email=email
     )
+    user.competition_id = competition_id
 
     user_repository = UserRepository()
     user_repository.save(user)
     user_repository.set_team(user, team_id)
+    _record_write(user.competition_id, user_id=user.id, team_id=team_id)
 
     return user.id
 
 
-def add_team(name):
+def add_team(name, competition_id=None):
     """Add a new team.
 
     :param name: the team name
+    :param competition_id: the integer id of the competition the team is
+                           competing in; the default competition if `None`
     """
+    _check_live(competition_id)
+
     team = Team(name=name)
+    team.competition_id = competition_id
     TeamRepository().save(team)
+    _record_write(team.competition_id, team_id=team.id)
 
     return team.id
 
 
 def add_entry(start_time, duration, user_id, latitude, longitude):
-    """Add a new volunteer entry for a given user.
+    """Add a new volunteer entry for a given user. If write-behind ingestion
+    is running, the entry is validated and queued to be saved later, and
+    `True` is returned; otherwise it's saved before this returns `False`.
 
     :param start_time: the start time of the work done
     :param duration: how long the user worked
@@ -58,26 +108,117 @@ def add_entry(start_time, duration, user_id, latitude, longitude):
     """
     user_repository = UserRepository()
     user = user_repository.get(user_id=user_id)
+    _check_live(user.competition_id)
     user.add_effort(
         start_time=start_time,
         duration=duration,
         latitude=latitude,
         longitude=longitude
     )
+
+    if entry_queue is not None and entry_queue.running:
+        # The entry has been checked against the user's saved efforts, and is
+        # checked against those still queued in this process; if it overlaps
+        # one queued in another, writing it fails and it's set aside as
+        # rejected.
+        entry_queue.submit({
+            'user': user.id,
+            'start_time': to_epoch(start_time),
+            'duration': duration.total_seconds(),
+            'latitude': latitude,
+            'longitude': longitude,
+        }, check=_check_queued(user.id, start_time, duration))
+        return True
+
     user_repository.save(user)
+    _record_write(
+        user.competition_id,
+        user_id=user.id,
+        team_id=user_repository.get_team(user)
+    )
+
+    return False
+
+
+def _check_queued(user_id, start_time, duration):
+    """Return a check for :meth:`WriteBehindQueue.submit` that refuses an
+    effort overlapping any queued for the same user.
+
+    :param user_id: the integer id of the user
+    :param start_time: the start time of the effort
+    :param duration: the duration of the effort
+    """
+    start = to_epoch(start_time)
+    end = start + duration.total_seconds()
+
+    def check(entry):
+        if (entry['user'] == user_id and entry['start_time'] < end and
+                start < entry['start_time'] + entry['duration']):
+            raise ConstraintError('Efforts may not overlap in time')
+
+    return check
+
 
+def write_entries(connection, entries):
+    """Save a batch of entries queued by :func:`add_entry`, on the
+    write-behind queue's connection, and apply the writes to this process's
+    caches and data versions.
 
-def get_users():
-    """Get all current users."""
-    return UserRepository().all()
+    :param connection: the database connection to write with
+    :param entries: a list of queued entry dictionaries
+    """
+    user_repository = UserRepository(connection)
+    # Other processes have to hear about these writes all the same.
+    user_repository.bus = bus
+    written = user_repository.add_entries([
+        dict(
+            e,
+            start_time=from_epoch(e['start_time']),
+            duration=timedelta(seconds=e['duration'])
+        )
+        for e in entries
+    ])
+    for u in written:
+        user_cache.delete(('user', u['id']))
+        _record_write(u['competition'], user_id=u['id'], team_id=u['team'])
+
+
+def get_users(competition_id=None, eager=True):
+    """Get all current users.
+
+    :param competition_id: if supplied, only get the users in this competition
+    :param eager: whether to load the users' efforts up front, rather than
+                  only their running totals
+    """
+    return UserRepository(
+        competition_id=competition_id, eager=eager, fanout=fanout
+    ).all()
 
 
-def get_user(user_id):
+def get_user(user_id, efforts=True, totals=True):
     """Get the user with a given id.
 
     :param user_id: the integer id of the user
+    :param efforts: whether to load the user's efforts
+    :param totals: whether to load the user's running totals, if not its
+                   efforts
     """
-    return UserRepository().get(user_id=user_id)
+    return UserRepository(eager=efforts, totals=totals).get(user_id=user_id)
+
+
+def get_users_by_id(user_ids, competition_id=None, efforts=True, totals=True):
+    """Get the users with the given ids, in order, with `None` for ids without
+    a user. The number of queries doesn't depend on the number of ids.
+
+    :param user_ids: a sequence of integer user ids
+    :param competition_id: if supplied, only get users in this competition
+    :param efforts: whether to load the users' efforts
+    :param totals: whether to load the users' running totals, if not their
+                   efforts
+    """
+    return UserRepository(
+        competition_id=competition_id, eager=efforts, totals=totals
+    ).get_many(user_ids)
 
 
 def get_user_team(user):
@@ -91,14 +232,184 @@ def get_user_team(user):
     return team_repository.get(team_id=user_repository.get_team(user))
 
 
-def get_teams():
-    """Get all current teams."""
-    return TeamRepository().all()
+def get_user_teams(users):
+    """Get the teams of any number of users, in a fixed number of queries,
+    without their members or running totals. Return a list of the teams in
+    the order of the users, with `None` for users who aren't on a team.
+
+    :param users: a sequence of users
+    """
+    team_ids = UserRepository().get_teams(users)
+    teams = TeamRepository(totals=False).get_many(
+        list(set(team_ids.values()))
+    )
+    by_id = dict((t.id, t) for t in teams if t is not None)
+
+    return [by_id.get(team_ids.get(u.id)) for u in users]
 
 
-def get_team(team_id):
+def get_teams(competition_id=None, eager=True):
+    """Get all current teams.
+
+    :param competition_id: if supplied, only get the teams in this competition
+    :param eager: whether to load the teams' members up front, rather than
+                  only their running totals
+    """
+    return TeamRepository(
+        competition_id=competition_id, eager=eager, fanout=fanout
+    ).all()
+
+
+def iter_teams(competition_id=None, members=True, efforts=True, totals=True):
+    """Get an iterator over all current teams, which only loads a batch of
+    teams at a time.
+
+    :param competition_id: if supplied, only get the teams in this competition
+    :param members: whether to load the teams' members
+    :param efforts: whether to load the members' efforts
+    :param totals: whether to load the running totals of the teams, and of
+                   their members if not their efforts
+    """
+    return TeamRepository(
+        competition_id=competition_id,
+        eager=members,
+        efforts=efforts,
+        totals=totals,
+        fanout=fanout
+    ).iter_all()
+
+
+def get_team(team_id, members=True, efforts=True, totals=True):
     """Get the team with a given id.
 
     :param team_id: the integer id of the team
+    :param members: whether to load the team's members
+    :param efforts: whether to load the members' efforts
+    :param totals: whether to load the running totals of the team, and of its
+                   members if not their efforts
+    """
+    return TeamRepository(
+        eager=members, efforts=efforts, totals=totals
+    ).get(team_id=team_id)
+
+
+def get_teams_by_id(team_ids, competition_id=None, members=True, efforts=True,
+                    totals=True):
+    """Get the teams with the given ids, in order, with `None` for ids without
+    a team. The number of queries doesn't depend on the number of ids.
+
+    :param team_ids: a sequence of integer team ids
+    :param competition_id: if supplied, only get teams in this competition
+    :param members: whether to load the teams' members
+    :param efforts: whether to load the members' efforts
+    :param totals: whether to load the running totals of the teams, and of
+                   their members if not their efforts
+    """
+    return TeamRepository(
+        competition_id=competition_id,
+        eager=members,
+        efforts=efforts,
+        totals=totals
+    ).get_many(team_ids)
+
+
+def _check_live(competition_id):
+    """Raise a :class:`ConstraintError` if the given competition doesn't exist
+    or has been archived, since archived competitions are read-only.
+
+    :param competition_id: the integer id of the competition, or `None` for the
+                           default competition
+    """
+    if competition_id is None:
+        return
+
+    competition = CompetitionRepository().get(competition_id=competition_id)
+    if competition is None:
+        raise ConstraintError('competition %s does not exist' % competition_id)
+    if competition.archived:
+        raise ConstraintError('competition %s is archived' % competition.name)
+
+
+def _check_team(team_id, competition_id):
+    """Raise a :class:`ConstraintError` if the given team doesn't exist in the
+    given competition, since users may only join teams in their own.
+
+    :param team_id: the integer id of the team
+    :param competition_id: the integer id of the competition, or `None` for the
+                           default competition
     """
-    return TeamRepository().get(team_id=team_id)
+    if competition_id is None:
+        competition_id = DEFAULT_COMPETITION_ID
+
+    team = TeamRepository(competition_id=competition_id).get(team_id=team_id)
+    if team is None:
+        raise ConstraintError('team %s is not in competition %s' % (
+            team_id, competition_id
+        ))
+
+
+def subscribe(competition_id=None, last_event_id=None):
+    """Subscribe to the changes writes make to the leaderboard, returning a
+    :class:`leaderboard.stream.Subscription`.
+
+    :param competition_id: the integer id of the competition whose
+                           leaderboard to follow; the one spanning every
+                           competition if `None`
+    :param last_event_id: the id of the last event a reconnecting client saw
+    """
+    standings.track(competition_id)
+
+    return publisher.subscribe(competition_id, last_event_id)
+
+
+def apply_invalidation(message):
+    """Apply a write made by another process, as announced on the
+    invalidation bus, to this process's caches and data versions.
+
+    :param message: the invalidation message dictionary
+    """
+    if message['kind'] == 'user':
+        user_cache.delete(('user', message['id']))
+        _record_write(
+            message['competition'],
+            user_id=message['id'],
+            team_id=message.get('team')
+        )
+        if message.get('old_team') is not None:
+            _record_write(message['competition'], team_id=message['old_team'])
+    elif message['kind'] == 'team':
+        _record_write(message['competition'], team_id=message['id'])
+
+
+def drop_caches():
+    """Drop everything this process has cached, and invalidate every ETag it
+    has issued, for when it may have missed other processes' writes.
+    """
+    user_cache.clear()
+    response_cache.clear()
+    versions.reset()
+    standings.clear()
+
+
+def _record_write(competition_id, user_id=None, team_id=None):
+    """Bump the data versions a write touched, drop the cached leaderboards
+    it may have changed, including the unscoped ones that span every
+    competition, and publish the changes it made to a user's standing to the
+    clients streaming them.
+
+    :param competition_id: the integer id of the written competition
+    :param user_id: the integer id of the written user, if any
+    :param team_id: the integer id of the written team, if any
+    """
+    keys = [('competition', competition_id)]
+    if user_id is not None:
+        keys.append(('user', user_id))
+    if team_id is not None:
+        keys.append(('team', team_id))
+    versions.bump(*keys)
+
+    response_cache.invalidate(
+        ('competition', competition_id), ('competition', None)
+    )
+    if user_id is not None:
+        standings.record(competition_id, user_id, team_id)
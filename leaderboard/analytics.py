@@ -0,0 +1,180 @@
+"""
+    leaderboard.analytics
+    ======================
+
+    Implements :class:`EffortArrays`, a vectorized path for leaderboard
+    computations over every effort at once, for reports and large rankings.
+    It needs NumPy, which the API itself doesn't.
+
+    :author: Michael Browning
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .model.columns import to_epoch
+from .persistence.analytics import AnalyticsRepository
+
+
+class EffortArrays(object):
+    """Every effort in a competition, as parallel NumPy arrays of user id,
+    start time in seconds since the epoch, duration in seconds and location
+    id, along with the ids of all users and teams and who is on which team.
+
+    Totals are computed by grouping the arrays on user or team id with
+    `bincount`, so no per-effort Python code runs.
+
+    :param users: the user id of each effort
+    :param starts: the start time of each effort
+    :param durations: the duration of each effort
+    :param locations: the location id of each effort
+    :param user_ids: the ids of all users, including those without efforts
+    :param team_ids: the ids of all teams, including those without members
+    :param memberships: an iterable of user and team id pairs
+    """
+
+    def __init__(self, users, starts, durations, locations, user_ids,
+                 team_ids, memberships):
+        if numpy is None:
+            raise ImportError('leaderboard analytics require NumPy')
+
+        self.users = numpy.asarray(users, dtype=numpy.int64)
+        self.starts = numpy.asarray(starts, dtype=numpy.float64)
+        self.durations = numpy.asarray(durations, dtype=numpy.float64)
+        self.locations = numpy.asarray(locations, dtype=numpy.int64)
+        self.user_ids = numpy.asarray(user_ids, dtype=numpy.int64)
+        self.team_ids = numpy.asarray(team_ids, dtype=numpy.int64)
+
+        # Every id used for indexing has a slot, so that bincount output can
+        # be indexed by id directly.
+        self._size = 1 + max(
+            self.users.max() if len(self.users) else 0,
+            self.user_ids.max() if len(self.user_ids) else 0
+        )
+        memberships = numpy.asarray(list(memberships), dtype=numpy.int64)
+        self.team_of_user = numpy.full(self._size, -1, dtype=numpy.int64)
+        if len(memberships):
+            memberships = memberships[memberships[:, 0] < self._size]
+            self.team_of_user[memberships[:, 0]] = memberships[:, 1]
+
+    @classmethod
+    def load(cls, repository=None, competition_id=None):
+        """Load every effort in bulk from an :class:`AnalyticsRepository`.
+
+        :param repository: the repository, or `None` for one on the app's
+                           connection
+        :param competition_id: if supplied, only load this competition
+        """
+        if numpy is None:
+            raise ImportError('leaderboard analytics require NumPy')
+        if repository is None:
+            repository = AnalyticsRepository(competition_id=competition_id)
+
+        batches = [
+            numpy.array(rows, dtype=numpy.float64)
+            for rows in repository.effort_batches()
+        ]
+        if batches:
+            rows = numpy.concatenate(batches)
+        else:
+            rows = numpy.empty((0, 4), dtype=numpy.float64)
+
+        return cls(
+            rows[:, 0], rows[:, 1], rows[:, 2], rows[:, 3],
+            repository.user_ids(),
+            repository.team_ids(),
+            repository.memberships()
+        )
+
+    def __len__(self):
+        return len(self.users)
+
+    def user_totals(self, start=None, end=None):
+        """Return the ids of all users and the total duration of each one's
+        efforts, in seconds, as two arrays.
+
+        :param start: if supplied, only count efforts starting at or after
+                      this :class:`datetime`
+        :param end: if supplied, only count efforts starting before this
+                    :class:`datetime`
+        """
+        mask = self._window(start, end)
+        totals = numpy.bincount(
+            self.users[mask], weights=self.durations[mask],
+            minlength=self._size
+        )
+
+        return self.user_ids, totals[self.user_ids]
+
+    def team_totals(self, start=None, end=None):
+        """Return the ids of all teams and the total duration of their
+        members' efforts, in seconds, as two arrays.
+
+        :param start: if supplied, only count efforts starting at or after
+                      this :class:`datetime`
+        :param end: if supplied, only count efforts starting before this
+                    :class:`datetime`
+        """
+        mask = self._window(start, end)
+        teams = self.team_of_user[self.users[mask]]
+        on_team = teams >= 0
+        size = 1 + max(
+            teams.max() if len(teams) else 0,
+            self.team_ids.max() if len(self.team_ids) else 0
+        )
+        totals = numpy.bincount(
+            teams[on_team], weights=self.durations[mask][on_team],
+            minlength=size
+        )
+
+        return self.team_ids, totals[self.team_ids]
+
+    def _window(self, start, end):
+        """Return a mask selecting the efforts that start in a window of time,
+        or a slice selecting every effort if the window is open.
+        """
+        if start is None and end is None:
+            return slice(None)
+
+        mask = numpy.ones(len(self.starts), dtype=bool)
+        if start is not None:
+            mask &= self.starts >= to_epoch(start)
+        if end is not None:
+            mask &= self.starts < to_epoch(end)
+
+        return mask
+
+
+def top_k(ids, totals, k):
+    """Return the ids and totals of the `k` largest totals, largest first.
+    Ties are broken by id, so the order is stable across calls.
+
+    :param ids: an array of ids
+    :param totals: an array of the corresponding totals
+    :param k: the number of entries to return
+    """
+    if 0 < k < len(totals):
+        # Selecting the top k is linear; only they need sorting. Everything
+        # tied with the kth total is kept, so the tie-break below is fair.
+        pivot = len(totals) - k
+        kth = totals[numpy.argpartition(totals, pivot)[pivot]]
+        candidates = numpy.flatnonzero(totals >= kth)
+    else:
+        candidates = numpy.arange(len(totals))
+
+    order = numpy.lexsort((ids[candidates], -totals[candidates]))[:k]
+
+    return ids[candidates][order], totals[candidates][order]
+
+
+def ranks(totals):
+    """Return the rank of each total, where the largest ranks 1 and equal
+    totals share a rank ("1224" ranking).
+
+    :param totals: an array of totals
+    """
+    ordered = numpy.sort(totals)
+
+    return 1 + len(totals) - numpy.searchsorted(ordered, totals, side='right')
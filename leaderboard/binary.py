@@ -0,0 +1,268 @@
+"""
+    leaderboard.binary
+    ===================
+
+    Implements a compact binary encoding of JSON-ready data, for clients that
+    ask for it instead of JSON.
+
+    An encoded document starts with :data:`MAGIC`, followed by a table of every
+    dictionary key used in it and then the value itself. Dictionaries refer to
+    their keys by their number in the table, so that a key repeated across a
+    listing is only sent once. Every value starts with a one-byte tag:
+
+    ===  ==============================================================
+    tag  value
+    ===  ==============================================================
+    N    `null`
+    T    `true`
+    F    `false`
+    I    an integer, zigzag-encoded as a varint
+    E    a :data:`leaderboard.helpers.DATETIME_FORMAT` time, as an `I` of
+         seconds since the epoch
+    R    a float, as an 8-byte big-endian double
+    S    a string, as a varint byte length and its UTF-8 bytes
+    L    an array, as a varint length and its values
+    D    an object, as a varint length and its key numbers and values
+    ===  ==============================================================
+
+    Varints are unsigned little-endian base 128, as in Protocol Buffers, and
+    the key table is a varint length followed by each key as an `S` without
+    its tag.
+
+    :author: Michael Browning
+"""
+
+import calendar
+import re
+import struct
+import time
+
+MIMETYPE = 'application/vnd.leaderboard+binary'
+MAGIC = 'LB\x01'
+
+# Tells the ETags of binary responses from those of the same data in JSON.
+ETAG_SUFFIX = 'bin'
+
+# Strings shaped like the API's times are sent as integers, provided they
+# come back out the same.
+TIME = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d$')
+TIME_FORMAT = '%04d-%02d-%02dT%02d:%02d:%02d'
+
+_double = struct.Struct('>d')
+
+
+def encode(obj):
+    """Return the binary encoding of a JSON-ready object.
+
+    :param obj: the object, made of dictionaries with string keys, lists,
+                tuples, strings, numbers, booleans and `None`
+    """
+    return _Encoder().encode(obj)
+
+
+def decode(data):
+    """Return the object a binary encoding represents, with strings decoded
+    to unicode as :func:`json.loads` would. Raises :class:`ValueError` if the
+    data isn't a valid encoding.
+
+    :param data: the encoded byte string
+    """
+    return _Decoder(data).decode()
+
+
+def _time_seconds(value):
+    """Return the seconds since the epoch of a time string, or `None` if the
+    string doesn't exactly round-trip through them.
+
+    :param value: the string
+    """
+    if not TIME.match(value):
+        return None
+
+    fields = tuple(
+        int(value[a:b])
+        for a, b in ((0, 4), (5, 7), (8, 10), (11, 13), (14, 16), (17, 19))
+    )
+    try:
+        seconds = calendar.timegm(fields)
+        if _format_time(seconds) != value:
+            return None
+    except (ValueError, OverflowError):
+        return None
+
+    return seconds
+
+
+def _format_time(seconds):
+    """Return the time string for a number of seconds since the epoch.
+
+    :param seconds: the seconds since the epoch
+    """
+    return TIME_FORMAT % time.gmtime(seconds)[:6]
+
+
+def _write_uint(out, n):
+    """Append an unsigned integer as a varint."""
+    while n > 0x7f:
+        out.append(chr(n & 0x7f | 0x80))
+        n >>= 7
+    out.append(chr(n))
+
+
+def _write_int(out, n):
+    """Append a signed integer as a zigzag-encoded varint, which keeps small
+    negative numbers short.
+    """
+    _write_uint(out, n * 2 if n >= 0 else -n * 2 - 1)
+
+
+def _write_str(out, value):
+    """Append a string as its byte length and UTF-8 bytes."""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    _write_uint(out, len(value))
+    out.append(value)
+
+
+class _Encoder(object):
+    """Encodes one document, collecting its key table as it goes."""
+
+    def __init__(self):
+        self.keys = {}
+        self.key_list = []
+        self.out = []
+
+    def encode(self, obj):
+        self._value(obj)
+
+        head = [MAGIC]
+        _write_uint(head, len(self.key_list))
+        for key in self.key_list:
+            _write_str(head, key)
+
+        return ''.join(head + self.out)
+
+    def _value(self, value):
+        out = self.out
+        if value is None:
+            out.append('N')
+        elif value is True:
+            out.append('T')
+        elif value is False:
+            out.append('F')
+        elif isinstance(value, (int, long)):
+            out.append('I')
+            _write_int(out, value)
+        elif isinstance(value, float):
+            out.append('R')
+            out.append(_double.pack(value))
+        elif isinstance(value, basestring):
+            seconds = _time_seconds(value)
+            if seconds is None:
+                out.append('S')
+                _write_str(out, value)
+            else:
+                out.append('E')
+                _write_int(out, seconds)
+        elif isinstance(value, dict):
+            out.append('D')
+            _write_uint(out, len(value))
+            for key, item in value.iteritems():
+                _write_uint(out, self._key(key))
+                self._value(item)
+        elif isinstance(value, (list, tuple)):
+            out.append('L')
+            _write_uint(out, len(value))
+            for item in value:
+                self._value(item)
+        else:
+            raise TypeError('%r is not serializable' % (value,))
+
+    def _key(self, key):
+        """Return the number of a key in the key table, adding it if it's
+        new.
+        """
+        number = self.keys.get(key)
+        if number is None:
+            if not isinstance(key, basestring):
+                raise TypeError('key %r is not a string' % (key,))
+            number = self.keys[key] = len(self.key_list)
+            self.key_list.append(key)
+
+        return number
+
+
+class _Decoder(object):
+    """Decodes one document."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def decode(self):
+        if self._read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a leaderboard binary document')
+
+        self.keys = [self._str() for _ in xrange(self._uint())]
+        value = self._value()
+        if self.pos != len(self.data):
+            raise ValueError('trailing data at byte %d' % self.pos)
+
+        return value
+
+    def _read(self, n):
+        end = self.pos + n
+        if end > len(self.data):
+            raise ValueError('truncated at byte %d' % self.pos)
+        chunk = self.data[self.pos:end]
+        self.pos = end
+
+        return chunk
+
+    def _uint(self):
+        n = shift = 0
+        while True:
+            byte = ord(self._read(1))
+            n |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return n
+            shift += 7
+
+    def _int(self):
+        n = self._uint()
+        return n >> 1 if not n & 1 else -((n + 1) >> 1)
+
+    def _str(self):
+        return self._read(self._uint()).decode('utf-8')
+
+    def _value(self):
+        tag = self._read(1)
+        if tag == 'N':
+            return None
+        elif tag == 'T':
+            return True
+        elif tag == 'F':
+            return False
+        elif tag == 'I':
+            return self._int()
+        elif tag == 'E':
+            return unicode(_format_time(self._int()))
+        elif tag == 'R':
+            return _double.unpack(self._read(_double.size))[0]
+        elif tag == 'S':
+            return self._str()
+        elif tag == 'L':
+            return [self._value() for _ in xrange(self._uint())]
+        elif tag == 'D':
+            obj = {}
+            for _ in xrange(self._uint()):
+                number = self._uint()
+                try:
+                    key = self.keys[number]
+                except IndexError:
+                    raise ValueError('unknown key %d' % number)
+                obj[key] = self._value()
+
+            return obj
+
+        raise ValueError('unknown tag %r at byte %d' % (tag, self.pos - 1))
@@ -0,0 +1,207 @@
+"""
+    leaderboard.cache
+    ==================
+
+    Implements an in-process, thread-safe LRU cache with optional expiry,
+    memory accounting and tag-based invalidation.
+
+    :author: Michael Browning
+"""
+
+from collections import OrderedDict
+from threading import RLock
+import time
+
+
+class LRUCache(object):
+    """A size-bounded cache that evicts the least recently used entry once
+    full. Entries may expire after a fixed time-to-live, and may be tagged so
+    that a group of related entries can be invalidated (or found) in one call.
+
+    If a `sizeof` callable is supplied, the cache also keeps a running total of
+    the approximate bytes held by its values, and evicts entries to keep that
+    total under `max_bytes`.
+
+    :param max_size: the maximum number of entries kept
+    :param ttl: the number of seconds an entry stays fresh, or `None` if
+                entries never expire
+    :param clock: a callable returning the current time in seconds
+    :param max_bytes: the maximum number of bytes held, or `None` for no limit
+    :param sizeof: a callable returning the approximate size of a value in
+                   bytes
+    """
+
+    def __init__(self, max_size, ttl=None, clock=time.time, max_bytes=None,
+                 sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._tags = {}
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        """Return the value cached under a key, or `default` if there is no
+        fresh entry for it.
+
+        :param key: the cache key
+        :param default: the value to return on a miss
+        """
+        with self._lock:
+            try:
+                value, tags, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= self.clock():
+                self.bytes -= self._sizes.pop(key)
+                self._untag(key, tags)
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            # Reinsert to mark the entry as the most recently used.
+            self._entries[key] = (value, tags, expires)
+            self.hits += 1
+
+            return value
+
+    def get_tagged(self, tag, default=None):
+        """Return the value of an entry carrying a tag, or `default` if there
+        is no fresh one. This lets tags that are unique to one entry double as
+        alternate keys.
+
+        :param tag: the tag to look up
+        :param default: the value to return on a miss
+        """
+        with self._lock:
+            keys = self._tags.get(tag)
+            if not keys:
+                self.misses += 1
+                return default
+
+            return self.get(next(iter(keys)), default)
+
+    def set(self, key, value, tags=()):
+        """Cache a value, evicting the least recently used entries if the
+        cache is full.
+
+        :param key: the cache key
+        :param value: the value to cache
+        :param tags: an iterable of tags the entry can be invalidated by
+        """
+        tags = frozenset(tags)
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        size = self.sizeof(value) if self.sizeof is not None else 0
+
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (value, tags, expires)
+            self._sizes[key] = size
+            self.bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while len(self._entries) > self.max_size or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                self._evict()
+
+    def delete(self, key):
+        """Remove an entry from the cache, if present.
+
+        :param key: the cache key
+        """
+        with self._lock:
+            if self._discard(key):
+                self.invalidations += 1
+
+    def invalidate(self, *tags):
+        """Remove every entry carrying any of the given tags.
+
+        :param tags: the tags to invalidate
+        """
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    if self._discard(key):
+                        self.invalidations += 1
+
+    def clear(self):
+        """Remove every entry from the cache."""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._sizes.clear()
+            self._tags.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Return a dictionary of the cache's counters, for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict(self):
+        """Evict the least recently used entry."""
+        key, (value, tags, expires) = self._entries.popitem(last=False)
+        self.bytes -= self._sizes.pop(key)
+        self._untag(key, tags)
+        self.evictions += 1
+
+    def _discard(self, key):
+        """Remove an entry and its tag references, returning whether it was
+        present.
+
+        :param key: the cache key
+        """
+        try:
+            value, tags, expires = self._entries.pop(key)
+        except KeyError:
+            return False
+
+        self.bytes -= self._sizes.pop(key)
+        self._untag(key, tags)
+        return True
+
+    def _untag(self, key, tags):
+        """Drop a key from the index of each of its tags.
+
+        :param key: the cache key
+        :param tags: the tags the key was stored with
+        """
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
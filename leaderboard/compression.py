@@ -0,0 +1,284 @@
+"""
+    leaderboard.compression
+    ========================
+
+    Implements :class:`CompressionMiddleware`, which compresses the app's
+    responses for clients that accept it.
+
+    :author: Michael Browning
+"""
+
+from itertools import chain
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header, parse_etags, unquote_etag
+from werkzeug.wsgi import ClosingIterator
+
+from . import binary
+
+# The content codings offered, most preferred first, with the `wbits` zlib
+# needs to write each one's container.
+ENCODINGS = (
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+)
+
+COMPRESSIBLE_TYPES = ('application/json', binary.MIMETYPE)
+
+
+class CompressionMiddleware(object):
+    """WSGI middleware that gzip- or deflate-compresses successful responses
+    of at least `min_size` bytes, when the request's `Accept-Encoding` allows
+    it.
+
+    Responses without a `Content-Length`, such as streamed ones, are buffered
+    until `min_size` bytes have arrived, and then compressed as they're
+    streamed, a chunk at a time.
+
+    Responses carrying an `ETag` are the same for as long as it is, so if a
+    `cache` is supplied, their compressed bytes are kept in it, keyed by the
+    request's path and query, the `ETag`, the content type and the encoding.
+    Later requests for the same version then skip both compressing and
+    reading the body.
+
+    A strong `ETag` names the exact bytes of a response, so compressed
+    responses carry the weak form of the app's `ETag` instead. It still
+    matches `If-None-Match`, which compares tags weakly, and a `304 Not
+    Modified` answering a weak tag is given the weak form too.
+
+    :param app: the WSGI application to wrap
+    :param min_size: the size in bytes below which responses are sent as they
+                     are, since compressing them doesn't pay
+    :param level: the zlib compression level
+    :param cache: an optional :class:`leaderboard.cache.LRUCache` for
+                  compressed bodies
+    """
+
+    def __init__(self, app, min_size=1024, level=6, cache=None):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.cache = cache
+
+    def __call__(self, environ, start_response):
+        started = []
+
+        def capture(status, headers, exc_info=None):
+            started[:] = [status, headers, exc_info]
+
+            # The app's body is only written after the decision to compress
+            # it is made, so it has to come from the returned iterable.
+            def write(data):
+                raise NotImplementedError(
+                    'compressed responses must be returned, not written'
+                )
+            return write
+
+        app_iter = self.app(environ, capture)
+        chunks = iter(app_iter)
+        buffered = []
+        if not started:
+            # The app only starts the response once it's first iterated.
+            buffered.extend(_take(chunks, 1))
+        status, headers, exc_info = started
+        headers = Headers(headers)
+        if status.startswith('304'):
+            _match_weak_etag(environ, headers)
+
+        if not self._compressible(environ, status, headers):
+            start_response(status, headers.to_list(), exc_info)
+            return _rejoin(buffered, chunks, app_iter)
+
+        headers['Vary'] = ', '.join(
+            [v for v in [headers.get('Vary')] if v] + ['Accept-Encoding']
+        )
+        encoding, wbits = self._encoding(environ)
+        length = headers.get('Content-Length', type=int)
+        if encoding is None or (length is not None and length < self.min_size):
+            start_response(status, headers.to_list(), exc_info)
+            return _rejoin(buffered, chunks, app_iter)
+
+        key = None
+        if self.cache is not None and 'ETag' in headers:
+            key = (
+                environ.get('PATH_INFO', ''),
+                environ.get('QUERY_STRING', ''),
+                headers['ETag'],
+                headers.get('Content-Type'),
+                encoding,
+            )
+            body = self.cache.get(key)
+            if body is not None:
+                _close(app_iter)
+                return self._send(
+                    start_response, status, headers, encoding, [body],
+                    len(body)
+                )
+
+        size = sum(len(c) for c in buffered)
+        for chunk in chunks:
+            buffered.append(chunk)
+            size += len(chunk)
+            if size >= self.min_size:
+                break
+        else:
+            # The whole body arrived under the threshold.
+            _close(app_iter)
+            start_response(status, headers.to_list(), exc_info)
+            return buffered
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, wbits)
+        if length is not None:
+            # The body was all there to begin with, so it's sent in one piece
+            # with its compressed length.
+            try:
+                body = compressor.compress(''.join(_rejoin(buffered, chunks)))
+                body += compressor.flush()
+            finally:
+                _close(app_iter)
+            if key is not None:
+                self.cache.set(key, body)
+
+            return self._send(
+                start_response, status, headers, encoding, [body], len(body)
+            )
+
+        # What's been buffered goes out as the first compressed chunk.
+        chunks = chain([''.join(buffered)], chunks)
+        return ClosingIterator(
+            self._send(
+                start_response, status, headers, encoding,
+                self._stream(compressor, chunks, key)
+            ),
+            lambda: _close(app_iter)
+        )
+
+    def _compressible(self, environ, status, headers):
+        """Return `True` if a response is one that could be compressed,
+        whether or not this request allows it.
+        """
+        return (
+            environ.get('REQUEST_METHOD') != 'HEAD' and
+            status.startswith('200') and
+            'Content-Encoding' not in headers and
+            headers.get('Content-Type', '').split(';')[0].strip()
+                in COMPRESSIBLE_TYPES
+        )
+
+    def _encoding(self, environ):
+        """Return the name and zlib `wbits` of the encoding the request
+        accepts most, or `None` and `None` if it accepts neither. An explicit
+        quality for an encoding overrides a wildcard's.
+        """
+        qualities = dict(
+            (value.lower(), quality) for value, quality in
+            parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        )
+        best = (None, None)
+        best_quality = 0
+        for name, wbits in ENCODINGS:
+            quality = qualities.get(name, qualities.get('*', 0))
+            if quality > best_quality:
+                best = (name, wbits)
+                best_quality = quality
+
+        return best
+
+    def _send(self, start_response, status, headers, encoding, body,
+              length=None):
+        """Start a compressed response and return its body.
+
+        :param encoding: the name of the encoding
+        :param body: an iterable of compressed chunks
+        :param length: the compressed length, if known
+        """
+        headers['Content-Encoding'] = encoding
+        if 'ETag' in headers and not headers['ETag'].startswith('W/'):
+            headers['ETag'] = 'W/' + headers['ETag']
+        if length is None:
+            headers.pop('Content-Length', None)
+        else:
+            headers['Content-Length'] = str(length)
+        start_response(status, headers.to_list())
+
+        return body
+
+    def _stream(self, compressor, chunks, key=None):
+        """Compress chunks as they arrive, flushing after each so that none
+        is held back, and cache the result if a key is given and the whole
+        body is streamed.
+
+        :param compressor: the zlib compression object
+        :param chunks: an iterable of uncompressed chunks
+        :param key: the cache key, or `None`
+        """
+        kept = []
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            if key is not None:
+                kept.append(data)
+            yield data
+
+        data = compressor.flush()
+        if key is not None:
+            kept.append(data)
+            self.cache.set(key, ''.join(kept))
+        yield data
+
+
+def _match_weak_etag(environ, headers):
+    """Give a `304 Not Modified` the weak form of its `ETag` if that's the
+    form the request's `If-None-Match` named, as it is for clients holding a
+    compressed response.
+
+    :param environ: the request's WSGI environment
+    :param headers: the response's :class:`Headers`
+    """
+    if 'ETag' not in headers or headers['ETag'].startswith('W/'):
+        return
+
+    tag = unquote_etag(headers['ETag'])[0]
+    etags = parse_etags(environ.get('HTTP_IF_NONE_MATCH'))
+    if etags.is_weak(tag) and not etags.contains(tag):
+        headers['ETag'] = 'W/' + headers['ETag']
+
+
+def _take(chunks, n):
+    """Return up to the next `n` chunks of an iterator."""
+    taken = []
+    for chunk in chunks:
+        taken.append(chunk)
+        if len(taken) == n:
+            break
+
+    return taken
+
+
+def _rejoin(buffered, chunks, app_iter=None):
+    """Return an iterable of chunks already read, followed by the rest. If the
+    app's iterable is given, it's closed when the result is.
+
+    :param buffered: a list of the chunks read so far
+    :param chunks: an iterator over the remaining chunks
+    :param app_iter: the iterable returned by the app
+    """
+    if not buffered and app_iter is not None:
+        return app_iter
+
+    def rejoined():
+        for chunk in buffered:
+            yield chunk
+        for chunk in chunks:
+            yield chunk
+
+    if app_iter is None:
+        return rejoined()
+    return ClosingIterator(rejoined(), lambda: _close(app_iter))
+
+
+def _close(app_iter):
+    """Close the iterable returned by a WSGI app, if it can be closed."""
+    if hasattr(app_iter, 'close'):
+        app_iter.close()
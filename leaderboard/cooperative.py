@@ -0,0 +1,140 @@
+"""
+    leaderboard.cooperative
+    ========================
+
+    Implements cooperative serving under gevent: a wait callback that has
+    psycopg2 yield to other requests while it waits on the database, and
+    :class:`RequestConnections`, which lends each request a pooled connection
+    of its own. It needs gevent, which the API itself doesn't.
+
+    :author: Michael Browning
+"""
+
+from functools import partial
+
+try:
+    from gevent import monkey
+    from gevent.socket import wait_read, wait_write
+except ImportError:
+    monkey = None
+
+import flask
+import psycopg2
+from psycopg2 import extensions
+
+
+def patched():
+    """Return `True` if gevent has patched the standard library in this
+    process, as its gunicorn workers do, so that requests are served by
+    greenlets.
+    """
+    return monkey is not None and monkey.is_module_patched('socket')
+
+
+def patch_psycopg():
+    """Have psycopg2 wait on the database with :func:`wait_callback`, so
+    that every connection in the process yields to other greenlets rather
+    than blocking them.
+    """
+    if monkey is None:
+        raise ImportError('cooperative serving requires gevent')
+
+    extensions.set_wait_callback(wait_callback)
+
+
+def wait_callback(connection, timeout=None):
+    """Wait until a connection's pending operation is done, letting other
+    greenlets run meanwhile. Called by psycopg2 once installed with
+    :func:`patch_psycopg`.
+
+    :param connection: the connection
+    :param timeout: how long to wait for the socket, in seconds
+    """
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(
+                'bad result from poll: %r' % state
+            )
+
+
+class RequestConnections(object):
+    """Lends each request a connection from a pool for as long as it runs, so
+    that requests served concurrently by one process don't share a
+    connection, and each waits on the database only for its own queries.
+
+    A request only takes a connection when it first asks for one with
+    :meth:`get`, and gives it back when it's torn down, with anything it left
+    uncommitted rolled back. A streamed response may read from the database
+    while it's being sent, so its request keeps the connection until the
+    response is closed.
+
+    :param pool: a :class:`leaderboard.pool.ConnectionPool`
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def init_app(self, app):
+        """Give the connections back at the end of an app's requests.
+
+        :param app: a :class:`flask.Flask` app instance
+        """
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+    def get(self):
+        """The current request's connection, taken from the pool if it
+        doesn't have one yet.
+        """
+        connection = getattr(flask.g, 'pooled_connection', None)
+        if connection is None:
+            connection = flask.g.pooled_connection = self.pool.get()
+
+        return connection
+
+    def lent(self, connection):
+        """Return `True` if a connection is the current request's.
+
+        :param connection: the connection
+        """
+        return connection is getattr(flask.g, 'pooled_connection', None)
+
+    def _after_request(self, response):
+        """Keep the connection of a request with a streamed response until
+        the response is closed.
+
+        :param response: the response object
+        """
+        connection = getattr(flask.g, 'pooled_connection', None)
+        if connection is not None and response.is_streamed:
+            flask.g.pooled_connection = None
+            response.call_on_close(partial(self._release, connection))
+
+        return response
+
+    def _teardown_request(self, exc=None):
+        """Give back the connection of a request that's done with it."""
+        connection = getattr(flask.g, 'pooled_connection', None)
+        if connection is not None:
+            flask.g.pooled_connection = None
+            self._release(connection)
+
+    def _release(self, connection):
+        """Roll back whatever a connection left uncommitted, closing it if
+        that fails, and give it back to the pool.
+
+        :param connection: the connection
+        """
+        if not connection.closed:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                connection.close()
+        self.pool.put(connection)
@@ -12,16 +12,33 @@ from functools import wraps
 
 from flask import request, abort, redirect
 
-from leaderboard import app
+from leaderboard import app, response_cache, user_cache, versions, bus, \
+    compression_cache, idempotency_cache, idempotency_store, admin_token, \
+    profile_store, registry
+from leaderboard.versions import GLOBAL
+from leaderboard.metrics import CONTENT_TYPE
 import actions
-from exceptions import HHException
-from .helpers import view, render_json, DATETIME_FORMAT
+from exceptions import HHException, ValidationError
+from .helpers import view, cached, idempotent, admin, render_json, \
+    render_json_stream, DATETIME_FORMAT
+
+
+# The fields and relations `?fields=` and `?include=` may name.
+FIELDS = frozenset([
+    'username', 'first_name', 'last_name', 'email', 'name', 'effort',
+    'efforts', 'members',
+])
+RELATIONS = frozenset(['efforts', 'members'])
+
+# The most ids `?ids=` may name in one request.
+MAX_IDS = 100
 
 
 def endpoint(fn):
     """Since the action layer nicely packages the error handling, we can
     standardize how the endpoints pass error messages through with this
-    decorator.
+    decorator. The errors are counted in :data:`leaderboard.registry`, as they
+    never reach :func:`leaderboard.helpers.view`.
 
     :param fn: the function to wrap
     """
@@ -30,15 +47,26 @@ def endpoint(fn):
         try:
             return fn(*args, **kwargs)
         except HHException as e:
+            _count_error()
             return _error_response(e.message)
         except Exception:
+            _count_error()
             return _error_response()
 
     return wrapped
 
 
+def _count_error():
+    """Count an error the current request was answered with."""
+    registry.inc(
+        'leaderboard_request_errors_total',
+        route=request.url_rule.rule, method=request.method, handled='true'
+    )
+
+
 @view(app, '/users', render_json, methods=['POST'])
 @endpoint
+@idempotent(idempotency_store)
 def add_user():
     """Add a new HH user."""
     user_id = actions.add_user(
@@ -46,7 +74,8 @@ def add_user():
         request.json['first_name'],
         request.json['last_name'],
         request.json['email'],
-        int(request.json['team'])
+        int(request.json['team']),
+        _competition_id()
     )
 
     response = _success_response()
@@ -59,7 +88,7 @@ def add_user():
 @endpoint
 def add_team():
     """Add a new HH team."""
-    team_id = actions.add_team(request.json['name'])
+    team_id = actions.add_team(request.json['name'], _competition_id())
 
     response = _success_response()
     response['id'] = team_id
@@ -69,12 +98,13 @@ def add_team():
 
 @view(app, '/users/<int:user_id>', render_json, methods=['POST'])
 @endpoint
+@idempotent(idempotency_store)
 def add_entry(user_id):
     """Add a new volunteer entry for the given user.
 
     :param user_id: the integer id of the user
     """
-    actions.add_entry(
+    queued = actions.add_entry(
         datetime.strptime(request.json['start_time'], DATETIME_FORMAT),
         timedelta(0, int(request.json['duration'])),
         int(request.json['user']),
@@ -82,41 +112,69 @@ def add_entry(user_id):
         float(request.json['longitude'])
     )
 
-    return _success_response()
+    response = _success_response()
+    if queued:
+        response['queued'] = True
+
+    return response
+
+
+@view(app, '/users', render_json, methods=['GET'],
+      version=lambda: _competition_version())
+@endpoint
+def get_users():
+    """Get the users named by the `ids` query argument, in its order."""
+    fields, include = _fieldset()
+    loading = _loading(fields, include)
+    user_ids = _ids_arg()
+    users = actions.get_users_by_id(
+        user_ids,
+        _competition_id(),
+        efforts=loading['efforts'],
+        totals=loading['totals']
+    )
+
+    return {'users': _multi_get(user_ids, users, fields, include)}
 
 
-@view(app, '/users/<int:user_id>', render_json, methods=['GET'])
+@view(app, '/users/<int:user_id>', render_json, methods=['GET'],
+      version=lambda user_id: versions.get(('user', user_id)))
 @endpoint
 def get_user(user_id):
     """Get a user's profile information.
 
     :param user_id: the integer id of the user
     """
-    return actions.get_user(user_id).to_dict()
+    fields, include = _fieldset()
+    loading = _loading(fields, include)
+    user = actions.get_user(
+        user_id, efforts=loading['efforts'], totals=loading['totals']
+    )
+
+    return user.to_dict(fields, include)
 
 
-@view(app, '/users/best', render_json, methods=['GET'])
+@view(app, '/users/best', render_json, methods=['GET'],
+      version=lambda: _competition_version())
+@cached(
+    response_cache,
+    args=('num_users', 'competition'),
+    tags=lambda: [('competition', _competition_id())],
+    version=lambda: _competition_version()
+)
 @endpoint
 def get_best_users():
     """Get a listing of the top volunteers."""
-    users = actions.get_users()
+    # Only the users' running totals are needed, not their efforts.
+    users = actions.get_users(_competition_id(), eager=False)
     user_data = []
-    for u in users:
-        if u.efforts:
-            effort = int(reduce(
-                lambda x, y: x + y, [e.duration for e in u.efforts]
-            ).total_seconds())
-        else:
-            effort = 0
-
-        team = actions.get_user_team(u)
-
+    for u, team in zip(users, actions.get_user_teams(users)):
         user_data.append({
             'username': u.username,
             'first_name': u.first_name,
             'last_name': u.last_name,
-            'effort': effort,
-            'team': team.name,
+            'effort': int(u.time_worked()),
+            'team': team.name if team is not None else None,
         })
 
     num_users = int(request.args.get('num_users', len(user_data)))
@@ -128,39 +186,57 @@ def get_best_users():
     }
 
 
-@view(app, '/teams', render_json, methods=['GET'])
+@view(app, '/teams', render_json_stream, methods=['GET'],
+      version=lambda: _competition_version())
 @endpoint
 def get_teams():
-    """Get a listing of all the teams."""
-    return {'teams': [t.to_dict() for t in actions.get_teams()]}
+    """Get a listing of all the teams, streamed a team at a time, or just the
+    teams named by the `ids` query argument, in its order.
+    """
+    fields, include = _fieldset()
+    if 'ids' in request.args:
+        team_ids = _ids_arg()
+        teams = actions.get_teams_by_id(
+            team_ids, _competition_id(), **_loading(fields, include)
+        )
+        return {'teams': _multi_get(team_ids, teams, fields, include)}
+
+    teams = actions.iter_teams(_competition_id(), **_loading(fields, include))
 
+    return {'teams': (t.to_dict(fields, include) for t in teams)}
 
-@view(app, '/teams/<int:team_id>', render_json, methods=['GET'])
+
+@view(app, '/teams/<int:team_id>', render_json, methods=['GET'],
+      version=lambda team_id: versions.get(('team', team_id)))
 @endpoint
 def get_team(team_id):
     """Get a particular team's information.
 
     :param team_id: the integer id of the team
     """
-    return actions.get_team(team_id).to_dict()
+    fields, include = _fieldset()
+    team = actions.get_team(team_id, **_loading(fields, include))
+
+    return team.to_dict(fields, include)
 
 
-@view(app, '/teams/best', render_json, methods=['GET'])
+@view(app, '/teams/best', render_json, methods=['GET'],
+      version=lambda: _competition_version())
+@cached(
+    response_cache,
+    args=('num_teams', 'competition'),
+    tags=lambda: [('competition', _competition_id())],
+    version=lambda: _competition_version()
+)
 def get_best_teams():
     """Get a listing of the top teams."""
-    teams = actions.get_teams()
+    # Only the teams' running totals are needed, not their members.
+    teams = actions.get_teams(_competition_id(), eager=False)
     team_data = []
     for t in teams:
-        efforts = []
-        for u in t.members:
-            efforts.extend([e.duration for e in t.members[u].efforts])
-
-        if efforts:
-            effort = int(reduce(lambda x, y: x + y, efforts).total_seconds())
-        else:
-            effort = 0
-
-        team_data.append({'id': t.id, 'name': t.name, 'effort': effort})
+        team_data.append(
+            {'id': t.id, 'name': t.name, 'effort': int(t.time_worked())}
+        )
 
     num_teams = int(request.args.get('num_teams', len(team_data)))
 
@@ -171,6 +247,219 @@ def get_best_teams():
     }
 
 
+@view(app, '/leaderboard/stream', None, methods=['GET'])
+def get_leaderboard_stream():
+    """Stream changes to the leaderboard, scoped by the `competition` query
+    argument, as server-sent events. A client reconnecting with the
+    `Last-Event-ID` header gets the events it missed, or a `reset` event if
+    they're no longer kept.
+
+    A stream holds its request open for as long as the client stays, so it
+    needs a worker that serves other requests meanwhile, such as gunicorn's
+    gevent workers in the Procfile; a sync worker would be tied up by each
+    client and killed by its timeout.
+    """
+    subscription = actions.subscribe(
+        request.args.get('competition', None, type=int),
+        request.headers.get('Last-Event-ID')
+    )
+
+    return app.response_class(
+        subscription.events(),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@view(app, '/competitions', render_json, methods=['POST'])
+@endpoint
+def add_competition():
+    """Add a new competition."""
+    competition_id = actions.add_competition(request.json['name'])
+
+    response = _success_response()
+    response['id'] = competition_id
+
+    return response
+
+
+@view(app, '/competitions', render_json, methods=['GET'])
+@endpoint
+def get_competitions():
+    """Get a listing of all the competitions that haven't been archived."""
+    return {
+        'competitions': [
+            dict(c.to_dict(), id=c.id) for c in actions.get_competitions()
+        ],
+    }
+
+
+@view(app, '/competitions/<int:competition_id>/archive', render_json,
+      methods=['POST'])
+@endpoint
+def archive_competition(competition_id):
+    """Archive a competition, after which it can no longer be written to.
+
+    :param competition_id: the integer id of the competition
+    """
+    actions.archive_competition(competition_id)
+
+    return _success_response()
+
+
+@view(app, '/cache/stats', render_json, methods=['GET'])
+@endpoint
+def get_cache_stats():
+    """Get the caches' hit, miss and eviction counters."""
+    return {
+        'responses': response_cache.stats(),
+        'users': user_cache.stats(),
+        'compression': compression_cache.stats(),
+        'idempotency': idempotency_cache.stats(),
+        'invalidation': bus.stats(),
+    }
+
+
+@view(app, '/metrics', None, methods=['GET'])
+def get_metrics():
+    """Get the request, database, cache and pool metrics of every worker, in
+    the Prometheus text format.
+    """
+    return app.response_class(registry.render(), content_type=CONTENT_TYPE)
+
+
+@view(app, '/admin/profiles', render_json, methods=['GET'])
+@admin(admin_token)
+def get_profiles():
+    """List this worker's kept request profiles, newest first."""
+    if profile_store is None:
+        abort(404)
+
+    return {'profiles': profile_store.list()}
+
+
+@view(app, '/admin/profiles/<profile_id>', render_json, methods=['GET'])
+@admin(admin_token)
+def get_profile(profile_id):
+    """Get a kept request profile, with the functions it spent the most
+    cumulative time in.
+
+    :param profile_id: the profile's id
+    """
+    profile = profile_store.get(profile_id) if profile_store else None
+    if profile is None:
+        abort(404)
+
+    return profile
+
+
+def _competition_id():
+    """The integer id of the competition the current request is scoped to,
+    taken from the JSON body or the `competition` query argument, or `None` if
+    the request isn't scoped to a competition.
+    """
+    if request.json and request.json.get('competition') is not None:
+        return int(request.json['competition'])
+
+    return request.args.get('competition', None, type=int)
+
+
+def _fieldset():
+    """The fields and relations the current request asks for with its `fields`
+    and `include` query arguments, each a comma-separated list of names, as a
+    pair of sets. Either is `None` if the request doesn't limit it, except
+    that without `include`, the relations are those named in `fields`.
+    """
+    fields = _names_arg('fields')
+    include = _names_arg('include')
+    if include is None and fields is not None:
+        include = fields & RELATIONS
+    if include is not None and not include <= RELATIONS:
+        raise ValidationError(
+            'unknown relation %s' % ', '.join(sorted(include - RELATIONS))
+        )
+
+    return fields, include
+
+
+def _names_arg(name):
+    """The set of names in a comma-separated query argument, or `None` if the
+    argument isn't given. Names other than :data:`FIELDS` aren't allowed.
+
+    :param name: the name of the query argument
+    """
+    value = request.args.get(name)
+    if value is None:
+        return None
+
+    names = frozenset(n.strip() for n in value.split(',') if n.strip())
+    if not names <= FIELDS:
+        raise ValidationError(
+            'unknown field %s' % ', '.join(sorted(names - FIELDS))
+        )
+
+    return names
+
+
+def _ids_arg():
+    """The list of integer ids in the current request's `ids` query argument,
+    a comma-separated list of at most :data:`MAX_IDS` ids.
+    """
+    value = request.args.get('ids', '')
+    try:
+        ids = [int(i) for i in value.split(',') if i.strip()]
+    except ValueError:
+        raise ValidationError('ids must be integers')
+    if not ids:
+        raise ValidationError('ids are required')
+    if len(ids) > MAX_IDS:
+        raise ValidationError('at most %d ids may be requested' % MAX_IDS)
+
+    return ids
+
+
+def _multi_get(ids, aggregates, fields, include):
+    """The listing for a multi-get: each aggregate's dictionary, with its id,
+    in the order of the requested ids, and a missing marker for each id that
+    has no aggregate.
+
+    :param ids: the requested ids
+    :param aggregates: the aggregates or `None`s, in the order of `ids`
+    :param fields: the set of fields, or `None` for all
+    :param include: the set of relations, or `None` for all
+    """
+    return [
+        {'id': i, 'missing': True} if a is None
+        else dict(a.to_dict(fields, include), id=i)
+        for i, a in zip(ids, aggregates)
+    ]
+
+
+def _loading(fields, include):
+    """The options for loading just what's needed to serialize an aggregate
+    with the given fields and relations, for actions that take them.
+
+    :param fields: the set of fields, or `None` for all
+    :param include: the set of relations, or `None` for all
+    """
+    return {
+        'members': include is None or 'members' in include,
+        'efforts': include is None or 'efforts' in include,
+        'totals': fields is not None and 'effort' in fields,
+    }
+
+
+def _competition_version():
+    """The version of the data in the competition the current request is
+    scoped to, or of all the data if it isn't scoped to one.
+    """
+    competition_id = _competition_id()
+    if competition_id is None:
+        return versions.get(GLOBAL)
+
+    return versions.get(('competition', competition_id))
+
+
 def _error_response(message='error'):
     """Default error response.
 
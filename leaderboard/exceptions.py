@@ -27,6 +27,12 @@ class ConstraintError(HHException):
     pass
 
 
+class ConsistencyError(HHException):
+    """Error for when an aggregate's running totals disagree with its contents.
+    """
+    pass
+
+
 class MissingFieldError(HHException):
     """Error for when domain objects initiated with missing field."""
 
@@ -39,3 +45,22 @@ class MissingFieldError(HHException):
 class ValidationError(HHException):
     """Error for when a supplied domain field value fails to validate."""
     pass
+
+
+class IdempotencyError(HHException):
+    """Error for when an idempotency key is reused for a different request, or
+    retried while its first request is still in progress.
+    """
+    pass
+
+
+class PoolTimeoutError(HHException):
+    """Error for when no database connection comes free in time."""
+    pass
+
+
+class QueueFullError(HHException):
+    """Error for when a write can't be queued because the queue is full or
+    closing.
+    """
+    pass
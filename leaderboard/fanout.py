@@ -0,0 +1,101 @@
+"""
+    leaderboard.fanout
+    ===================
+
+    Implements :class:`FanOut`, which runs independent database loads
+    concurrently, each on a pooled connection of its own.
+
+    :author: Michael Browning
+"""
+
+from functools import partial
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import os
+
+from .pool import ConnectionPool
+
+
+class FanOut(object):
+    """A bounded pool of threads and database connections for running loads
+    that don't depend on each other at the same time, rather than one after
+    another on a single connection.
+
+    :meth:`map` calls a load with a connection and each of a list of items,
+    on at most `parallelism` threads at once, and returns the results in the
+    order of the items. Each thread takes a connection from a
+    :class:`leaderboard.pool.ConnectionPool` of the same size for each load
+    and returns it afterwards. Loads must commit or roll back what they do,
+    as :func:`leaderboard.persistence.opens_cursor` does.
+
+    The threads are only started when first needed, and again after a fork,
+    since they can't be shared with the parent process.
+
+    :param connect: a callable returning a new database connection
+    :param parallelism: the most loads run at once
+    """
+
+    def __init__(self, connect, parallelism=4):
+        self.parallelism = parallelism
+        self.connections = ConnectionPool(connect, size=parallelism)
+        self._threads = None
+        self._lock = Lock()
+        self._pid = None
+        self._loads = 0
+
+    def map(self, load, items):
+        """Call `load` with a connection and each item, concurrently, and
+        return the list of the results in the order of the items. If any
+        load raises, the first exception is raised here once the rest are
+        done.
+
+        :param load: a callable taking a connection and an item
+        :param items: a sequence of items
+        """
+        return self._pool().map(partial(self._run, load), items, chunksize=1)
+
+    def close(self):
+        """Stop the threads and close every connection. They're started and
+        opened again if the fan-out is used afterwards.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, None
+        if threads is not None:
+            threads.close()
+            threads.join()
+        self.connections.close()
+
+    def stats(self):
+        """Return a dictionary of the fan-out's counters, for monitoring."""
+        with self._lock:
+            loads = self._loads
+
+        return dict(
+            self.connections.stats(), parallelism=self.parallelism, loads=loads
+        )
+
+    def _pool(self):
+        """This process's pool of threads, created if need be."""
+        with self._lock:
+            if self._pid != os.getpid():
+                # The parent's threads didn't survive the fork.
+                self._pid = os.getpid()
+                self._threads = None
+            if self._threads is None:
+                self._threads = ThreadPool(self.parallelism)
+
+            return self._threads
+
+    def _run(self, load, item):
+        """Run a load on a connection from the pool.
+
+        :param load: a callable taking a connection and an item
+        :param item: the item
+        """
+        with self._lock:
+            self._loads += 1
+        connection = self.connections.get()
+        try:
+            return load(connection, item)
+        finally:
+            self.connections.put(connection)
@@ -8,28 +8,261 @@
 """
 
 from functools import wraps
+import hashlib
+import hmac
 import json
+import time
 
 import flask
 from werkzeug import BaseResponse
+from werkzeug.exceptions import HTTPException
 
+from . import binary, registry
 from .exceptions import ValidationError
 
 DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
+# Streamed responses are written in chunks of about this many bytes.
+STREAM_CHUNK_SIZE = 8192
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+ADMIN_HEADER = 'X-Admin-Token'
+
 
 def render_json(obj):
-    """Returns a JSON-serialized representation of an object.
+    """Returns a JSON-serialized representation of an object, or its
+    :mod:`leaderboard.binary` encoding if the request's `Accept` header
+    prefers that.
 
     :param obj: the object to serialize as JSON
     """
-    try:
-        return flask.jsonify(obj)
-    except ValueError as e:
-        # It's a list, which flask won't jsonify.
-        response = flask.make_response(json.dumps(obj))
-        response.headers['Content-Type'] = 'application/json'
-        return response
+    if _wants_binary():
+        response = flask.make_response(binary.encode(obj))
+        response.headers['Content-Type'] = binary.MIMETYPE
+    else:
+        try:
+            response = flask.jsonify(obj)
+        except ValueError as e:
+            # It's a list, which flask won't jsonify.
+            response = flask.make_response(json.dumps(obj))
+            response.headers['Content-Type'] = 'application/json'
+
+    # Both encodings carry the same data, but they're different
+    # representations, which caches must keep apart.
+    response.headers['Vary'] = 'Accept'
+
+    return response
+
+
+def _wants_binary():
+    """Return `True` if the current request prefers the binary encoding to
+    JSON. JSON wins ties, so clients that accept anything get JSON.
+    """
+    return flask.request.accept_mimetypes.best_match(
+        ['application/json', binary.MIMETYPE]
+    ) == binary.MIMETYPE
+
+
+def render_json_stream(obj):
+    """Returns a JSON-serialized representation of a dictionary, streamed as
+    it's serialized. Values that are iterators, such as those returned by
+    :meth:`leaderboard.persistence.repository.Repository.iter_all`, are
+    written out as arrays one item at a time, using the item's `to_dict` if
+    it has one, so that neither the items nor their serialized forms are all
+    held at once, and the first bytes go out before the last item is loaded.
+
+    Dictionaries without any iterators, like error responses, are rendered
+    by :func:`render_json`, as is everything for clients asking for the
+    binary encoding, whose key table has to be known up front.
+
+    :param obj: the dictionary to serialize as JSON
+    """
+    if not any(_is_stream(v) for v in obj.values()):
+        return render_json(obj)
+    if _wants_binary():
+        return render_json(dict(
+            (k, [_to_dict(i) for i in v] if _is_stream(v) else v)
+            for k, v in obj.iteritems()
+        ))
+
+    response = flask.Response(
+        _buffer(_iter_json(obj), STREAM_CHUNK_SIZE),
+        mimetype='application/json'
+    )
+    response.headers['Vary'] = 'Accept'
+
+    return response
+
+
+def _is_stream(value):
+    """Return `True` if a value is an iterator to stream as a JSON array.
+
+    :param value: the value
+    """
+    return hasattr(value, 'next')
+
+
+def _iter_json(obj):
+    """Yield the JSON serialization of a dictionary in pieces.
+
+    :param obj: the dictionary, whose values may be iterators
+    """
+    yield '{'
+    for i, (key, value) in enumerate(obj.iteritems()):
+        yield '%s%s: ' % (', ' if i else '', json.dumps(key))
+        if not _is_stream(value):
+            yield json.dumps(value)
+            continue
+
+        yield '['
+        for j, item in enumerate(value):
+            yield '%s%s' % (', ' if j else '', json.dumps(_to_dict(item)))
+        yield ']'
+    yield '}'
+
+
+def _to_dict(item):
+    """Return an item's `to_dict`, if it has one, or else the item.
+
+    :param item: the item
+    """
+    return item.to_dict() if hasattr(item, 'to_dict') else item
+
+
+def _buffer(pieces, size):
+    """Join an iterable of strings into chunks of at least a given size,
+    except for the last, so that the server isn't asked to write each piece
+    separately.
+
+    :param pieces: an iterable of strings
+    :param size: the minimum chunk size in bytes
+    """
+    chunk = []
+    length = 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def cached(cache, args=(), tags=None, version=None):
+    """Returns a decorator that caches the output of a view function in the
+    supplied cache, keyed by the function, its route arguments, the values
+    of the named query arguments and, if a `version` is supplied, the ETag
+    of the data's version before the function is called. Error responses
+    aren't cached.
+
+    Keying by the version means output read just before a write, but stored
+    after it invalidated the cache, is kept under the version it was read
+    at, which no later request asks for.
+
+    :param cache: a :class:`leaderboard.cache.LRUCache`
+    :param args: the names of the query arguments the output depends on
+    :param tags: a callable returning the tags to store the output under, so
+                 that writes can invalidate it
+    :param version: a callable returning the
+                    :class:`leaderboard.versions.Version` of the output's data
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*fn_args, **fn_kwargs):
+            key = (
+                fn.__name__,
+                tuple(sorted(fn_kwargs.items())),
+                tuple(flask.request.args.get(arg) for arg in args),
+                version().etag if version else None,
+            )
+            result = cache.get(key)
+            if result is None:
+                result = fn(*fn_args, **fn_kwargs)
+                if not (isinstance(result, dict) and result.get('error')):
+                    cache.set(key, result, tags() if tags else ())
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def idempotent(store):
+    """Returns a decorator that makes a view function safe to retry, for
+    requests with an `Idempotency-Key` header. The output for the first
+    request with a key is kept in the supplied store, and later requests with
+    the key get it back without the function being called. Failed requests,
+    which raise or return an error response, aren't kept, so that they may be
+    retried.
+
+    Reusing a key for a request with a different method, path, query string
+    or body, or while its first request is in progress, raises an
+    :class:`leaderboard.exceptions.IdempotencyError`.
+
+    The write and the stored response are committed separately, so a process
+    that dies in between leaves the key reserved but unanswered. Once its
+    lease expires, a retry with the key makes the write again.
+
+    :param store: a :class:`leaderboard.idempotency.IdempotencyStore`
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*fn_args, **fn_kwargs):
+            key = flask.request.headers.get(IDEMPOTENCY_HEADER)
+            if not key:
+                return fn(*fn_args, **fn_kwargs)
+
+            request = flask.request
+            fingerprint = hashlib.sha1('%s %s?%s\n%s' % (
+                request.method, request.path, request.query_string,
+                request.data
+            )).hexdigest()
+            result = store.begin(key, fingerprint)
+            if result is not None:
+                return result
+
+            try:
+                result = fn(*fn_args, **fn_kwargs)
+            except Exception:
+                store.abandon(key)
+                raise
+            if isinstance(result, dict) and result.get('error'):
+                store.abandon(key)
+            else:
+                store.finish(key, fingerprint, result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def admin(token):
+    """Returns a decorator that restricts a view function to requests whose
+    `X-Admin-Token` header carries the admin token. Other requests are
+    refused with a `403 Forbidden`, and if there's no admin token, every
+    request is answered with a `404 Not Found`, as if there were no such view.
+
+    :param token: the admin token, or `None`
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*fn_args, **fn_kwargs):
+            if token is None:
+                flask.abort(404)
+            given = flask.request.headers.get(ADMIN_HEADER, '')
+            if not hmac.compare_digest(given, token):
+                flask.abort(403)
+
+            return fn(*fn_args, **fn_kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 def view(app, url, renderer, *args, **kwargs):
@@ -38,12 +271,26 @@ def view(app, url, renderer, *args, **kwargs):
     i.e., you can apply multiple routes to a callable with :func:`view` and they
     will each apply to the callable's original output.
 
+    If `version` is supplied, it's called with the route's arguments and
+    must return the :class:`leaderboard.versions.Version` of the data the view
+    shows. Responses then carry `ETag` and `Last-Modified` headers, and
+    requests whose `If-None-Match` names the current ETag get a
+    `304 Not Modified` without the wrapped function being called at all.
+
+    Each request to the route is counted and timed in
+    :data:`leaderboard.registry`, along with the time it spends in database
+    transactions, by its route and method. Responses streamed from a
+    generator are timed until they start, not until they've been sent.
+
     :param app: a :class:`flask.Flask` app instance
     :param url: the url to route to
     :param renderer: a callable that returns the rendered output; if None,
                      returns the wrapped function's original output
+    :param version: an optional callable returning the version of the view's
+                    data
     """
     defaults = kwargs.pop('defaults', {})
+    version = kwargs.pop('version', None)
     route_id = object()
     defaults['_route_id'] = route_id
 
@@ -51,10 +298,28 @@ def view(app, url, renderer, *args, **kwargs):
         @app.route(url, defaults=defaults, *args, **kwargs)
         @wraps(fn)
         def wrapper(*args, **kwargs):
+            # Outputs passed through to another route are counted there.
+            if kwargs.get('_route_id') is not route_id:
+                return respond(*args, **kwargs)
+
+            return _measured(url, respond, *args, **kwargs)
+
+        def respond(*args, **kwargs):
             this_route = kwargs.get('_route_id')
             if not getattr(fn, 'is_route', False):
                 del kwargs['_route_id']
 
+            current = None
+            if (
+                version is not None and this_route is route_id and
+                flask.request.method in ('GET', 'HEAD')
+            ):
+                current = version(**_route_kwargs(kwargs))
+                if _not_modified(current):
+                    response = app.response_class(status=304)
+                    _set_version_headers(response, current)
+                    return response
+
             result = fn(*args, **kwargs)
 
             # This lets us pass the output of a callable that's already been
@@ -67,9 +332,105 @@ def view(app, url, renderer, *args, **kwargs):
             if renderer is None:
                 return result
 
-            return renderer(result)
+            response = renderer(result)
+            # Errors may be transient, so they mustn't be revalidated as if
+            # they were the current data.
+            if current is not None and not (
+                isinstance(result, dict) and result.get('error')
+            ):
+                _set_version_headers(response, current)
+
+            return response
 
         wrapper.is_route = True
         return wrapper
 
     return decorator
+
+
+def _measured(route, respond, *args, **kwargs):
+    """Respond to a request, counting it and recording how long it took in
+    :data:`leaderboard.registry`. Requests that raise are counted as errors,
+    unless they're aborted with a client error status.
+
+    :param route: the route's URL rule
+    :param respond: the callable producing the response
+    """
+    method = flask.request.method
+    status = 500
+    started = time.time()
+    registry.begin()
+    try:
+        response = respond(*args, **kwargs)
+        status = getattr(response, 'status_code', 200)
+        return response
+    except HTTPException as e:
+        status = e.code
+        raise
+    finally:
+        duration = time.time() - started
+        spent = registry.end()
+        registry.inc(
+            'leaderboard_requests_total',
+            route=route, method=method, status=status
+        )
+        if status >= 500:
+            registry.inc(
+                'leaderboard_request_errors_total',
+                route=route, method=method, handled='false'
+            )
+        registry.observe(
+            'leaderboard_request_duration_seconds', duration,
+            route=route, method=method
+        )
+        registry.observe(
+            'leaderboard_request_db_seconds', spent.get('db', 0.0),
+            route=route, method=method
+        )
+
+
+def _route_kwargs(kwargs):
+    """Return a view's keyword arguments without the routing bookkeeping.
+
+    :param kwargs: the keyword arguments a view was called with
+    """
+    return dict((k, v) for k, v in kwargs.items() if k != '_route_id')
+
+
+def _not_modified(version):
+    """Return `True` if the current request is conditional on a version of the
+    data that's still current.
+
+    Only `If-None-Match` is honoured. `If-Modified-Since` is ignored: its
+    whole seconds can't tell apart two writes in the same second, and a date
+    from another process carries no token to show whose it is, so it could
+    answer `304` for data that has changed.
+
+    :param version: the current :class:`leaderboard.versions.Version`
+    """
+    # Compressed responses carry weak forms of the ETags, and If-None-Match
+    # compares tags weakly.
+    return flask.request.if_none_match.contains_weak(_etag(version))
+
+
+def _etag(version):
+    """Return the ETag of the representation of a version of the data that the
+    current request negotiates. The JSON and binary encodings are different
+    representations, so each needs its own strong ETag.
+
+    :param version: the :class:`leaderboard.versions.Version` of the data
+    """
+    if _wants_binary():
+        return '%s-%s' % (version.etag, binary.ETAG_SUFFIX)
+
+    return version.etag
+
+
+def _set_version_headers(response, version):
+    """Set the validator headers for a version of the data on a response.
+
+    :param response: the response object
+    :param version: the :class:`leaderboard.versions.Version` it shows
+    """
+    response.set_etag(_etag(version))
+    response.last_modified = version.modified
@@ -0,0 +1,102 @@
+"""
+    leaderboard.idempotency
+    ========================
+
+    Implements :class:`IdempotencyStore`, which remembers the responses to
+    requests made with an idempotency key, so that retries of them can be
+    answered without being carried out again.
+
+    :author: Michael Browning
+"""
+
+from itertools import count
+
+from .exceptions import IdempotencyError
+from .persistence import IdempotencyRepository
+
+
+class IdempotencyStore(object):
+    """Keeps the response to each idempotency key's request, in an in-process
+    cache in front of a database table that every process shares.
+
+    A request calls :meth:`begin` before doing anything. If the key has
+    already been answered, the stored response comes back and the request
+    should return it. Otherwise the key is reserved for the request, which
+    then calls :meth:`finish` with its response, or :meth:`abandon` if it
+    failed so that it may be retried.
+
+    A key whose request never finishes, because its process died, is given
+    up when the lease runs out. If the request's write was committed first,
+    the retry that then reserves the key makes it again.
+
+    :param cache: a :class:`leaderboard.cache.LRUCache`, which should expire
+                  entries no later than `ttl`
+    :param ttl: how long keys are kept, in seconds
+    :param lease: how long a request may hold a key unanswered, in seconds
+    :param purge_every: how many reservations are made between purges of
+                        expired keys from the table
+    """
+
+    def __init__(self, cache, ttl=86400, lease=60, purge_every=1000):
+        self.cache = cache
+        self.ttl = ttl
+        self.lease = lease
+        self.purge_every = purge_every
+        self._reservations = count(1)
+
+    def begin(self, key, fingerprint):
+        """Return the response to a key's request, or reserve the key and
+        return `None` if it hasn't been answered. Raises an
+        :class:`IdempotencyError` if the key was used for a different request,
+        or its request is still in progress.
+
+        :param key: the idempotency key
+        :param fingerprint: a digest identifying the request
+        """
+        answered = self.cache.get(key)
+        if answered is None:
+            answered = self._repository().get(key)
+        if answered is not None:
+            used_for, response = answered
+            if used_for != fingerprint:
+                raise IdempotencyError(
+                    'Idempotency-Key was used for a different request'
+                )
+            if response is None:
+                raise IdempotencyError(
+                    'a request with this Idempotency-Key is in progress'
+                )
+            self.cache.set(key, answered)
+
+            return dict(response)
+
+        repository = self._repository()
+        if not repository.reserve(key, fingerprint):
+            raise IdempotencyError(
+                'a request with this Idempotency-Key is in progress'
+            )
+        if next(self._reservations) % self.purge_every == 0:
+            repository.purge()
+
+        return None
+
+    def finish(self, key, fingerprint, response):
+        """Store the response to a key's request.
+
+        :param key: the idempotency key
+        :param fingerprint: a digest identifying the request
+        :param response: the JSON-serializable response
+        """
+        self._repository().complete(key, response)
+        self.cache.set(key, (fingerprint, dict(response)))
+
+    def abandon(self, key):
+        """Give up a key whose request failed, so that it may be retried.
+
+        :param key: the idempotency key
+        """
+        self._repository().release(key)
+
+    def _repository(self):
+        """A repository on the app's current connection."""
+        return IdempotencyRepository(ttl=self.ttl, lease=self.lease)
@@ -0,0 +1,366 @@
+"""
+    leaderboard.ingest
+    ===================
+
+    Implements :class:`WriteBehindQueue`, which acknowledges writes as soon as
+    they're journaled to local disk and makes them in the database in batches.
+
+    :author: Michael Browning
+"""
+
+from binascii import hexlify
+from collections import deque
+from itertools import islice
+from threading import Thread, Condition, Event
+import fcntl
+import glob
+import json
+import logging
+import os
+import time
+
+import psycopg2
+
+from .exceptions import ConstraintError, QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue(object):
+    """A durable queue of entries that are written to the database by a
+    background thread, many to a transaction.
+
+    :meth:`submit` appends each entry to a journal file in `directory`, syncs
+    it to disk and returns, so that a request can be acknowledged without
+    waiting on the database. The writer thread started with :meth:`start`
+    takes up to `batch_size` entries at a time off the queue and passes them
+    to its `write` callable with a connection of its own, so a burst of
+    entries is written in a few transactions rather than one each. A
+    checkpoint file next to the journal records how much of it has been
+    written, and the journal is emptied whenever the queue is.
+
+    Each process has its own journal, which it holds a lock on. When a queue
+    starts, it takes over the journals of processes that died with entries
+    left unwritten, so nothing acknowledged is lost; `write` must therefore
+    tolerate being given an entry it has already written.
+
+    Once `max_pending` entries are waiting, :meth:`submit` waits up to `block`
+    seconds for the writer to catch up and then raises a
+    :class:`QueueFullError`. :meth:`close` writes everything still queued
+    before returning.
+
+    A batch that fails is retried, with backoff, unless it fails with one of
+    the `permanent` errors, in which case its entries are retried one at a
+    time and those that still fail are set aside in a `.rejected` file.
+    Entries known to conflict with one still waiting can be refused
+    beforehand, by passing :meth:`submit` a `check`.
+
+    :param directory: the directory holding the journals
+    :param connect: a callable returning a new database connection
+    :param batch_size: the most entries written in one transaction
+    :param max_pending: the most entries that may wait to be written
+    :param block: how long :meth:`submit` waits for room, in seconds
+    :param sync: whether to sync each entry to disk before acknowledging it
+    :param max_backoff: the longest wait between retries of a failed batch
+    :param permanent: the exceptions that retrying a batch can't fix
+    """
+
+    def __init__(self, directory, connect, batch_size=500, max_pending=10000,
+                 block=0.5, sync=True, max_backoff=30.0,
+                 permanent=(psycopg2.IntegrityError, psycopg2.DataError,
+                            ConstraintError)):
+        self.directory = directory
+        self.connect = connect
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.block = block
+        self.sync = sync
+        self.max_backoff = max_backoff
+        self.permanent = permanent
+        self.path = None
+        self._write = None
+        self._journal = None
+        self._offset = 0
+        self._pending = deque()
+        self._cond = Condition()
+        self._closing = False
+        self._stopped = Event()
+        self._thread = None
+        self._connection = None
+        self._written = 0
+        self._batches = 0
+        self._failures = 0
+        self._rejected = 0
+
+    @property
+    def running(self):
+        """Whether the writer thread is running and accepting entries."""
+        return (
+            self._thread is not None and self._thread.is_alive() and
+            not self._closing
+        )
+
+    def start(self, write):
+        """Open this process's journal, take over any left by dead processes
+        and start the writer thread, if it isn't already running.
+
+        :param write: a callable that writes a list of entries in one
+                      transaction, given an open connection and the list
+        """
+        if self.running:
+            return
+
+        self._write = write
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.path = os.path.join(self.directory, 'ingest-%s-%d.journal' % (
+            hexlify(os.urandom(4)), os.getpid()
+        ))
+        self._journal = open(self.path, 'ab')
+        fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._set_checkpoint(0)
+        self._adopt_orphans()
+
+        self._closing = False
+        self._stopped.clear()
+        self._thread = Thread(target=self._run, name='write-behind')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, entry, check=None):
+        """Journal an entry to be written. Once this returns, the entry will
+        be written even if this process dies first.
+
+        :param entry: a JSON-serializable dictionary
+        :param check: if supplied, a callable given each entry still waiting
+                      to be written, with the queue locked, before `entry` is
+                      journaled; it may raise to refuse `entry`
+        """
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self._cond:
+            deadline = time.time() + self.block
+            while len(self._pending) >= self.max_pending and not self._closing:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise QueueFullError('too many entries are waiting')
+                self._cond.wait(remaining)
+            if self._closing:
+                raise QueueFullError('entries are no longer accepted')
+            if check is not None:
+                for waiting, _ in self._pending:
+                    check(waiting)
+
+            self._append([line])
+            self._pending.append((entry, self._offset))
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every entry submitted so far has been written. Return
+        `False` if `timeout` seconds pass first.
+
+        :param timeout: the longest to wait, in seconds, or `None` for as long
+                        as it takes
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending and self.running:
+                remaining = 1.0
+                if deadline is not None:
+                    remaining = min(remaining, deadline - time.time())
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+
+            return not self._pending
+
+    def close(self, timeout=None):
+        """Stop accepting entries, write everything still queued and stop the
+        writer thread. Entries that can't be written before `timeout` seconds
+        pass are left in the journal for the next queue to take over.
+
+        :param timeout: the longest to wait, in seconds, or `None` for as long
+                        as it takes
+        """
+        if self._thread is None:
+            return
+
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+        self._journal.close()
+        if not self._pending:
+            for name in (self.path + '.pos', self.path):
+                os.remove(name)
+        if self._connection is not None:
+            self._close_connection()
+
+    def stats(self):
+        """Return a dictionary of the queue's counters, for monitoring."""
+        with self._cond:
+            return {
+                'pending': len(self._pending),
+                'written': self._written,
+                'batches': self._batches,
+                'failures': self._failures,
+                'rejected': self._rejected,
+                'journal_bytes': self._offset,
+            }
+
+    def _run(self):
+        """Write batches of entries until closed and drained."""
+        backoff = 1.0
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    # Waiting without a timeout would block signals.
+                    self._cond.wait(1.0)
+                if not self._pending or self._stopped.is_set():
+                    return
+                batch = list(islice(self._pending, self.batch_size))
+
+            try:
+                try:
+                    self._write_batch([entry for entry, _ in batch])
+                except self.permanent:
+                    self._write_singly(batch)
+                    continue
+            except Exception:
+                logger.exception(
+                    'writing %d entries failed; retrying in %ss',
+                    len(batch), backoff
+                )
+                with self._cond:
+                    self._failures += 1
+                self._stopped.wait(min(backoff, self.max_backoff))
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            backoff = 1.0
+            self._done(batch)
+
+    def _write_batch(self, entries):
+        """Write entries in one transaction, on the writer's connection.
+
+        :param entries: the list of entries
+        """
+        if self._connection is None:
+            self._connection = self.connect()
+        try:
+            self._write(self._connection, entries)
+            self._connection.commit()
+        except Exception:
+            self._close_connection()
+            raise
+
+    def _write_singly(self, batch):
+        """Write the entries of a batch that failed permanently one at a time,
+        setting aside those that fail alone.
+
+        :param batch: a list of entry and journal offset pairs
+        """
+        for entry, offset in batch:
+            try:
+                self._write_batch([entry])
+            except self.permanent:
+                logger.exception('rejected entry %r', entry)
+                with open(self.path + '.rejected', 'ab') as rejected:
+                    rejected.write(json.dumps(entry) + '\n')
+                with self._cond:
+                    self._rejected += 1
+            self._done([(entry, offset)])
+
+    def _done(self, batch):
+        """Take a written batch off the queue and checkpoint the journal past
+        it, emptying the journal if nothing else is waiting.
+
+        :param batch: a list of entry and journal offset pairs
+        """
+        with self._cond:
+            for _ in batch:
+                self._pending.popleft()
+            self._written += len(batch)
+            self._batches += 1
+            if self._pending:
+                self._set_checkpoint(batch[-1][1])
+            else:
+                # The checkpoint is reset first, so a crash in between only
+                # has entries written twice.
+                self._set_checkpoint(0)
+                os.ftruncate(self._journal.fileno(), 0)
+                self._offset = 0
+            self._cond.notify_all()
+
+    def _append(self, lines):
+        """Append lines to the journal and, if syncing, sync them to disk.
+
+        :param lines: a list of newline-terminated lines
+        """
+        data = ''.join(lines)
+        self._journal.write(data)
+        self._journal.flush()
+        if self.sync:
+            os.fsync(self._journal.fileno())
+        self._offset += len(data)
+
+    def _set_checkpoint(self, offset):
+        """Record durably that the journal has been written up to an offset.
+
+        :param offset: the byte offset in the journal
+        """
+        temp = self.path + '.pos.tmp'
+        with open(temp, 'wb') as f:
+            f.write(str(offset))
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.rename(temp, self.path + '.pos')
+
+    def _adopt_orphans(self):
+        """Move the unwritten entries of every journal that no live process
+        holds into this one, and delete those journals.
+        """
+        for path in glob.glob(os.path.join(self.directory, '*.journal')):
+            if path == self.path:
+                continue
+
+            with open(path, 'rb') as orphan:
+                try:
+                    fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    continue
+                try:
+                    with open(path + '.pos', 'rb') as f:
+                        orphan.seek(int(f.read() or 0))
+                except IOError:
+                    pass
+                lines = [l for l in orphan.readlines() if l.endswith('\n')]
+
+                if lines:
+                    logger.warning(
+                        'taking over %d unwritten entries from %s',
+                        len(lines), path
+                    )
+                    self._append(lines)
+                    offset = self._offset - sum(len(l) for l in lines)
+                    for line in lines:
+                        offset += len(line)
+                        self._pending.append((json.loads(line), offset))
+
+                for name in (path + '.pos', path):
+                    try:
+                        os.remove(name)
+                    except OSError:
+                        pass
+
+    def _close_connection(self):
+        """Close the writer's connection, so the next batch opens a new one."""
+        try:
+            self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
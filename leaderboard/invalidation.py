@@ -0,0 +1,210 @@
+"""
+    leaderboard.invalidation
+    =========================
+
+    Implements a cross-process invalidation bus over Postgres LISTEN/NOTIFY,
+    which keeps each worker's in-process caches coherent with writes made by
+    the others.
+
+    :author: Michael Browning
+"""
+
+from binascii import hexlify
+from threading import Thread, Event, Lock
+import json
+import logging
+import os
+import select
+import time
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+CHANNEL = 'leaderboard_invalidation'
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidationBus(object):
+    """Announces writes to every process sharing the database, and delivers
+    other processes' announcements to this process's handlers.
+
+    Writers call :meth:`notify` on the cursor that made the write, so the
+    message is only delivered if and when that transaction commits. A
+    listener thread started with :meth:`start` holds its own connection,
+    calls every handler registered with :meth:`subscribe` for each message
+    from another process, and records the lag between the write and its
+    delivery. If the listener loses its connection it reconnects with
+    backoff, and since messages sent in the meantime are lost, it then calls
+    every handler registered with :meth:`on_reconnect` so that caches can be
+    dropped wholesale.
+
+    :param connect: a callable returning a new database connection
+    :param channel: the notification channel name
+    :param clock: a callable returning the current time in seconds
+    :param poll_interval: how long the listener waits for a message before
+                          checking whether it's been stopped
+    :param max_backoff: the longest wait between reconnection attempts
+    """
+
+    def __init__(self, connect, channel=CHANNEL, clock=time.time,
+                 poll_interval=5.0, max_backoff=30.0):
+        self.connect = connect
+        self.channel = channel
+        self.clock = clock
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.connections = 0
+        self._handlers = []
+        self._reconnect_handlers = []
+        self._origin = None
+        self._pid = None
+        self._thread = None
+        self._stopped = Event()
+        self._lock = Lock()
+        self._received = 0
+        self._lag_total = 0.0
+        self._lag_last = None
+        self._lag_max = None
+
+    @property
+    def origin(self):
+        """A token identifying this process in the messages it sends. It's
+        regenerated after a fork, so that every worker has its own.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._origin = '%s-%d' % (hexlify(os.urandom(4)), self._pid)
+
+        return self._origin
+
+    def subscribe(self, handler):
+        """Register a callable to be called with each message dictionary sent
+        by another process.
+
+        :param handler: the message handler
+        """
+        self._handlers.append(handler)
+
+    def on_reconnect(self, handler):
+        """Register a callable to be called with no arguments whenever the
+        listener has reconnected and so may have missed messages.
+
+        :param handler: the reconnection handler
+        """
+        self._reconnect_handlers.append(handler)
+
+    def notify(self, cursor, kind, **keys):
+        """Announce a write in the cursor's transaction.
+
+        :param cursor: the cursor that made the write
+        :param kind: the kind of entity written, e.g. `'user'`
+        :param keys: the keys identifying the written entity
+        """
+        message = dict(keys, kind=kind, origin=self.origin, time=self.clock())
+        cursor.execute(
+            'SELECT pg_notify(%s, %s)', (self.channel, json.dumps(message))
+        )
+
+    def dispatch(self, payload):
+        """Deliver a notification payload to the handlers, unless it was sent
+        by this process, which has already applied its own writes.
+
+        :param payload: the JSON notification payload
+        """
+        try:
+            message = json.loads(payload)
+            sent = float(message['time'])
+        except (ValueError, KeyError, TypeError):
+            logger.error('malformed invalidation payload %r', payload)
+            return
+
+        if message.get('origin') == self.origin:
+            return
+
+        lag = max(self.clock() - sent, 0.0)
+        with self._lock:
+            self._received += 1
+            self._lag_total += lag
+            self._lag_last = lag
+            if self._lag_max is None or lag > self._lag_max:
+                self._lag_max = lag
+
+        for handler in self._handlers:
+            try:
+                handler(message)
+            except Exception:
+                logger.exception('invalidation handler failed on %r', message)
+
+    def start(self):
+        """Start the listener thread, if it isn't already running in this
+        process.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopped.clear()
+        self._thread = Thread(target=self._listen, name='invalidation-bus')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the listener thread."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(self.poll_interval)
+
+    def stats(self):
+        """Return a dictionary of the listener's counters and the lag between
+        writes and their invalidations, in seconds, for monitoring.
+        """
+        with self._lock:
+            return {
+                'connections': self.connections,
+                'received': self._received,
+                'lag_last': self._lag_last,
+                'lag_max': self._lag_max,
+                'lag_mean': (
+                    self._lag_total / self._received if self._received
+                    else None
+                ),
+            }
+
+    def _listen(self):
+        """Listen for notifications until stopped, reconnecting on failure."""
+        backoff = 1.0
+        while not self._stopped.is_set():
+            connection = None
+            try:
+                connection = self.connect()
+                connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cursor = connection.cursor()
+                cursor.execute('LISTEN %s' % self.channel)
+
+                self.connections += 1
+                if self.connections > 1:
+                    for handler in self._reconnect_handlers:
+                        handler()
+                backoff = 1.0
+
+                while not self._stopped.is_set():
+                    readable, _, _ = select.select(
+                        [connection], [], [], self.poll_interval
+                    )
+                    if not readable:
+                        continue
+
+                    connection.poll()
+                    while connection.notifies:
+                        self.dispatch(connection.notifies.pop(0).payload)
+            except Exception:
+                logger.exception(
+                    'invalidation listener failed; reconnecting in %ss', backoff
+                )
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
@@ -0,0 +1,404 @@
+"""
+    leaderboard.metrics
+    ====================
+
+    Implements :class:`Registry`, which counts and times requests, samples
+    the app's other counters, and renders them all in the Prometheus text
+    format, summed over the worker processes serving the app.
+
+    :author: Michael Browning
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock, Thread, Event, local
+import atexit
+import errno
+import json
+import os
+
+# The upper bounds of the histograms' buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The content type of the Prometheus text format.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+RATIO = 'ratio'
+
+
+class Registry(object):
+    """Keeps this process's metrics: counters and histograms recorded as
+    requests are served, and samples taken from callables registered with
+    :meth:`collect`, like the caches' and pools' `stats`, whenever the
+    metrics are rendered or written.
+
+    Each worker of a server like gunicorn has a registry of its own, so that
+    recording a metric only takes a lock that's never held for long. If a
+    `directory` is given, every `interval` seconds each worker writes its
+    metrics there, in a file named for its pid, and :meth:`render` sums
+    those of every worker, so that whichever one is scraped answers for all
+    of them. Counters and histograms of workers that have exited are still
+    counted, as their requests still happened, but their gauges are not.
+    Files of exited workers are never removed, so the directory should be
+    emptied when the app is deployed.
+
+    :param directory: a directory the workers share, or `None` to only
+                      render this process's metrics
+    :param interval: how often each worker writes its metrics, in seconds
+    """
+
+    def __init__(self, directory=None, interval=5.0):
+        self.directory = directory
+        self.interval = interval
+        self._metrics = OrderedDict()
+        self._collectors = []
+        self._values = {}
+        self._pid = None
+        self._lock = Lock()
+        self._timings = local()
+        self._stopped = Event()
+        self._thread = None
+
+    def counter(self, name, help):
+        """Declare a counter, which only goes up.
+
+        :param name: the metric name, ending in `_total`
+        :param help: a description of the metric
+        """
+        self._metrics[name] = (COUNTER, help, None)
+
+    def gauge(self, name, help):
+        """Declare a gauge, which goes up and down.
+
+        :param name: the metric name
+        :param help: a description of the metric
+        """
+        self._metrics[name] = (GAUGE, help, None)
+
+    def histogram(self, name, help, buckets=BUCKETS):
+        """Declare a histogram, which counts observations in buckets.
+
+        :param name: the metric name
+        :param help: a description of the metric
+        :param buckets: the buckets' upper bounds, in ascending order
+        """
+        self._metrics[name] = (HISTOGRAM, help, tuple(buckets))
+
+    def ratio(self, name, help, numerator, denominators):
+        """Declare a gauge that's the ratio of other metrics, for each set of
+        labels. It's worked out once every worker's metrics are summed, which
+        a ratio can't be.
+
+        :param name: the metric name
+        :param help: a description of the metric
+        :param numerator: the name of the metric to divide
+        :param denominators: the names of the metrics whose sum to divide by
+        """
+        self._metrics[name] = (RATIO, help, (numerator, tuple(denominators)))
+
+    def collect(self, collector):
+        """Register a callable returning samples of declared counters and
+        gauges, as `(name, labels, value)` tuples where `labels` is a
+        dictionary.
+
+        :param collector: the callable
+        """
+        self._collectors.append(collector)
+
+    def inc(self, name, amount=1, **labels):
+        """Add to a counter.
+
+        :param name: the counter's name
+        :param amount: how much to add
+        :param labels: the sample's labels
+        """
+        key = _labels(labels)
+        with self._lock:
+            values = self._own(name)
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Count an observation in a histogram.
+
+        :param name: the histogram's name
+        :param value: the observed value
+        :param labels: the sample's labels
+        """
+        buckets = self._metrics[name][2]
+        key = _labels(labels)
+        with self._lock:
+            values = self._own(name)
+            counts = values.get(key)
+            if counts is None:
+                # A count for each bucket and one for +Inf, then the sum.
+                counts = values[key] = [0] * (len(buckets) + 1) + [0.0]
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def begin(self):
+        """Start adding up the time the current request spends on each
+        activity passed to :meth:`spend`.
+        """
+        self._timings.spent = {}
+
+    def spend(self, activity, seconds):
+        """Add time spent on an activity, like the database, to the current
+        request's, if :meth:`begin` was called for it. Time spent in other
+        threads, as by :class:`leaderboard.fanout.FanOut`, isn't counted.
+
+        :param activity: the activity's name
+        :param seconds: the time spent
+        """
+        spent = getattr(self._timings, 'spent', None)
+        if spent is not None:
+            spent[activity] = spent.get(activity, 0.0) + seconds
+
+    def end(self):
+        """Stop adding up the current request's time, and return a
+        dictionary of the seconds it spent on each activity.
+        """
+        spent = getattr(self._timings, 'spent', None)
+        self._timings.spent = None
+
+        return spent or {}
+
+    def snapshot(self):
+        """Return this process's metrics, as a dictionary of metric names to
+        dictionaries of their samples' label strings to values. Histograms'
+        values are lists of the count in each bucket, followed by their sum.
+        """
+        with self._lock:
+            self._own(None)
+            samples = dict(
+                (name, dict(
+                    (key, list(v) if isinstance(v, list) else v)
+                    for key, v in values.items()
+                ))
+                for name, values in self._values.items()
+            )
+
+        for collector in self._collectors:
+            for name, labels, value in collector():
+                values = samples.setdefault(name, {})
+                key = _labels(labels)
+                values[key] = values.get(key, 0) + value
+
+        return samples
+
+    def flush(self):
+        """Write this process's metrics to the directory, if there is one."""
+        if self.directory is None:
+            return
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError as e:
+                # Another worker made it first.
+                if e.errno != errno.EEXIST:
+                    raise
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'wb') as f:
+            json.dump({'pid': os.getpid(), 'samples': self.snapshot()}, f)
+        os.rename(path + '.tmp', path)
+
+    def start(self):
+        """Start writing this process's metrics to the directory every
+        `interval` seconds, and when it exits. Call this once per worker
+        process, after forking; without a directory it does nothing.
+        """
+        if self.directory is None or self._thread is not None:
+            return
+
+        self._thread = Thread(target=self._run, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def stop(self):
+        """Stop writing this process's metrics."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def render(self):
+        """Return the metrics of every worker, summed, in the Prometheus text
+        format.
+        """
+        merged = self._merge()
+        lines = []
+        for name, (kind, help, extra) in self._metrics.items():
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (
+                name, GAUGE if kind == RATIO else kind
+            ))
+            if kind == RATIO:
+                samples = _ratios(merged, *extra)
+            else:
+                samples = merged.get(name, {})
+            for key in sorted(samples):
+                if kind == HISTOGRAM:
+                    lines.extend(_histogram(name, key, samples[key], extra))
+                else:
+                    lines.append(_sample(name, key, samples[key]))
+
+        return '\n'.join(lines) + '\n'
+
+    def _own(self, name):
+        """Return the samples of one of this process's metrics, holding the
+        lock. A process forked from the one that recorded them starts over,
+        so its parent's requests aren't counted twice.
+
+        :param name: the metric's name
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._values = {}
+        if name is None:
+            return None
+
+        return self._values.setdefault(name, {})
+
+    def _merge(self):
+        """Return the snapshots of every worker, summed."""
+        merged = self.snapshot()
+        if self.directory is None or not os.path.isdir(self.directory):
+            return merged
+
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                # It's gone, or isn't ours.
+                continue
+            if snapshot['pid'] == os.getpid():
+                continue
+
+            alive = _alive(snapshot['pid'])
+            for name, samples in snapshot['samples'].items():
+                kind = self._metrics.get(name, (None,))[0]
+                if kind is None or (kind == GAUGE and not alive):
+                    continue
+                values = merged.setdefault(name, {})
+                for key, value in samples.items():
+                    values[key] = _add(values.get(key), value)
+
+        return merged
+
+    def _run(self):
+        """Write this process's metrics every `interval` seconds until
+        stopped.
+        """
+        while not self._stopped.wait(self.interval):
+            try:
+                self.flush()
+            except (IOError, OSError):
+                # The next write may do better; the metrics are still here.
+                pass
+
+
+def _labels(labels):
+    """Return the label string of a dictionary of labels, which identifies a
+    sample.
+
+    :param labels: the dictionary
+    """
+    return ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                     .replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in sorted(labels.items())
+    )
+
+
+def _add(total, value):
+    """Add a sample's value to a running total, bucket by bucket for
+    histograms.
+
+    :param total: the total, or `None`
+    :param value: the value
+    """
+    if total is None:
+        return list(value) if isinstance(value, list) else value
+    if isinstance(value, list):
+        return [a + b for a, b in zip(total, value)]
+
+    return total + value
+
+
+def _ratios(merged, numerator, denominators):
+    """Return the samples of a ratio, for every label string with a nonzero
+    denominator.
+
+    :param merged: the summed metrics
+    :param numerator: the name of the metric to divide
+    :param denominators: the names of the metrics whose sum to divide by
+    """
+    totals = {}
+    for name in denominators:
+        for key, value in merged.get(name, {}).items():
+            totals[key] = totals.get(key, 0) + value
+    numerators = merged.get(numerator, {})
+
+    return dict(
+        (key, float(numerators.get(key, 0)) / total)
+        for key, total in totals.items() if total
+    )
+
+
+def _sample(name, key, value):
+    """Return the line of one sample.
+
+    :param name: the metric name
+    :param key: the label string
+    :param value: the value
+    """
+    if key:
+        name = '%s{%s}' % (name, key)
+    if isinstance(value, float):
+        return '%s %r' % (name, value)
+
+    return '%s %d' % (name, value)
+
+
+def _histogram(name, key, counts, buckets):
+    """Return the lines of one histogram sample: its cumulative bucket
+    counts, sum and count.
+
+    :param name: the metric name
+    :param key: the label string
+    :param counts: the count in each bucket, followed by the sum
+    :param buckets: the buckets' upper bounds
+    """
+    lines = []
+    total = 0
+    for bound, count in zip(buckets + ('+Inf',), counts):
+        total += count
+        lines.append(_sample(
+            name + '_bucket',
+            '%s%sle="%s"' % (key, ',' if key else '', bound),
+            total
+        ))
+    lines.append(_sample(name + '_sum', key, float(counts[-1])))
+    lines.append(_sample(name + '_count', key, total))
+
+    return lines
+
+
+def _alive(pid):
+    """Return `True` if a process is running.
+
+    :param pid: the process id
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+
+    return True
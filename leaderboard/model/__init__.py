@@ -47,5 +47,6 @@ def type_validator(field_type):
     return validator
 
 
+from .competition import Competition
 from .team import Team
 from .user import User
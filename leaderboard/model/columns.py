@@ -0,0 +1,363 @@
+"""
+    leaderboard.model.columns
+    ==========================
+
+    Implements :class:`EffortColumns`, the columnar store that holds a
+    :class:`User`'s efforts.
+
+    :author: Michael Browning
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import MutableSet
+from datetime import datetime, timedelta
+import sys
+
+from .effort import Effort, format_start
+from ..exceptions import ConstraintError
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(dt):
+    """Return the seconds between the epoch and a naive datetime.
+
+    :param dt: the :class:`datetime`
+    """
+    return (dt - EPOCH).total_seconds()
+
+
+def from_epoch(seconds):
+    """Return the naive datetime a number of seconds after the epoch.
+
+    :param seconds: the seconds since the epoch
+    """
+    return EPOCH + timedelta(seconds=seconds)
+
+
+class EffortColumns(MutableSet):
+    """A set of efforts kept as parallel arrays of start times, durations and
+    locations, ordered by start time.
+
+    Rather than one object per effort, each holding a `datetime`, a
+    `timedelta` and a :class:`Location`, the store keeps each effort as one
+    entry in each of three arrays: its start as seconds since the epoch, its
+    duration in seconds, and the number of its location in a table of the
+    distinct locations seen. Totals are summed straight from the arrays, and
+    :class:`Effort` objects are only built when the store is iterated.
+
+    The arrays double as an interval index. A user's efforts never overlap,
+    so ordered by start time their ends are ordered too, and only the
+    neighbours of a new effort's start need checking for an overlap.
+
+    Each effort's serialized form is built the first time it's asked for and
+    kept alongside the arrays. Copies share the serialized forms until either
+    copy changes, so a cached user's copies serialize its efforts only once.
+    """
+
+    def __init__(self, efforts=()):
+        self._starts = array('d')
+        self._durations = array('d')
+        self._location_numbers = array('l')
+        self._locations = []
+        self._location_index = {}
+        # The serialized form of each effort, or `None` until it's built.
+        self._dicts = []
+        self._dicts_shared = False
+
+        for e in efforts:
+            self.add(e)
+
+    @classmethod
+    def _from_iterable(cls, efforts):
+        return cls(efforts)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        for i in xrange(len(self._starts)):
+            yield self._effort(i)
+
+    def __contains__(self, effort):
+        return self._find(effort) is not None
+
+    def __copy__(self):
+        other = type(self)()
+        other._starts = array('d', self._starts)
+        other._durations = array('d', self._durations)
+        other._location_numbers = array('l', self._location_numbers)
+        other._locations = list(self._locations)
+        other._location_index = self._location_index.copy()
+        # Until one of them changes, both stores have the same efforts, so
+        # they can fill in the same serialized forms.
+        other._dicts = self._dicts
+        other._dicts_shared = self._dicts_shared = True
+
+        return other
+
+    def __sizeof__(self):
+        return (
+            object.__sizeof__(self) +
+            sys.getsizeof(self._starts) +
+            sys.getsizeof(self._durations) +
+            sys.getsizeof(self._location_numbers) +
+            sys.getsizeof(self._locations) +
+            sys.getsizeof(self._location_index) +
+            sum(sys.getsizeof(l) for l in self._locations) +
+            sys.getsizeof(self._dicts) +
+            sum(
+                sys.getsizeof(d) + sys.getsizeof(d['start_time'])
+                for d in self._dicts if d is not None
+            )
+        )
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, list(self))
+
+    def add(self, effort):
+        """Add an effort, unless an equal one is already present. Return `True`
+        if the effort was added.
+
+        :param effort: an object of type :class:`Effort`
+        """
+        start = to_epoch(effort.start_time)
+        i = bisect_right(self._starts, start)
+        if self._find(effort, start) is not None:
+            return False
+
+        self._starts.insert(i, start)
+        self._durations.insert(i, effort.duration.total_seconds())
+        self._location_numbers.insert(i, self._location_number(effort.location))
+        self._own_dicts().insert(i, None)
+
+        return True
+
+    def discard(self, effort):
+        """Remove an effort, if present.
+
+        :param effort: an object of type :class:`Effort`
+        """
+        i = self._find(effort)
+        if i is not None:
+            del self._starts[i]
+            del self._durations[i]
+            del self._location_numbers[i]
+            del self._own_dicts()[i]
+
+    def update(self, efforts, check=False):
+        """Add many efforts at once, merging them into the arrays in a single
+        sorted sweep rather than inserting them one at a time. Unless checking
+        for overlaps, efforts equal to one already present are skipped. Return
+        the number of efforts added and their total duration in seconds.
+
+        :param efforts: an iterable of objects of type :class:`Effort`
+        :param check: whether to raise :class:`ConstraintError`, and leave the
+                      store unchanged, if any of the efforts overlap each other
+                      or one already present
+        """
+        new = sorted(
+            (
+                to_epoch(e.start_time),
+                e.duration.total_seconds(),
+                self._location_number(e.location),
+                None
+            )
+            for e in efforts
+        )
+        if not new:
+            return 0, 0
+
+        starts = array('d')
+        durations = array('d')
+        location_numbers = array('l')
+        dicts = []
+        # The latest end seen so far, and whether it belongs to a new effort;
+        # overlaps among efforts already present aren't the caller's doing.
+        last_end = None
+        last_new = False
+        added = 0
+        added_seconds = 0
+        i = j = 0
+        while i < len(self._starts) or j < len(new):
+            if j == len(new) or (
+                i < len(self._starts) and self._starts[i] <= new[j][0]
+            ):
+                entry = (
+                    self._starts[i],
+                    self._durations[i],
+                    self._location_numbers[i],
+                    self._dicts[i]
+                )
+                is_new = False
+                i += 1
+            else:
+                entry = new[j]
+                is_new = True
+                j += 1
+
+            start, duration, number, serialized = entry
+            # When checking, a repeated effort is an overlap like any other.
+            if not check and is_new and self._merged(
+                starts, durations, location_numbers, entry
+            ):
+                continue
+            if (
+                check and last_end is not None and start < last_end and
+                (is_new or last_new)
+            ):
+                raise ConstraintError('Efforts may not overlap in time')
+            if last_end is None or start + duration > last_end:
+                last_end = start + duration
+                last_new = is_new
+
+            starts.append(start)
+            durations.append(duration)
+            location_numbers.append(number)
+            dicts.append(serialized)
+            if is_new:
+                added += 1
+                added_seconds += duration
+
+        self._starts = starts
+        self._durations = durations
+        self._location_numbers = location_numbers
+        self._dicts = dicts
+        self._dicts_shared = False
+
+        return added, added_seconds
+
+    def overlaps(self, effort):
+        """Return `True` if the supplied effort overlaps in time with any of
+        the efforts present. Efforts that merely meet end to start don't
+        overlap.
+
+        :param effort: an object of type :class:`Effort`
+        """
+        start = to_epoch(effort.start_time)
+        end = start + effort.duration.total_seconds()
+        i = bisect_left(self._starts, start)
+
+        # Only the last effort starting before this one can reach past its
+        # start, and only the first starting at or after it can begin before
+        # its end.
+        return (
+            (i > 0 and self._starts[i - 1] + self._durations[i - 1] > start) or
+            (i < len(self._starts) and self._starts[i] < end)
+        )
+
+    def to_dicts(self):
+        """Return the serialized forms of the efforts, ordered by start time,
+        as :meth:`Effort.to_dict` would give them. The dictionaries are
+        shared, so they mustn't be modified.
+        """
+        dicts = self._dicts
+        for i, d in enumerate(dicts):
+            if d is None:
+                dicts[i] = {
+                    'start_time': format_start(from_epoch(self._starts[i])),
+                    'duration': int(self._durations[i]),
+                    'location':
+                        self._locations[self._location_numbers[i]].to_dict(),
+                }
+
+        return list(dicts)
+
+    def total_seconds(self):
+        """The total duration of all the efforts, in seconds."""
+        return sum(self._durations)
+
+    def window_seconds(self, start=None, end=None):
+        """The total duration, in seconds, of the efforts starting in a window
+        of time.
+
+        :param start: the :class:`datetime` the window opens at, inclusive, or
+                      `None` to leave it open
+        :param end: the :class:`datetime` the window closes at, exclusive, or
+                    `None` to leave it open
+        """
+        lo = 0 if start is None else bisect_left(self._starts, to_epoch(start))
+        hi = (
+            len(self._starts) if end is None
+            else bisect_left(self._starts, to_epoch(end))
+        )
+
+        return sum(self._durations[lo:hi])
+
+    def _effort(self, i):
+        """Build the :class:`Effort` stored at a position in the arrays.
+
+        :param i: the position
+        """
+        return Effort.from_row(
+            start_time=from_epoch(self._starts[i]),
+            duration=timedelta(seconds=self._durations[i]),
+            location=self._locations[self._location_numbers[i]]
+        )
+
+    @staticmethod
+    def _merged(starts, durations, location_numbers, entry):
+        """Return `True` if an entry is already among the entries with the
+        same start at the end of a set of arrays being merged.
+
+        :param entry: the entry, as a tuple of start, duration, location
+                      number and serialized form
+        """
+        start, duration, number, _ = entry
+        i = len(starts) - 1
+        while i >= 0 and starts[i] == start:
+            if durations[i] == duration and location_numbers[i] == number:
+                return True
+            i -= 1
+
+        return False
+
+    def _find(self, effort, start=None):
+        """Return the position of an effort in the arrays, or `None` if it
+        isn't stored.
+
+        :param effort: an object of type :class:`Effort`
+        :param start: the effort's start in seconds since the epoch, if
+                      already known
+        """
+        if not isinstance(effort, Effort):
+            return None
+        if start is None:
+            start = to_epoch(effort.start_time)
+
+        duration = effort.duration.total_seconds()
+        i = bisect_left(self._starts, start)
+        while i < len(self._starts) and self._starts[i] == start:
+            if (
+                self._durations[i] == duration and
+                self._locations[self._location_numbers[i]] == effort.location
+            ):
+                return i
+            i += 1
+
+        return None
+
+    def _own_dicts(self):
+        """Return the list of serialized forms, first copying it if it's
+        shared with another store, for when the efforts are about to change.
+        """
+        if self._dicts_shared:
+            self._dicts = list(self._dicts)
+            self._dicts_shared = False
+
+        return self._dicts
+
+    def _location_number(self, location):
+        """Return the number of a location in the location table, adding it if
+        it's new.
+
+        :param location: an object of type :class:`Location`
+        """
+        number = self._location_index.get(location)
+        if number is None:
+            number = len(self._locations)
+            self._locations.append(location)
+            self._location_index[location] = number
+
+        return number
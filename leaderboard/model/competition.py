@@ -0,0 +1,32 @@
+"""
+    leaderboard.model.competition
+    ==============================
+
+    Implements the :class:`Competition` entity.
+
+    :author: Michael Browning
+"""
+
+from .model import Entity
+from . import re_validator
+
+
+class Competition(Entity):
+    """An independent competition (e.g. one city for one season). Users, teams
+    and their efforts all belong to exactly one competition, and leaderboards
+    are only ever computed within a single competition.
+    """
+
+    _validation_rules = {
+        'name': re_validator(r'[A-z][A-z0-9]'),
+    }
+
+    def __init__(self, **kwargs):
+        super(Competition, self).__init__(**kwargs)
+        self.archived = False
+
+    def to_dict(self):
+        competition_dict = super(Competition, self).to_dict()
+        competition_dict['archived'] = self.archived
+
+        return competition_dict
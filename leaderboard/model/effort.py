@@ -38,6 +38,23 @@ def threshold_validator(threshold):
     return validator
 
 
+def format_start(start_time):
+    """Return the JSON representation of an effort's start time.
+
+    :param start_time: the :class:`datetime` the effort started at
+    """
+    return datetime.strftime(start_time, DATETIME_FORMAT)
+
+
+def duration_seconds(duration):
+    """Return the JSON representation of an effort's duration, in whole
+    seconds.
+
+    :param duration: the :class:`timedelta` the effort lasted
+    """
+    return int(duration.total_seconds())
+
+
 class Effort(Value):
     """A completed volunteer opportunity, containing information about when and
     where it happened and for how long."""
@@ -47,31 +64,24 @@ class Effort(Value):
         'duration': threshold_validator(timedelta(0)),
         'location': type_validator(Location),
     }
+    _serializers = {
+        'start_time': format_start,
+        'duration': duration_seconds,
+        'location': Location.to_dict,
+    }
 
     def overlaps(self, other):
-        """Return `True` if the supplied effort overlaps in time with this one.
+        """Return `True` if the supplied effort overlaps in time with this one,
+        including when either contains the other. Efforts that merely meet end
+        to start don't overlap.
 
         :param other: an object of type :class:`Effort`
         """
-        if self.start_time == other.start_time:
-            return True
-
-        end = self.start_time + self.duration
         return (
-            self.start_time < other.start_time < end or
-            self.start_time < other.start_time + other.duration < end
+            self.start_time < other.start_time + other.duration and
+            other.start_time < self.start_time + self.duration
         )
 
-    def to_dict(self):
-        effort_dict = super(Effort, self).to_dict()
-        effort_dict['start_time'] = (
-            datetime.strftime(effort_dict['start_time'], DATETIME_FORMAT)
-        )
-        effort_dict['duration'] = int(effort_dict['duration'].total_seconds())
-        effort_dict['location'] = effort_dict['location'].to_dict()
-
-        return effort_dict
-
     @staticmethod
     def create_effort(**kwargs):
         """Return an instantiated :class:`Effort` object"""
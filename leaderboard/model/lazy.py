@@ -0,0 +1,109 @@
+"""
+    leaderboard.model.lazy
+    =======================
+
+    Implements :class:`LazyCollection`, which stands in for an aggregate's
+    collection until it's first used.
+
+    :author: Michael Browning
+"""
+
+from copy import copy
+import sys
+
+
+def loaded(collection):
+    """Return `True` unless a collection is a :class:`LazyCollection` that
+    hasn't been loaded yet.
+
+    :param collection: the collection
+    """
+    return not isinstance(collection, LazyCollection) or collection.loaded
+
+
+class LazyCollection(object):
+    """A proxy for a collection, such as a user's efforts or a team's members,
+    that's only loaded from the repository when it's first used. Until then
+    it costs one object and a loading function.
+
+    :param load: a callable taking no arguments and returning the loaded
+                 collection
+    """
+
+    def __init__(self, load):
+        self._load = load
+        self._collection = None
+
+    @property
+    def loaded(self):
+        return self._collection is not None
+
+    def get(self):
+        """Return the underlying collection, loading it if need be."""
+        if self._collection is None:
+            self._collection = self._load()
+            self._load = None
+
+        return self._collection
+
+    def __getattr__(self, name):
+        # Only reached for attributes the proxy itself lacks, which its own
+        # private attributes never are once it's initialized.
+        if name in ('_load', '_collection'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __len__(self):
+        return len(self.get())
+
+    def __iter__(self):
+        return iter(self.get())
+
+    def __contains__(self, item):
+        return item in self.get()
+
+    def __getitem__(self, key):
+        return self.get()[key]
+
+    def __setitem__(self, key, value):
+        self.get()[key] = value
+
+    def __delitem__(self, key):
+        del self.get()[key]
+
+    def __sub__(self, other):
+        return self.get() - other
+
+    def __rsub__(self, other):
+        return other - self.get()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyCollection):
+            other = other.get()
+        return self.get() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __copy__(self):
+        if self._collection is None:
+            return type(self)(self._load)
+
+        other = type(self)(None)
+        other._collection = copy(self._collection)
+
+        return other
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self)
+        if self._collection is not None:
+            size += sys.getsizeof(self._collection)
+
+        return size
+
+    def __repr__(self):
+        if self._collection is None:
+            return '<%s (not loaded)>' % type(self).__name__
+        return '<%s %r>' % (type(self).__name__, self._collection)
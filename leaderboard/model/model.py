@@ -7,17 +7,120 @@
     :author: Michael Browning
 """
 
+import keyword
+import operator
+import re
+
 from ..exceptions import MissingFieldError, DefinitionError
 
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _compile_assigner(name, fields, rules=None):
+    """Return a function taking exactly the given fields as arguments and
+    assigning them to an object, through their validation rules if any are
+    given.
+
+    :param name: the name of the function
+    :param fields: the names of the fields, in order
+    :param rules: a dictionary of validation rules by field name
+    """
+    namespace = {'_set': object.__setattr__}
+    lines = ['def %s(self%s):' % (name, ''.join(', ' + f for f in fields))]
+    for i, f in enumerate(fields):
+        if rules is None:
+            lines.append('    _set(self, %r, %s)' % (f, f))
+        else:
+            namespace['_rule%d' % i] = rules[f]
+            lines.append('    _set(self, %r, _rule%d(%s))' % (f, i, f))
+    if not fields:
+        lines.append('    pass')
+
+    exec(compile('\n'.join(lines), '<%s>' % name, 'exec'), namespace)
+
+    return namespace[name]
+
+
+def _compile_serializer(fields, serializers=None):
+    """Return a function building the dictionary of an object's fields in a
+    single expression, converting the fields that have serializers.
+
+    :param fields: the names of the fields, in order
+    :param serializers: a dictionary of callables converting a field's value
+                        to a JSON-ready one, by field name
+    """
+    serializers = serializers or {}
+    namespace = {}
+    items = []
+    for i, f in enumerate(fields):
+        if f in serializers:
+            namespace['_serializer%d' % i] = serializers[f]
+            items.append('%r: _serializer%d(self.%s)' % (f, i, f))
+        else:
+            items.append('%r: self.%s' % (f, f))
+    source = 'def _serialize(self):\n    return {%s}' % ', '.join(items)
+
+    exec(compile(source, '<_serialize>', 'exec'), namespace)
+
+    return namespace['_serialize']
+
+
+class ModelMeta(type):
+    """Metaclass for models, which compiles a class's validation rules into
+    functions made for its fields when the class is defined, so that creating
+    an object doesn't loop over the rules. Its serialization is compiled the
+    same way, through any serializers the class gives for its fields.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        rules = namespace.get('_validation_rules')
+        if rules is not None and all(
+            IDENTIFIER.match(f) and not keyword.iskeyword(f) for f in rules
+        ):
+            fields = tuple(sorted(rules))
+            namespace.setdefault(
+                '_validate', _compile_assigner('_validate', fields, rules)
+            )
+            namespace.setdefault(
+                '_assign', _compile_assigner('_assign', fields)
+            )
+            namespace.setdefault(
+                '_serialize',
+                _compile_serializer(fields, namespace.get('_serializers'))
+            )
+
+        return super(ModelMeta, mcs).__new__(mcs, name, bases, namespace)
+
 
 class Model(object):
     """The base domain model class."""
 
-    def __init__(self, **kwargs):
-        self._validate(**kwargs)
+    __metaclass__ = ModelMeta
+    __slots__ = ()
 
-    def _validate(self, **kwargs):
-        """Apply the validation rules to each of the input fields and store"""
+    def __init__(self, _trusted=False, **kwargs):
+        try:
+            if _trusted:
+                self._assign(**kwargs)
+            else:
+                self._validate(**kwargs)
+        except TypeError:
+            # The compiled functions take exactly the class's fields, so a
+            # missing or unexpected field surfaces as a TypeError.
+            self._check_fields(kwargs)
+            raise
+
+    @classmethod
+    def from_row(cls, **kwargs):
+        """Return an object built from data that has already been validated,
+        such as a row loaded from the database, without validating it again.
+        """
+        return cls(_trusted=True, **kwargs)
+
+    def _check_fields(self, kwargs):
+        """Raise an error unless the input fields are exactly the fields with
+        validation rules.
+        """
         for kw in self._validation_rules:
             if kw not in kwargs:
                 raise MissingFieldError(type(self).__name__, kw)
@@ -26,31 +129,102 @@ class Model(object):
             if kw not in self._validation_rules:
                 raise DefinitionError(type(self).__name__, kw)
 
+    def _validate(self, **kwargs):
+        """Apply the validation rules to each of the input fields and store"""
+        self._check_fields(kwargs)
+        for kw in kwargs:
             rule = self._validation_rules[kw]
-            setattr(self, kw, rule(kwargs[kw]))
+            # Bypasses the immutability guard on values.
+            object.__setattr__(self, kw, rule(kwargs[kw]))
 
-    def to_dict(self):
+    def _assign(self, **kwargs):
+        """Store the input fields as they are"""
+        self._check_fields(kwargs)
+        for kw in kwargs:
+            object.__setattr__(self, kw, kwargs[kw])
+
+    def _serialize(self):
+        """Return a dictionary of the fields"""
         return {kw: getattr(self, kw) for kw in self._validation_rules}
 
+    def to_dict(self):
+        return self._serialize()
+
 
 class Entity(Model):
     """The base entity class."""
-    pass
+
+    # Whether aggregates check their running totals against their contents
+    # whenever the totals are read. That's too slow to leave on, so it's for
+    # tests.
+    check_totals = False
+
+
+def _key_getter(fields):
+    """Return a function getting a tuple of the given fields from an object.
+
+    :param fields: the names of the fields
+    """
+    if len(fields) == 1:
+        return lambda obj, getter=operator.attrgetter(*fields): (getter(obj),)
+    elif fields:
+        return operator.attrgetter(*fields)
+    else:
+        return lambda obj: ()
+
+
+class ValueMeta(ModelMeta):
+    """Metaclass for values, which gives each value class fixed slots for its
+    fields instead of a per-instance `__dict__`, and records the field names
+    in a fixed order for equality and hashing.
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        fields = tuple(sorted(namespace.get('_validation_rules', {})))
+        if '__slots__' not in namespace:
+            namespace['__slots__'] = tuple(
+                f for f in fields if not any(hasattr(b, f) for b in bases)
+            )
+        if '_validation_rules' in namespace:
+            namespace['_fields'] = fields
+            # The key is read in C rather than with a loop over the fields,
+            # since it's computed on every equality comparison.
+            namespace['_key'] = property(_key_getter(fields))
+
+        return super(ValueMeta, mcs).__new__(mcs, name, bases, namespace)
 
 
 class Value(Model):
-    """The base, immutable value class."""
+    """The base, immutable value class. Values are compared and hashed by
+    their fields, and the hash is computed once, on creation.
+    """
+
+    __metaclass__ = ValueMeta
+    # Objects only receive an id when they're saved, so it's the one attribute
+    # that may be assigned after creation.
+    __slots__ = ('id', '_hash', '_serialized')
+    _fields = ()
 
     def __init__(self, **kwargs):
         super(Value, self).__init__(**kwargs)
-        self._set = True
+        object.__setattr__(self, '_hash', hash(self._key))
+
+    @classmethod
+    def from_row(cls, **kwargs):
+        # Values have no state beyond their fields, so there's no need to go
+        # through __init__.
+        value = cls.__new__(cls)
+        try:
+            value._assign(**kwargs)
+        except TypeError:
+            value._check_fields(kwargs)
+            raise
+        object.__setattr__(value, '_hash', hash(value._key))
+
+        return value
 
     def __setattr__(self, name, value):
-        # This lets us initialize values in __init__, but then prevents further
-        # modification.
-        if name != 'id' and hasattr(self, '_set') and self._set:
-            # Objects only receive an id when they're saved, so we need to allow
-            # id assignment after creation.
+        if name != 'id':
             raise TypeError(
                 'Type "%s" does not support attribute assignment' % (
                     type(self).__name__
@@ -59,37 +233,54 @@ class Value(Model):
         object.__setattr__(self, name, value)
 
     def __delattr__(self, name):
-        # The last step in making a truly immutable object, to prevent self._set
-        # from being deleted and thereby making attribute assignment possible
-        # again.
         raise TypeError(
             'Type "%s" does not support attribute deletion' % (
                 type(self).__name__
             )
         )
 
+    # The field values that make up a value's identity. The object id isn't
+    # included, since it's metadata.
+    _key = ()
+
     def __eq__(self, other):
-        if other:
-            if isinstance(other, type(self)) or isinstance(self, type(other)):
-                # We don't consider the object id in equality comparisons, since
-                # it's metadata.
-                self_dict = self.__dict__.copy()
-                self_dict.pop('id', None)
-                other_dict = other.__dict__.copy()
-                other_dict.pop('id', None)
-
-                return self_dict == other_dict
-            else:
-                return False
-        else:
+        if self is other:
+            return True
+        if type(other) is not type(self) and not (
+            isinstance(other, Value) and (
+                isinstance(other, type(self)) or isinstance(self, type(other))
+            )
+        ):
             return False
 
+        # Comparing the precomputed hashes first rejects nearly all unequal
+        # values without looking at their fields.
+        return self._hash == other._hash and self._key == other._key
+
     def __ne__(self, other):
         return not self == other
 
     def __hash__(self):
-        dict = self.__dict__.copy()
-        dict.pop('id', None)
-        return hash(
-           tuple([(k, getattr(self, k)) for k in sorted(dict)])
+        return self._hash
+
+    def to_dict(self):
+        # Values are immutable, so they're only serialized once. The
+        # dictionary is shared by every caller, so it mustn't be modified.
+        try:
+            return self._serialized
+        except AttributeError:
+            serialized = self._serialize()
+            object.__setattr__(self, '_serialized', serialized)
+
+            return serialized
+
+    def __getstate__(self):
+        return dict(
+            (f, getattr(self, f)) for f in self._fields + ('id',)
+            if hasattr(self, f)
         )
+
+    def __setstate__(self, state):
+        for f in state:
+            object.__setattr__(self, f, state[f])
+        object.__setattr__(self, '_hash', hash(self._key))
@@ -9,11 +9,16 @@
 
 from .model import Entity
 from . import re_validator
-from ..exceptions import ConstraintError
+from .lazy import loaded
+from ..exceptions import ConstraintError, ConsistencyError
 
 
 class Team(Entity):
-    """A team."""
+    """A team.
+
+    Like a user, a team keeps running totals of its members' effort count and
+    duration. They're `None` if any member's are.
+    """
 
     _validation_rules = {
         'name': re_validator(r'[A-z][A-z0-9]'),
@@ -22,10 +27,19 @@ class Team(Entity):
     def __init__(self, **kwargs):
         super(Team, self).__init__(**kwargs)
         self.members = {}
+        self.effort_count = 0
+        self.effort_seconds = 0
+        # Like the id, the competition is assigned by the repository.
+        self.competition_id = None
 
     def time_worked(self):
-        """The total time put in volunteering by all users on this team."""
-        return sum(m.time_worked() for m in self.members)
+        """The total time put in volunteering by all users on this team,
+        expressed in seconds.
+        """
+        if self.check_totals:
+            self._check_totals()
+
+        return self.effort_seconds
 
     def add_user(self, user):
         """Add a user to this team. No two users may have the same username.
@@ -37,10 +51,53 @@ class Team(Entity):
                 'Team %s has user with username %s' % (self.name, user.username)
             )
         self.members[user.username] = user
+        if self.effort_count is None or user.effort_count is None:
+            self.effort_count = self.effort_seconds = None
+        else:
+            self.effort_count += user.effort_count
+            self.effort_seconds += user.effort_seconds
+
+    def _check_totals(self):
+        """Raise a :class:`ConsistencyError` if the running totals disagree
+        with the members', when they've been loaded.
+        """
+        if not loaded(self.members) or self.effort_count is None:
+            return
 
-    def to_dict(self):
+        count = sum(m.effort_count for m in self)
+        seconds = sum(m.time_worked() for m in self)
+        if (
+            self.effort_count != count or
+            abs(self.effort_seconds - seconds) > 1e-6
+        ):
+            raise ConsistencyError(
+                'Team %s has running totals %d/%s for members\' %d/%s' % (
+                    self.name, self.effort_count, self.effort_seconds,
+                    count, seconds
+                )
+            )
+
+    def to_dict(self, fields=None, include=None):
+        """Return the team's data, limited to some fields and relations if
+        they're supplied. Both apply to the members too.
+
+        :param fields: the names of the fields to return, which may include
+                       `effort`, the total time worked, or `None` for all of
+                       them but that
+        :param include: the names of the relations to return, or `None` for all
+                        of them; the team's only one is `members`
+        """
         team_dict = super(Team, self).to_dict()
-        team_dict['members'] = [m.to_dict() for m in self.members.values()]
+        if fields is not None:
+            team_dict = dict(
+                (f, v) for f, v in team_dict.iteritems() if f in fields
+            )
+            if 'effort' in fields:
+                team_dict['effort'] = int(self.time_worked())
+        if include is None or 'members' in include:
+            team_dict['members'] = [
+                m.to_dict(fields, include) for m in self.members.values()
+            ]
 
         return team_dict
 
@@ -11,14 +11,22 @@
 
 from .model import Entity
 from .effort import Effort
+from .columns import EffortColumns
 from . import re_validator, type_validator
-from ..exceptions import ConstraintError
+from .lazy import loaded
+from ..exceptions import ConstraintError, ConsistencyError
 
 name_transform = lambda x: x[0].upper() + x[1:]
 
 
 class User(Entity):
-    """A user."""
+    """A user.
+
+    A user keeps running totals of its efforts' count and duration, so that
+    reading them doesn't need the efforts themselves. Repositories loading a
+    user without its efforts load the totals instead, unless asked not to, in
+    which case they're `None` and the user is only fit for reading.
+    """
 
     _validation_rules = {
         'username': re_validator(r'^[A-z][A-z0-9]+$'),
@@ -29,7 +37,11 @@ class User(Entity):
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        self.efforts = set()
+        self.efforts = EffortColumns()
+        self.effort_count = 0
+        self.effort_seconds = 0
+        # Like the id, the competition is assigned by the repository.
+        self.competition_id = None
 
     def full_name(self):
         """The user's full first and last name."""
@@ -39,7 +51,10 @@ class User(Entity):
         """The total time put in volunteering by this user, expressed in
         seconds.
         """
-        total = sum(e.duration.total_seconds() for e in self.efforts)
+        if self.check_totals:
+            self._check_totals()
+
+        return self.effort_seconds
 
     def add_effort(self, *args, **kwargs):
         """Add an effort to this user's record. Efforts may not overlap in time.
@@ -51,14 +66,66 @@ class User(Entity):
         else:
             effort = Effort.create_effort(**kwargs)
 
-            for e in self.efforts:
-                if effort.overlaps(e):
-                    raise ConstraintError('Efforts may not overlap in time')
+            if self.efforts.overlaps(effort):
+                raise ConstraintError('Efforts may not overlap in time')
+
+        if self.efforts.add(effort):
+            self.effort_count += 1
+            self.effort_seconds += effort.duration.total_seconds()
+
+    def add_efforts(self, efforts, check=True):
+        """Add a batch of efforts to this user's record, all at once. None of
+        the efforts may overlap in time, with each other or with the user's
+        existing efforts; if any do, none are added.
+
+        :param efforts: an iterable of objects of type :class:`Effort`
+        :param check: whether to check the efforts for overlaps; repositories
+                      loading saved efforts, which are guaranteed not to
+                      overlap, can skip it
+        """
+        count, seconds = self.efforts.update(efforts, check=check)
+        self.effort_count += count
+        self.effort_seconds += seconds
+
+    def _check_totals(self):
+        """Raise a :class:`ConsistencyError` if the running totals disagree
+        with the efforts, when they've been loaded.
+        """
+        if not loaded(self.efforts) or self.effort_count is None:
+            return
 
-        self.efforts.add(effort)
+        if (
+            self.effort_count != len(self.efforts) or
+            abs(self.effort_seconds - self.efforts.total_seconds()) > 1e-6
+        ):
+            raise ConsistencyError(
+                'User %s has running totals %d/%s for efforts %d/%s' % (
+                    self.username,
+                    self.effort_count,
+                    self.effort_seconds,
+                    len(self.efforts),
+                    self.efforts.total_seconds()
+                )
+            )
 
-    def to_dict(self):
+    def to_dict(self, fields=None, include=None):
+        """Return the user's data, limited to some fields and relations if
+        they're supplied.
+
+        :param fields: the names of the fields to return, which may include
+                       `effort`, the total time worked, or `None` for all of
+                       them but that
+        :param include: the names of the relations to return, or `None` for all
+                        of them; the user's only one is `efforts`
+        """
         user_dict = super(User, self).to_dict()
-        user_dict['efforts'] = [e.to_dict() for e in self.efforts]
+        if fields is not None:
+            user_dict = dict(
+                (f, v) for f, v in user_dict.iteritems() if f in fields
+            )
+            if 'effort' in fields:
+                user_dict['effort'] = int(self.time_worked())
+        if include is None or 'efforts' in include:
+            user_dict['efforts'] = self.efforts.to_dicts()
 
         return user_dict
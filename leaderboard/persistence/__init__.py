@@ -8,22 +8,37 @@
 """
 
 from functools import wraps
+import time
+
 from psycopg2.extras import RealDictCursor
 
+from .. import registry
+
 
 def opens_cursor(fn, connection):
     """Wraps a function that accepts a cursor as its first argument, handling
-    the opening, closing and commit logic.
+    the opening, closing and commit logic. If the function raises, its
+    transaction is rolled back, so that the connection can still be used.
+    The time the transaction takes counts towards the current request's
+    database time in :data:`leaderboard.registry`.
 
     :param fn: the function to wrap
     :param connection: the connection that spawns the cursor
     """
     @wraps(fn)
     def wrapped(*args, **kwargs):
+        started = time.time()
         cursor = connection.cursor(cursor_factory=RealDictCursor)
-        result = fn(cursor, *args, **kwargs)
+        try:
+            result = fn(cursor, *args, **kwargs)
+        except Exception:
+            connection.rollback()
+            cursor.close()
+            registry.spend('db', time.time() - started)
+            raise
         connection.commit()
         cursor.close()
+        registry.spend('db', time.time() - started)
 
         return result
 
@@ -32,3 +47,6 @@ def opens_cursor(fn, connection):
 
 from .user import UserRepository
 from .team import TeamRepository
+from .competition import CompetitionRepository
+from .analytics import AnalyticsRepository
+from .idempotency import IdempotencyRepository
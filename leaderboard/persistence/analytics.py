@@ -0,0 +1,172 @@
+"""
+    leaderboard.persistence.analytics
+    ==================================
+
+    Implements :class:`AnalyticsRepository`, which reads efforts in bulk as
+    plain rows rather than as domain objects.
+
+    :author: Michael Browning
+"""
+
+from .repository import Repository
+from . import opens_cursor
+
+
+class AnalyticsRepository(Repository):
+    """A read-only repository for computations over every effort at once,
+    such as reports and large rankings, which would be far too slow through
+    :class:`User` aggregates.
+    """
+
+    table_name = 'efforts'
+    users_table_name = 'users'
+    teams_table_name = 'teams'
+    users2teams_table_name = 'users2teams'
+
+    # Rows are fetched from a server-side cursor in batches of this size, so
+    # that the client never holds every row at once.
+    batch_size = 100000
+
+    def __init__(self, connection=None, competition_id=None):
+        super(AnalyticsRepository, self).__init__(connection, competition_id)
+        self.user_ids = opens_cursor(self.user_ids, self.connection)
+        self.team_ids = opens_cursor(self.team_ids, self.connection)
+        self.memberships = opens_cursor(self.memberships, self.connection)
+        self.user_totals = opens_cursor(self.user_totals, self.connection)
+        self.team_totals = opens_cursor(self.team_totals, self.connection)
+
+    def effort_batches(self):
+        """Yield lists of effort rows, each a tuple of user id, start time in
+        seconds since the epoch, duration in seconds and location id.
+        """
+        cursor = self.connection.cursor('analytics_efforts')
+        cursor.itersize = self.batch_size
+        try:
+            cursor.execute(
+                'SELECT "user", extract(epoch FROM start_time)::float8, '
+                    'extract(epoch FROM duration)::float8, location '
+                    'FROM %s%s' % (self.table_name, self._where()),
+                self._params()
+            )
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+            self.connection.commit()
+
+    def user_ids(self, cursor):
+        """Return the ids of all users."""
+        cursor.execute(
+            'SELECT id FROM %s%s' % (self.users_table_name, self._where()),
+            self._params()
+        )
+
+        return [r['id'] for r in cursor.fetchall()]
+
+    def team_ids(self, cursor):
+        """Return the ids of all teams."""
+        cursor.execute(
+            'SELECT id FROM %s%s' % (self.teams_table_name, self._where()),
+            self._params()
+        )
+
+        return [r['id'] for r in cursor.fetchall()]
+
+    def memberships(self, cursor):
+        """Return the user and team ids of all team memberships, as tuples."""
+        if self.competition_id is None:
+            cursor.execute(
+                'SELECT "user", team FROM %s' % self.users2teams_table_name
+            )
+        else:
+            cursor.execute(
+                'SELECT ut."user", ut.team FROM %s ut '
+                    'JOIN %s u ON u.id = ut."user" '
+                    'WHERE u.competition = %%s' % (
+                        self.users2teams_table_name, self.users_table_name
+                    ),
+                (self.competition_id,)
+            )
+
+        return [(r['user'], r['team']) for r in cursor.fetchall()]
+
+    def user_totals(self, cursor, user_ids=None):
+        """Return a dictionary of the total duration of each user's efforts,
+        in seconds, by user id, including users without efforts.
+
+        :param user_ids: if supplied, only total these users
+        """
+        cursor.execute(
+            'SELECT u.id, '
+                'coalesce(sum(extract(epoch FROM e.duration)), 0)::float8 '
+                'AS seconds '
+                'FROM %s u LEFT JOIN %s e ON e."user" = u.id%s '
+                'GROUP BY u.id' % (
+                    self.users_table_name, self.table_name,
+                    self._where_ids('u', user_ids)
+                ),
+            self._params_ids(user_ids)
+        )
+
+        return dict((r['id'], r['seconds']) for r in cursor.fetchall())
+
+    def team_totals(self, cursor, team_ids=None):
+        """Return a dictionary of the total duration of each team's members'
+        efforts, in seconds, by team id, including teams without efforts.
+
+        :param team_ids: if supplied, only total these teams
+        """
+        cursor.execute(
+            'SELECT t.id, '
+                'coalesce(sum(extract(epoch FROM e.duration)), 0)::float8 '
+                'AS seconds '
+                'FROM %s t LEFT JOIN %s ut ON ut.team = t.id '
+                'LEFT JOIN %s e ON e."user" = ut."user"%s '
+                'GROUP BY t.id' % (
+                    self.teams_table_name, self.users2teams_table_name,
+                    self.table_name, self._where_ids('t', team_ids)
+                ),
+            self._params_ids(team_ids)
+        )
+
+        return dict((r['id'], r['seconds']) for r in cursor.fetchall())
+
+    def _where_ids(self, alias, ids):
+        """The clause scoping a query of users or teams to this repository's
+        competition and, if supplied, some ids.
+
+        :param alias: the alias of the users or teams table in the query
+        :param ids: a list of ids, or `None`
+        """
+        conditions = []
+        if self.competition_id is not None:
+            conditions.append('%s.competition = %%s' % alias)
+        if ids is not None:
+            conditions.append('%s.id = ANY(%%s)' % alias)
+        if not conditions:
+            return ''
+        return ' WHERE ' + ' AND '.join(conditions)
+
+    def _params_ids(self, ids):
+        """The parameters for :meth:`_where_ids`."""
+        params = []
+        if self.competition_id is not None:
+            params.append(self.competition_id)
+        if ids is not None:
+            params.append(list(ids))
+        return tuple(params) or None
+
+    def _where(self):
+        """The clause scoping a query to this repository's competition."""
+        if self.competition_id is None:
+            return ''
+        return ' WHERE competition = %s'
+
+    def _params(self):
+        """The parameters for :meth:`_where`."""
+        if self.competition_id is None:
+            return None
+        return (self.competition_id,)
@@ -0,0 +1,110 @@
+"""
+    leaderboard.persistence.competition
+    ====================================
+
+    Implements :class:`CompetitionRepository`, for :class:`Competition`
+    objects.
+
+    :author: Michael Browning
+"""
+
+import psycopg2
+
+from .repository import Repository
+from ..model import Competition
+from . import opens_cursor
+from ..exceptions import ConstraintError
+
+
+class CompetitionRepository(Repository):
+    """A repository that keeps track of :class:`Competition` objects."""
+
+    table_name = 'competitions'
+
+    def __init__(self, connection=None):
+        super(CompetitionRepository, self).__init__(connection)
+        self.get = opens_cursor(self.get, self.connection)
+        self.save = opens_cursor(self.save, self.connection)
+        self.archive = opens_cursor(self.archive, self.connection)
+        self.live = opens_cursor(self.live, self.connection)
+
+    def get(self, cursor, competition_id=None, name=None):
+        """Get the :class:`Competition` with the specified id or name.
+
+        :param competition_id: the integer id of the competition
+        :param name: the name of the competition
+        """
+        if name and competition_id:
+            raise ValueError('Only one of id or name may be used as index')
+        elif name:
+            field = 'name'
+            value = name
+        elif competition_id:
+            field = 'id'
+            value = competition_id
+        else:
+            raise ValueError('One of id or name must be used as index')
+
+        try:
+            competition_data = self._get(cursor, field, value)[0]
+        except IndexError:
+            return
+
+        return self._create(cursor, competition_data)
+
+    def live(self, cursor):
+        """Return all competitions that haven't been archived."""
+        cursor.execute(
+            'SELECT * FROM %s WHERE NOT archived' % self.table_name
+        )
+
+        return [self._create(cursor, r) for r in cursor.fetchall()]
+
+    def save(self, cursor, competition):
+        """Save a :class:`Competition` to the repository.
+
+        :param competition: a :class:`Competition` object
+        """
+        if hasattr(competition, 'id'):
+            cursor.execute(
+                'UPDATE %s SET name = %%s WHERE id = %%s' % self.table_name,
+                (competition.name, competition.id)
+            )
+        else:
+            try:
+                cursor.execute(
+                    'INSERT INTO %s (name) VALUES (%%s) RETURNING id' % (
+                        self.table_name,
+                    ),
+                    (competition.name,)
+                )
+            except psycopg2.IntegrityError:
+                raise ConstraintError(
+                    'competition %s exists' % competition.name
+                )
+
+            competition.id = cursor.fetchone()['id']
+
+    def archive(self, cursor, competition):
+        """Archive a competition. Archiving only flags the competition's own
+        row; its users, teams and efforts stay where they are and remain
+        readable, and no other competition's data is touched.
+
+        :param competition: the :class:`Competition` to archive
+        """
+        cursor.execute(
+            'UPDATE %s SET archived = true WHERE id = %%s' % self.table_name,
+            (competition.id,)
+        )
+        competition.archived = True
+
+    def _create(self, cursor, row):
+        """Reconstitute a competition from a database row.
+
+        :param row: the row data as a dictionary
+        """
+        competition = Competition.from_row(name=row['name'])
+        competition.id = row['id']
+        competition.archived = row['archived']
+
+        return competition
@@ -0,0 +1,126 @@
+"""
+    leaderboard.persistence.idempotency
+    ====================================
+
+    Implements :class:`IdempotencyRepository`, for the responses stored under
+    clients' idempotency keys.
+
+    :author: Michael Browning
+"""
+
+from datetime import timedelta
+import json
+
+import psycopg2
+
+from .repository import Repository
+from . import opens_cursor
+
+
+class IdempotencyRepository(Repository):
+    """A repository that keeps track of the requests made with each
+    idempotency key, and the responses to them.
+
+    A key is reserved when its first request starts, and its response stored
+    when that request succeeds. Keys are forgotten `ttl` seconds after they
+    were reserved, and a reservation whose request hasn't finished within
+    `lease` seconds is given up on, so that its key may be reserved again.
+
+    :param ttl: how long keys are kept, in seconds
+    :param lease: how long a request may hold a key unanswered, in seconds
+    """
+
+    table_name = 'idempotency_keys'
+
+    def __init__(self, connection=None, ttl=86400, lease=60):
+        super(IdempotencyRepository, self).__init__(connection)
+        self.ttl = timedelta(seconds=ttl)
+        self.lease = timedelta(seconds=lease)
+        self.get = opens_cursor(self.get, self.connection)
+        self.reserve = opens_cursor(self.reserve, self.connection)
+        self.complete = opens_cursor(self.complete, self.connection)
+        self.release = opens_cursor(self.release, self.connection)
+        self.purge = opens_cursor(self.purge, self.connection)
+
+    def get(self, cursor, key):
+        """Get the fingerprint of the request made with a key, and the
+        response to it or `None` if it's still in progress, as a pair. Return
+        `None` if the key isn't held.
+
+        :param key: the idempotency key
+        """
+        cursor.execute(
+            'SELECT fingerprint, response FROM %s WHERE key = %%s '
+                'AND created > now() - %%s '
+                'AND (response IS NOT NULL OR created > now() - %%s)' % (
+                    self.table_name
+                ),
+            (key, self.ttl, self.lease)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        response = row['response']
+        if response is not None:
+            response = json.loads(response)
+
+        return row['fingerprint'], response
+
+    def reserve(self, cursor, key, fingerprint):
+        """Reserve a key for a request, unless another request holds it.
+        Return `True` if the key was reserved.
+
+        :param key: the idempotency key
+        :param fingerprint: a digest identifying the request
+        """
+        cursor.execute(
+            'DELETE FROM %s WHERE key = %%s AND (created <= now() - %%s '
+                'OR (response IS NULL AND created <= now() - %%s))' % (
+                    self.table_name
+                ),
+            (key, self.ttl, self.lease)
+        )
+        try:
+            cursor.execute(
+                'INSERT INTO %s (key, fingerprint) VALUES (%%s, %%s)' % (
+                    self.table_name
+                ),
+                (key, fingerprint)
+            )
+        except psycopg2.IntegrityError:
+            # Another request holds the key.
+            cursor.connection.rollback()
+            return False
+
+        return True
+
+    def complete(self, cursor, key, response):
+        """Store the response to a key's request.
+
+        :param key: the idempotency key
+        :param response: the JSON-serializable response
+        """
+        cursor.execute(
+            'UPDATE %s SET response = %%s WHERE key = %%s' % self.table_name,
+            (json.dumps(response), key)
+        )
+
+    def release(self, cursor, key):
+        """Give up a key whose request failed, so that it may be retried.
+
+        :param key: the idempotency key
+        """
+        cursor.execute(
+            'DELETE FROM %s WHERE key = %%s AND response IS NULL' % (
+                self.table_name
+            ),
+            (key,)
+        )
+
+    def purge(self, cursor):
+        """Forget every key that has outlived its time-to-live."""
+        cursor.execute(
+            'DELETE FROM %s WHERE created <= now() - %%s' % self.table_name,
+            (self.ttl,)
+        )
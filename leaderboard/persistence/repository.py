@@ -7,30 +7,160 @@
     :author: Michael Browning
 """
 
+from functools import wraps
+from itertools import count
 import os
 import urlparse
 import psycopg2
+from psycopg2.extras import RealDictCursor
 
 from . import opens_cursor
 from .. import config
 
+# The competition created by the schema, which objects saved without an
+# explicit competition belong to.
+DEFAULT_COMPETITION_ID = 1
+
+# Numbers the server-side cursors, whose names must be unique per connection.
+_cursor_ids = count()
+
 
 class Repository(object):
-    """A repository that keeps track of persisted domain objects."""
+    """A repository that keeps track of persisted domain objects.
+
+    A repository may be scoped to a single competition, in which case its
+    listing and lookup queries only ever see rows from that competition.
+
+    A `fanout` is only used by repositories that take in
+    :class:`FanOutMixin`; others build their objects one after another.
+    """
+
+    # :meth:`iter_all` builds objects from this many rows at a time.
+    batch_size = 100
 
-    def __init__(self, connection=None):
+    def __init__(self, connection=None, competition_id=None, fanout=None):
         if connection is None:
-            from .. import connection as conn
-            self.connection = conn
+            from .. import current_connection
+            self.connection = current_connection()
         else:
             self.connection = connection
+        self.competition_id = competition_id
+        self.fanout = fanout
+        if self._uses_app_connection():
+            from .. import bus
+            self.bus = bus
+        else:
+            self.bus = None
         self.all = opens_cursor(self.all, self.connection)
+        self._create_batch = opens_cursor(self._create_batch, self.connection)
 
     def all(self, cursor):
         """Return all objects in the repository."""
-        cursor.execute('SELECT * FROM %s' % self.table_name)
+        if self.competition_id is None:
+            cursor.execute('SELECT * FROM %s' % self.table_name)
+        else:
+            cursor.execute(
+                'SELECT * FROM %s WHERE competition = %%s' % self.table_name,
+                (self.competition_id,)
+            )
+
+        return self._create_all(cursor, cursor.fetchall())
+
+    def iter_all(self):
+        """Return an iterator over all objects in the repository, which only
+        holds :attr:`batch_size` of them at a time. The query runs right away,
+        so that it fails here rather than partway through the iteration.
+
+        The rows are read from a server-side cursor declared `WITH HOLD`, so
+        that it stays open across the commits of whatever runs while the
+        objects are being iterated over. It's closed once the iterator is
+        exhausted or closed, and should be one or the other.
+        """
+        cursor = self.connection.cursor(
+            '%s_all_%d' % (self.table_name, next(_cursor_ids)),
+            cursor_factory=RealDictCursor,
+            withhold=True
+        )
+        if self.competition_id is None:
+            cursor.execute('SELECT * FROM %s' % self.table_name)
+        else:
+            cursor.execute(
+                'SELECT * FROM %s WHERE competition = %%s' % self.table_name,
+                (self.competition_id,)
+            )
+        self.connection.commit()
+
+        return self._iter_batches(cursor)
+
+    def _iter_batches(self, cursor):
+        """Yield the objects for the rows of a server-side cursor, a batch at a
+        time, and close it when done.
+
+        :param cursor: the executed, named cursor
+        """
+        try:
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for obj in self._create_batch(rows):
+                    yield obj
+        finally:
+            cursor.close()
+            self.connection.commit()
+
+    def _create_batch(self, cursor, rows):
+        """Reconstitute the objects for a batch of rows.
+
+        :param rows: a list of rows as dictionaries
+        """
+        return self._create_all(cursor, rows)
+
+    def _create_all(self, cursor, rows):
+        """Reconstitute the objects for a list of rows, in order.
+
+        :param rows: a list of rows as dictionaries
+        """
+        return [self._create(cursor, r) for r in rows]
+
+    def _opens_lazy_cursor(self, load):
+        """Wrap a method that loads a lazy collection like :func:`opens_cursor`
+        does. If this repository uses the app's connection, the collection is
+        loaded on whichever is current when it's used, since a cached object
+        may be used by a later request, after the pooled connection it was
+        loaded on has been lent to another.
+
+        :param load: the method, which accepts a cursor as its first argument
+        """
+        if not self._uses_app_connection():
+            return opens_cursor(load, self.connection)
+
+        @wraps(load)
+        def wrapped(*args, **kwargs):
+            from .. import current_connection
+
+            return opens_cursor(load, current_connection())(*args, **kwargs)
+
+        return wrapped
 
-        return [self._create(cursor, r) for r in cursor.fetchall()]
+    def _notify(self, cursor, kind, **keys):
+        """Announce a write to other processes on the invalidation bus, if
+        this repository is on the app's shared connection.
+
+        :param kind: the kind of entity written
+        :param keys: the keys identifying the written entity
+        """
+        if self.bus is not None:
+            self.bus.notify(cursor, kind, **keys)
+
+    def _uses_app_connection(self):
+        """Return `True` if this repository uses the app's connection, or the
+        current request's own, which are the only ones the app's shared caches
+        are kept coherent with.
+        """
+        from .. import is_app_connection
+
+        return is_app_connection(self.connection)
 
     def get(self, obj_id):
         """Return an object with the specified id from the repository.
@@ -59,9 +189,124 @@ class Repository(object):
         :param field: the field to search
         :param value: the desired value
         """
-        cursor.execute(
-            'SELECT * FROM %s WHERE %s = %%s' % (self.table_name, field),
-            (value,)
-        )
+        if self.competition_id is None:
+            cursor.execute(
+                'SELECT * FROM %s WHERE %s = %%s' % (self.table_name, field),
+                (value,)
+            )
+        else:
+            cursor.execute(
+                'SELECT * FROM %s WHERE %s = %%s AND competition = %%s' % (
+                    self.table_name, field
+                ),
+                (value, self.competition_id)
+            )
 
         return cursor.fetchall()
+
+    def _get_any(self, cursor, field, values):
+        """Get the objects with any of the specified values in the specified
+        field, in one query however many values there are.
+
+        :param field: the field to search
+        :param values: a list of the desired values
+        """
+        if self.competition_id is None:
+            cursor.execute(
+                'SELECT * FROM %s WHERE %s = ANY(%%s)' % (
+                    self.table_name, field
+                ),
+                (values,)
+            )
+        else:
+            cursor.execute(
+                'SELECT * FROM %s WHERE %s = ANY(%%s) AND competition = %%s' % (
+                    self.table_name, field
+                ),
+                (values, self.competition_id)
+            )
+
+        return cursor.fetchall()
+
+    def _competition_of(self, obj):
+        """Return the id of the competition an object belongs to, falling back
+        to this repository's competition and then the default competition.
+
+        :param obj: a domain object that may carry a `competition_id`
+        """
+        competition_id = getattr(obj, 'competition_id', None)
+        if competition_id is None:
+            competition_id = self.competition_id
+        if competition_id is None:
+            competition_id = DEFAULT_COMPETITION_ID
+
+        return competition_id
+
+
+class FanOutMixin(object):
+    """Lets a :class:`Repository` build the objects it lists from their rows
+    itself, and then load their related objects for all of them at once, in
+    a fixed number of queries, rather than one object after another.
+
+    Given a :class:`leaderboard.fanout.FanOut`, it instead loads each
+    object's related objects concurrently, on the fan-out's connections.
+    Each object's related objects are then read in a transaction of their
+    own.
+
+    Repositories taking it in must come before :class:`Repository` in their
+    bases, and implement :meth:`_on`, :meth:`_from_row`, :meth:`_attach` and
+    :meth:`_attach_many`.
+    """
+
+    def _create_all(self, cursor, rows):
+        """Reconstitute the objects for a list of rows, in order, loading
+        their related objects on the fan-out if this repository has one.
+
+        :param rows: a list of rows as dictionaries
+        """
+        objs = [self._from_row(r) for r in rows]
+        if self.fanout is None or len(rows) < 2:
+            self._attach_many(cursor, objs)
+        else:
+            self.fanout.map(self._attach_on, objs)
+
+        return objs
+
+    def _attach_on(self, connection, obj):
+        """Load an object's related objects on another connection.
+
+        :param connection: the connection to load on
+        :param obj: the object built by :meth:`_from_row`
+        """
+        repository = self._on(connection)
+        opens_cursor(repository._attach, connection)(obj)
+
+    def _on(self, connection):
+        """Return a copy of this repository on another connection, without a
+        fan-out, whose lazily loaded collections still load on this one's.
+
+        :param connection: the connection
+        """
+        raise NotImplementedError()
+
+    def _from_row(self, row):
+        """Build an object from a database row, without its related objects.
+
+        :param row: the row data as a dictionary
+        """
+        raise NotImplementedError()
+
+    def _attach(self, cursor, obj):
+        """Give an object built by :meth:`_from_row` its related objects.
+
+        :param obj: the object being loaded
+        """
+        raise NotImplementedError()
+
+    def _attach_many(self, cursor, objs):
+        """Do what :meth:`_attach` does for many objects at once, in a fixed
+        number of queries.
+
+        :param objs: a list of the objects being loaded
+        """
+        raise NotImplementedError()
@@ -7,26 +7,48 @@
     :author: Michael Browning
 """
 
+from functools import partial
+
 import psycopg2
 
-from .repository import Repository
+from .repository import FanOutMixin, Repository
 from .user import UserRepository
 from ..model import Team
+from ..model.lazy import LazyCollection, loaded
 from . import opens_cursor
 from ..exceptions import ConstraintError
 
 
-class TeamRepository(Repository):
-    """A repository that keeps track of :class:`Team` objects."""
+class TeamRepository(FanOutMixin, Repository):
+    """A repository that keeps track of :class:`Team` objects.
+
+    By default a team's members are only loaded when they're first used.
+    Callers that know they need them can pass `eager=True` to have them, and
+    their efforts, loaded along with each team. `efforts` and `totals` control
+    how the members are loaded, as `eager` and `totals` do for a
+    :class:`UserRepository`, and `totals` applies to the teams' running totals
+    too.
+    """
 
     table_name = 'teams'
 
-    def __init__(self, connection=None):
-        super(TeamRepository, self).__init__(connection)
+    def __init__(self, connection=None, competition_id=None, eager=False,
+                 efforts=None, totals=True, fanout=None):
+        super(TeamRepository, self).__init__(
+            connection, competition_id, fanout
+        )
+        self.eager = eager
+        self.totals = totals
         self.get = opens_cursor(self.get, self.connection)
+        self.get_many = opens_cursor(self.get_many, self.connection)
         self.save = opens_cursor(self.save, self.connection)
         self.delete = opens_cursor(self.delete, self.connection)
-        self.user_repository = UserRepository(self.connection)
+        self._load_members = self._opens_lazy_cursor(self._load_members)
+        self.user_repository = UserRepository(
+            self.connection,
+            eager=eager if efforts is None else efforts,
+            totals=totals
+        )
 
     def get(self, cursor, team_id=None, name=None):
         """Get the :class:`Team` with the specified id or name.
@@ -50,16 +72,31 @@ class TeamRepository(Repository):
         except IndexError:
             return
 
-        team_id = team_data['id']
-        del team_data['id']
+        team_id = team_data.pop('id')
+        competition_id = team_data.pop('competition', None)
 
-        team = Team(**team_data)
+        team = Team.from_row(**team_data)
         team.id = team_id
-        for u in self._get_users(cursor, team):
-            team.add_user(u)
+        team.competition_id = competition_id
+        self._attach_members(cursor, team)
 
         return team
 
+    def get_many(self, cursor, team_ids):
+        """Get the teams with the given ids, in as many queries as it takes to
+        get one, however many ids there are. Return a list of the teams in
+        the order of the ids, with `None` for any id without a team.
+
+        :param team_ids: a sequence of integer team ids
+        """
+        teams = dict(
+            (r['id'], self._from_row(r))
+            for r in self._get_any(cursor, 'id', list(set(team_ids)))
+        )
+        self._attach_many_members(cursor, teams.values())
+
+        return [teams.get(team_id) for team_id in team_ids]
+
     def save(self, cursor, team):
         """Save a :class:`Team` to the repository.
 
@@ -68,20 +105,29 @@ class TeamRepository(Repository):
         if hasattr(team, 'id'):
             self._update(cursor, team)
         else:
+            competition_id = self._competition_of(team)
             try:
                 cursor.execute(
-                    'INSERT INTO %s (name) VALUES (%%s) RETURNING id' % (
+                    'INSERT INTO %s (name, competition) VALUES (%%s, %%s) '
+                    'RETURNING id' % (
                         self.table_name,
                     ),
-                    (team.name,)
+                    (team.name, competition_id)
                 )
             except psycopg2.IntegrityError:
                 raise ConstraintError('team %s exists' % team.name)
 
             team.id = cursor.fetchone()['id']
+            team.competition_id = competition_id
 
-        for user in team:
-            self.user_repository.save(user)
+        # Members that were never loaded can't have changed.
+        if loaded(team.members):
+            for user in team:
+                self.user_repository.save(user)
+
+        self._notify(
+            cursor, 'team', id=team.id, competition=self._competition_of(team)
+        )
 
     def delete(self, cursor, team):
         """Delete a :class:`Team` from the repository.
@@ -94,20 +140,129 @@ class TeamRepository(Repository):
         cursor.execute(
             'DELETE FROM %s WHERE id = %%s' % self.table_name, (team.id,)
         )
+        self._notify(
+            cursor, 'team', id=team.id, competition=self._competition_of(team)
+        )
 
     def _create(self, cursor, row):
         """Reconstitute a team from a database row.
 
         :param row: the row data as a dictionary
         """
-        team = Team(name=row['name'])
-        team.id = row['id']
+        team = self._from_row(row)
+        self._attach_members(cursor, team)
 
-        for u in self._get_users(cursor, team):
-            team.add_user(u)
+        return team
+
+    def _on(self, connection):
+        """Return a copy of this repository on another connection, which
+        loads lazy members, and its members' lazy efforts, on this one's.
+
+        :param connection: the connection
+        """
+        repository = TeamRepository(
+            connection,
+            self.competition_id,
+            eager=self.eager,
+            totals=self.totals
+        )
+        repository.user_repository = self.user_repository._on(connection)
+        repository._load_members = self._load_members
+
+        return repository
+
+    def _attach(self, cursor, team):
+        """Give a team built by :meth:`_from_row` its members.
+
+        :param team: the :class:`Team` being loaded
+        """
+        self._attach_members(cursor, team)
+
+    def _attach_many(self, cursor, teams):
+        """Give teams built by :meth:`_from_row` their members.
+
+        :param teams: a list of the :class:`Team` objects being loaded
+        """
+        self._attach_many_members(cursor, teams)
+
+    def _from_row(self, row):
+        """Build a team from a database row, without its members.
+
+        :param row: the row data as a dictionary
+        """
+        team = Team.from_row(name=row['name'])
+        team.id = row['id']
+        team.competition_id = row['competition']
 
         return team
 
+    def _attach_members(self, cursor, team):
+        """Give a loaded team its members, or, unless this repository is
+        eager, a proxy that loads them when they're first used, along with
+        their running totals if this repository loads those.
+
+        :param team: the :class:`Team` being loaded
+        """
+        if self.eager:
+            for u in self._get_users(cursor, team):
+                team.add_user(u)
+            return
+
+        team.members = LazyCollection(partial(self._load_members, team))
+        if self.totals:
+            team.effort_count, team.effort_seconds = self._get_effort_totals(
+                cursor, team
+            )
+        else:
+            team.effort_count = team.effort_seconds = None
+
+    def _attach_many_members(self, cursor, teams):
+        """Do what :meth:`_attach_members` does for many teams at once, in a
+        fixed number of queries.
+
+        :param teams: a list of the :class:`Team` objects being loaded
+        """
+        if not teams:
+            return
+
+        team_ids = [t.id for t in teams]
+        if self.eager:
+            cursor.execute(
+                'SELECT "user", team FROM %s WHERE team = ANY(%%s)' % (
+                    self.user_repository.users2teams_table_name
+                ),
+                (team_ids,)
+            )
+            memberships = cursor.fetchall()
+            users = self.user_repository.get_many(
+                [m['user'] for m in memberships]
+            )
+            by_id = dict((t.id, t) for t in teams)
+            for m, user in zip(memberships, users):
+                if user is not None:
+                    by_id[m['team']].add_user(user)
+            return
+
+        totals = {}
+        if self.totals:
+            totals = self._get_many_effort_totals(cursor, team_ids)
+        for team in teams:
+            team.members = LazyCollection(partial(self._load_members, team))
+            if self.totals:
+                team.effort_count, team.effort_seconds = totals.get(
+                    team.id, (0, 0)
+                )
+            else:
+                team.effort_count = team.effort_seconds = None
+
+    def _load_members(self, cursor, team):
+        """Load the members of a team whose members weren't loaded with it,
+        keyed by username.
+
+        :param team: the :class:`Team` to load members for
+        """
+        return dict((u.username, u) for u in self._get_users(cursor, team))
+
     def _update(self, cursor, team):
         """Update an existing team's data.
 
@@ -120,6 +275,8 @@ class TeamRepository(Repository):
                 (team.name, team.id)
             )
 
+        if not loaded(team.members):
+            return
         existing_users = set(u for u in existing)
         new_users = set(u for u in team)
 
@@ -127,6 +284,49 @@ class TeamRepository(Repository):
             self.user_repository.save(u)
             self.user_repository.set_team(u, team)
 
+    def _get_effort_totals(self, cursor, team):
+        """Get the number of efforts a team's members have in the database, and
+        their total duration in seconds.
+
+        :param team: the team to total efforts for
+        """
+        cursor.execute(
+            'SELECT count(*) AS count, '
+                'coalesce(sum(extract(epoch FROM e.duration)), 0)::float8 '
+                'AS seconds '
+                'FROM %s e JOIN %s ut ON ut."user" = e."user" '
+                'WHERE ut.team = %%s' % (
+                    self.user_repository.efforts_table_name,
+                    self.user_repository.users2teams_table_name
+                ),
+            (team.id,)
+        )
+        totals = cursor.fetchone()
+
+        return totals['count'], totals['seconds']
+
+    def _get_many_effort_totals(self, cursor, team_ids):
+        """Get the number of efforts each of many teams' members have in the
+        database, and their total duration in seconds, as a dictionary of
+        pairs by team id. Teams without efforts are left out.
+
+        :param team_ids: a list of integer team ids
+        """
+        cursor.execute(
+            'SELECT ut.team, count(*) AS count, '
+                'sum(extract(epoch FROM e.duration))::float8 AS seconds '
+                'FROM %s e JOIN %s ut ON ut."user" = e."user" '
+                'WHERE ut.team = ANY(%%s) GROUP BY ut.team' % (
+                    self.user_repository.efforts_table_name,
+                    self.user_repository.users2teams_table_name
+                ),
+            (team_ids,)
+        )
+
+        return dict(
+            (r['team'], (r['count'], r['seconds'])) for r in cursor.fetchall()
+        )
+
     def _get_users(self, cursor, team):
         """Return users associated with a team.
 
@@ -7,31 +7,101 @@
     :author: Michael Browning
 """
 
+from copy import copy
+from functools import partial, wraps
+import sys
+
 import psycopg2
 
-from .repository import Repository
+from .repository import FanOutMixin, Repository
 from ..model import User
 from ..model.effort import Effort
 from ..model.location import Location
+from ..model.columns import EffortColumns
+from ..model.lazy import LazyCollection, loaded
 from ..exceptions import ConstraintError
 from . import opens_cursor
 
 
-class UserRepository(Repository):
-    """A repository that keeps track of :class:`User` objects."""
+def aggregate_size(user):
+    """Return the approximate number of bytes held by a :class:`User`
+    aggregate, for cache accounting.
+
+    :param user: the :class:`User`
+    """
+    # The effort store accounts for its own arrays and locations.
+    return _sizeof(user) + sys.getsizeof(user.efforts)
+
+
+def _sizeof(obj):
+    """The size of an object and its instance dictionary, if it has one.
+
+    :param obj: the object to measure
+    """
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+
+    return size
+
+
+def _snapshot(user):
+    """Return a copy of a user aggregate that shares nothing mutable with it.
+    Efforts are immutable, so only their container needs copying.
+
+    :param user: the :class:`User` to copy
+    """
+    snapshot = copy(user)
+    snapshot.efforts = copy(user.efforts)
+
+    return snapshot
+
+
+class UserRepository(FanOutMixin, Repository):
+    """A repository that keeps track of :class:`User` objects.
+
+    Repositories on the app's shared connection keep loaded aggregates in the
+    shared, bounded `user_cache`, so that repeated loads of the same user
+    don't go to the database. Writes through the repository update or evict
+    the cached aggregate. The cache only ever holds private snapshots, so
+    callers are free to modify the users they get back.
+
+    By default a user's efforts are only loaded when they're first used.
+    Callers that know they need them can pass `eager=True` to have them loaded
+    along with each user. Callers that need neither the efforts nor their
+    running totals can pass `totals=False`, so that the efforts table isn't
+    read at all; the users they get are only fit for reading, and aren't
+    cached.
+    """
 
     table_name = 'users'
     efforts_table_name = 'efforts'
     locations_table_name = 'locations'
     users2teams_table_name = 'users2teams'
 
-    def __init__(self, connection=None):
-        super(UserRepository, self).__init__(connection)
-        self.get = opens_cursor(self.get, self.connection)
-        self.save = opens_cursor(self.save, self.connection)
-        self.delete = opens_cursor(self.delete, self.connection)
-        self.set_team = opens_cursor(self.set_team, self.connection)
+    def __init__(self, connection=None, competition_id=None, cache=None,
+                 eager=False, totals=True, fanout=None):
+        super(UserRepository, self).__init__(
+            connection, competition_id, fanout
+        )
+        self.eager = eager
+        self.totals = totals
+        if cache is None and self._uses_app_connection():
+            from .. import user_cache as cache
+        self.cache = cache
+        self.get = self._reads_cache(opens_cursor(self.get, self.connection))
+        self.get_many = opens_cursor(self.get_many, self.connection)
+        self.save = self._writes_cache(opens_cursor(self.save, self.connection))
+        self.delete = self._evicts_cache(
+            opens_cursor(self.delete, self.connection)
+        )
+        self.set_team = self._evicts_cache(
+            opens_cursor(self.set_team, self.connection)
+        )
         self.get_team = opens_cursor(self.get_team, self.connection)
+        self.get_teams = opens_cursor(self.get_teams, self.connection)
+        self.add_entries = opens_cursor(self.add_entries, self.connection)
+        self._load_efforts = self._opens_lazy_cursor(self._load_efforts)
 
     def get(self, cursor, username=None, user_id=None):
         """Get the :class:`User` with the specified username or id.
@@ -55,16 +125,47 @@ class UserRepository(Repository):
         except IndexError:
             return
 
-        user_id = user_data['id']
-        del user_data['id']
+        user_id = user_data.pop('id')
+        competition_id = user_data.pop('competition', None)
 
-        user = User(**user_data)
+        user = User.from_row(**user_data)
         user.id = user_id
-        for e in self._get_efforts(cursor, user):
-            user.add_effort(e)
+        user.competition_id = competition_id
+        self._attach_efforts(cursor, user)
 
         return user
 
+    def get_many(self, cursor, user_ids):
+        """Get the users with the given ids, in as many queries as it takes to
+        get one, however many ids there are. Return a list of the users in
+        the order of the ids, with `None` for any id without a user.
+
+        Users in the cache are taken from it, like :meth:`get` does, unless
+        they belong to another competition than the one the repository is
+        scoped to.
+
+        :param user_ids: a sequence of integer user ids
+        """
+        users = {}
+        if self.cache is not None:
+            for user_id in set(user_ids):
+                user = self.cache.get(('user', user_id))
+                if self._satisfied_by(user):
+                    users[user_id] = _snapshot(user)
+
+        missing = list(set(user_ids) - set(users))
+        if missing:
+            loaded_users = [
+                self._from_row(r) for r in self._get_any(cursor, 'id', missing)
+            ]
+            self._attach_many_efforts(cursor, loaded_users)
+            for user in loaded_users:
+                users[user.id] = user
+                if self.cache is not None:
+                    self._cache(user)
+
+        return [users.get(user_id) for user_id in user_ids]
+
     def save(self, cursor, user):
         """Save a :class:`User` to the repository.
 
@@ -73,10 +174,12 @@ class UserRepository(Repository):
         if hasattr(user, 'id'):
             self._update(cursor, user)
         else:
+            competition_id = self._competition_of(user)
             try:
                 cursor.execute(
-                    'INSERT INTO %s (username, first_name, last_name, email) '
-                    'VALUES (%%s, %%s, %%s, %%s) RETURNING id' % (
+                    'INSERT INTO %s '
+                    '(username, first_name, last_name, email, competition) '
+                    'VALUES (%%s, %%s, %%s, %%s, %%s) RETURNING id' % (
                         self.table_name,
                     ),
                     (
@@ -84,16 +187,20 @@ class UserRepository(Repository):
                         user.first_name,
                         user.last_name,
                         user.email,
+                        competition_id,
                     )
                 )
             except psycopg2.IntegrityError:
                 raise ConstraintError('user %s exists' % user.username)
 
             user.id = cursor.fetchone()['id']
+            user.competition_id = competition_id
 
             for e in user.efforts:
                 self._save_effort(cursor, e, user)
 
+        self._notify_user(cursor, user)
+
     def delete(self, cursor, user):
         """Delete a :class:`User` from the repository.
 
@@ -103,6 +210,7 @@ class UserRepository(Repository):
             'DELETE FROM %s WHERE id = %%s' % self.table_name, (user.id,)
         )
         self._delete_efforts(cursor, user)
+        self._notify_user(cursor, user)
 
     def set_team(self, cursor, user, team):
         """Set a user's team.
@@ -114,15 +222,54 @@ class UserRepository(Repository):
             team_id = team.id
         else:
             team_id = int(team)
+        previous = self._team_of(cursor, user)
+        if previous is None:
+            # New users don't have a team row to update yet.
+            cursor.execute(
+                'INSERT INTO %s ("user", team) VALUES (%%s, %%s)' % (
+                    self.users2teams_table_name
+                ),
+                (user.id, team_id)
+            )
+        else:
+            cursor.execute(
+                'UPDATE %s SET team = %%s WHERE "user" = %%s' % (
+                    self.users2teams_table_name
+                ),
+                (team_id, user.id)
+            )
+
+        # The team the user left has changed too.
+        keys = {'team': team_id}
+        if previous is not None and previous != team_id:
+            keys['old_team'] = previous
+        self._notify_user(cursor, user, **keys)
+
+    def get_team(self, cursor, user):
+        """Get the id of a user's team.
+
+        :param user: the user to retrieve the team of
+        """
+        return self._team_of(cursor, user)
+
+    def get_teams(self, cursor, users):
+        """Get the ids of the teams of any number of users, in one query.
+        Return a dictionary of team ids by user id, without users who aren't
+        on a team.
+
+        :param users: a sequence of users
+        """
         cursor.execute(
-            'UPDATE %s SET team = %%s WHERE "user" = %%s' % (
+            'SELECT "user", team FROM %s WHERE "user" = ANY(%%s)' % (
                 self.users2teams_table_name
             ),
-            (team_id, user.id)
+            ([u.id for u in users],)
         )
 
-    def get_team(self, cursor, user):
-        """Get the id of a user's team.
+        return dict((r['user'], r['team']) for r in cursor.fetchall())
+
+    def _team_of(self, cursor, user):
+        """Return the id of a user's team, or `None` if they aren't on one.
 
         :param user: the user to retrieve the team of
         """
@@ -132,8 +279,276 @@ class UserRepository(Repository):
             ),
             (user.id,)
         )
+        row = cursor.fetchone()
+
+        return row['team'] if row is not None else None
+
+    def add_entries(self, cursor, entries):
+        """Save a batch of efforts for any number of users, with one statement
+        for any new locations, one to look up every location and one for the
+        efforts. Efforts that are already saved are skipped, as are repeats
+        within the batch. Return a dictionary of the id, username,
+        competition and team of each user who had efforts saved.
+
+        Raise :class:`ConstraintError`, saving nothing, if any effort overlaps
+        another of its user's, saved or in the batch. The users' rows are
+        locked first, so that batches written at the same time can't each
+        miss the other's efforts.
+
+        :param entries: a list of dictionaries, each with the `user` id and
+                        the `start_time`, `duration`, `latitude` and
+                        `longitude` of an effort
+        """
+        if not entries:
+            return []
+
+        points = ','.join(
+            cursor.mogrify('(%s::float8, %s::float8)', p) for p in
+            set((e['latitude'], e['longitude']) for e in entries)
+        )
+        cursor.execute(
+            'INSERT INTO %s (latitude, longitude) '
+                'SELECT * FROM (VALUES %s) v (latitude, longitude) '
+                'WHERE NOT EXISTS (SELECT 1 FROM %s l '
+                    'WHERE l.latitude = v.latitude '
+                    'AND l.longitude = v.longitude)' % (
+                        self.locations_table_name, points,
+                        self.locations_table_name
+                    )
+        )
+        cursor.execute(
+            'SELECT l.* FROM %s l JOIN (VALUES %s) v (latitude, longitude) '
+                'ON l.latitude = v.latitude AND l.longitude = v.longitude' % (
+                    self.locations_table_name, points
+                )
+        )
+        locations = dict(
+            ((r['latitude'], r['longitude']), r['id'])
+            for r in cursor.fetchall()
+        )
+
+        efforts = {}
+        for e in entries:
+            key = (e['start_time'], e['duration'], e['user'])
+            efforts.setdefault(key, cursor.mogrify(
+                '(%s::timestamp, %s::interval, %s, %s)', (
+                    e['start_time'],
+                    e['duration'],
+                    e['user'],
+                    locations[e['latitude'], e['longitude']]
+                )
+            ))
+        values = ','.join(efforts.values())
+        self._check_entries(cursor, values, [e['user'] for e in entries])
+
+        # Efforts carry their user's competition, as in :meth:`_save_effort`.
+        cursor.execute(
+            'INSERT INTO %s '
+                '(start_time, duration, "user", location, competition) '
+                'SELECT v.*, u.competition '
+                'FROM (VALUES %s) v (start_time, duration, "user", location) '
+                'JOIN %s u ON u.id = v."user" '
+                'WHERE NOT EXISTS (SELECT 1 FROM %s e '
+                    'WHERE e.start_time = v.start_time '
+                    'AND e."user" = v."user") '
+                'RETURNING "user"' % (
+                    self.efforts_table_name, values, self.table_name,
+                    self.efforts_table_name
+                )
+        )
+        user_ids = list(set(r['user'] for r in cursor.fetchall()))
+        if not user_ids:
+            return []
+
+        cursor.execute(
+            'SELECT u.id, u.username, u.competition, ut.team '
+                'FROM %s u LEFT JOIN %s ut ON ut."user" = u.id '
+                'WHERE u.id = ANY(%%s)' % (
+                    self.table_name, self.users2teams_table_name
+                ),
+            (user_ids,)
+        )
+        users = cursor.fetchall()
+        for u in users:
+            self._notify(
+                cursor, 'user',
+                id=u['id'],
+                username=u['username'],
+                competition=u['competition'],
+                team=u['team']
+            )
+
+        return users
+
+    def _check_entries(self, cursor, values, user_ids):
+        """Lock the rows of the users a batch of efforts is for, and raise
+        :class:`ConstraintError` if any of the efforts overlaps another of its
+        user's, saved or in the batch. An effort identical to a saved one
+        isn't an overlap, since it's skipped.
+
+        :param values: the efforts, as SQL `VALUES` rows of start time,
+                       duration, user and location, without repeats
+        :param user_ids: the integer ids of the users
+        """
+        cursor.execute(
+            'SELECT id FROM %s WHERE id = ANY(%%s) ORDER BY id FOR UPDATE' % (
+                self.table_name,
+            ),
+            (list(set(user_ids)),)
+        )
+        overlaps = (
+            '%(e)s."user" = v."user" '
+            'AND %(e)s.start_time < v.start_time + v.duration '
+            'AND v.start_time < %(e)s.start_time + %(e)s.duration '
+            'AND (%(e)s.start_time, %(e)s.duration) <> '
+                '(v.start_time, v.duration)'
+        )
+        cursor.execute(
+            'WITH v (start_time, duration, "user", location) AS (VALUES %s) '
+            'SELECT v."user", v.start_time FROM v '
+                'WHERE EXISTS (SELECT 1 FROM %s e WHERE %s) '
+                'OR EXISTS (SELECT 1 FROM v w WHERE %s) '
+                'LIMIT 1' % (
+                    values, self.efforts_table_name, overlaps % {'e': 'e'},
+                    overlaps % {'e': 'w'}
+                )
+        )
+        row = cursor.fetchone()
+        if row is not None:
+            raise ConstraintError(
+                'effort at %s overlaps another of user %s' % (
+                    row['start_time'], row['user']
+                )
+            )
+
+    def _reads_cache(self, get):
+        """Wrap :meth:`get` so that cached users are returned without a query,
+        and loaded users are cached. Lookups by username are only cached for
+        repositories scoped to a competition, since usernames are only unique
+        within one.
+
+        :param get: the cursor-managed :meth:`get`
+        """
+        if self.cache is None:
+            return get
+
+        @wraps(get)
+        def wrapped(username=None, user_id=None):
+            if user_id and not username:
+                user = self.cache.get(('user', user_id))
+            elif username and not user_id and self.competition_id is not None:
+                user = self.cache.get_tagged(
+                    ('username', self.competition_id, username)
+                )
+            else:
+                return get(username=username, user_id=user_id)
+
+            if self._satisfied_by(user):
+                return _snapshot(user)
+
+            user = get(username=username, user_id=user_id)
+            if user is not None:
+                self._cache(user)
+
+            return user
+
+        return wrapped
+
+    def _satisfied_by(self, user):
+        """Return `True` if a cached user can be returned in place of loading
+        it: it must belong to the repository's competition, if it's scoped to
+        one, and a lazily loaded user doesn't satisfy an eager repository.
+
+        :param user: the cached :class:`User`, or `None`
+        """
+        if user is None:
+            return False
+        if (self.competition_id is not None and
+                user.competition_id != self.competition_id):
+            return False
+
+        return not self.eager or loaded(user.efforts)
+
+    def _writes_cache(self, save):
+        """Wrap :meth:`save` so that the saved user replaces any cached copy.
+        If the save fails, the cached copy is evicted instead, since the
+        database may have been partially written.
+
+        :param save: the cursor-managed :meth:`save`
+        """
+        if self.cache is None:
+            return save
+
+        @wraps(save)
+        def wrapped(user):
+            try:
+                result = save(user)
+            except Exception:
+                if hasattr(user, 'id'):
+                    self.cache.delete(('user', user.id))
+                raise
+            self._cache(user)
+
+            return result
 
-        return cursor.fetchone()['team']
+        return wrapped
+
+    def _evicts_cache(self, write):
+        """Wrap a write method taking a user as its first argument so that
+        the user's cached copy is evicted.
+
+        :param write: the cursor-managed write method
+        """
+        if self.cache is None:
+            return write
+
+        @wraps(write)
+        def wrapped(user, *args, **kwargs):
+            try:
+                return write(user, *args, **kwargs)
+            finally:
+                self.cache.delete(('user', user.id))
+
+        return wrapped
+
+    def _cache(self, user):
+        """Cache a snapshot of a user, findable by id and by username within
+        its competition. A user without running totals doesn't satisfy every
+        reader, so it evicts the cached copy instead.
+
+        :param user: the :class:`User` to cache
+        """
+        if user.effort_count is None:
+            self.cache.delete(('user', user.id))
+            return
+
+        self.cache.set(
+            ('user', user.id),
+            _snapshot(user),
+            tags=[('username', user.competition_id, user.username)]
+        )
+
+    def _notify_user(self, cursor, user, **keys):
+        """Announce a write to a user on the invalidation bus. The message
+        carries the user's team unless `keys` gives it, since the team's
+        total and standing change with the user's.
+
+        :param user: the written :class:`User`
+        :param keys: any further keys identifying what was written
+        """
+        if self.bus is None:
+            return
+
+        if 'team' not in keys:
+            keys['team'] = self._team_of(cursor, user)
+
+        self._notify(
+            cursor, 'user',
+            id=user.id,
+            username=user.username,
+            competition=self._competition_of(user),
+            **keys
+        )
 
     def _update(self, cursor, user):
         """Update a user's data.
@@ -157,6 +572,9 @@ class UserRepository(Repository):
                 tuple([getattr(user, field) for field in changed] + [user.id])
             )
 
+        # Efforts that were never loaded can't have changed.
+        if not loaded(user.efforts):
+            return
         for e in user.efforts - existing.efforts:
             self._save_effort(cursor, e, user)
         for e in existing.efforts - user.efforts:
@@ -167,19 +585,131 @@ class UserRepository(Repository):
 
         :param row: row data as dictionary
         """
-        user = User(
+        user = self._from_row(row)
+        self._attach_efforts(cursor, user)
+
+        return user
+
+    def _on(self, connection):
+        """Return a copy of this repository on another connection, which
+        shares its cache and loads lazy efforts on this one's.
+
+        :param connection: the connection
+        """
+        repository = UserRepository(
+            connection,
+            self.competition_id,
+            cache=self.cache,
+            eager=self.eager,
+            totals=self.totals
+        )
+        repository._load_efforts = self._load_efforts
+
+        return repository
+
+    def _attach(self, cursor, user):
+        """Give a user built by :meth:`_from_row` its efforts.
+
+        :param user: the :class:`User` being loaded
+        """
+        self._attach_efforts(cursor, user)
+
+    def _attach_many(self, cursor, users):
+        """Give users built by :meth:`_from_row` their efforts.
+
+        :param users: a list of the :class:`User` objects being loaded
+        """
+        self._attach_many_efforts(cursor, users)
+
+    def _from_row(self, row):
+        """Build a user from a database row, without its efforts.
+
+        :param row: row data as dictionary
+        """
+        user = User.from_row(
             username=row['username'],
             first_name=row['first_name'],
             last_name=row['last_name'],
             email=row['email']
         )
         user.id = row['id']
-
-        for e in self._get_efforts(cursor, user):
-            user.add_effort(e)
+        user.competition_id = row['competition']
 
         return user
 
+    def _attach_efforts(self, cursor, user):
+        """Give a loaded user its efforts, or, unless this repository is
+        eager, a proxy that loads them when they're first used, along with
+        their running totals if this repository loads those.
+
+        :param user: the :class:`User` being loaded
+        """
+        if self.eager:
+            user.add_efforts(self._get_efforts(cursor, user), check=False)
+            return
+
+        user.efforts = LazyCollection(partial(self._load_efforts, user))
+        if self.totals:
+            user.effort_count, user.effort_seconds = self._get_effort_totals(
+                cursor, user
+            )
+        else:
+            user.effort_count = user.effort_seconds = None
+
+    def _attach_many_efforts(self, cursor, users):
+        """Do what :meth:`_attach_efforts` does for many users at once, in a
+        fixed number of queries.
+
+        :param users: a list of the :class:`User` objects being loaded
+        """
+        if not users:
+            return
+
+        user_ids = [u.id for u in users]
+        if self.eager:
+            efforts = dict((user_id, []) for user_id in user_ids)
+            cursor.execute(
+                'SELECT * FROM %s WHERE "user" = ANY(%%s)' % (
+                    self.efforts_table_name
+                ),
+                (user_ids,)
+            )
+            rows = cursor.fetchall()
+            locations = self._get_locations(
+                cursor, set(r['location'] for r in rows)
+            )
+            for r in rows:
+                efforts[r['user']].append(Effort.from_row(
+                    start_time=r['start_time'],
+                    duration=r['duration'],
+                    location=locations[r['location']]
+                ))
+            for user in users:
+                user.add_efforts(efforts[user.id], check=False)
+            return
+
+        totals = {}
+        if self.totals:
+            totals = self._get_many_effort_totals(cursor, user_ids)
+        for user in users:
+            user.efforts = LazyCollection(partial(self._load_efforts, user))
+            if self.totals:
+                user.effort_count, user.effort_seconds = totals.get(
+                    user.id, (0, 0)
+                )
+            else:
+                user.effort_count = user.effort_seconds = None
+
+    def _load_efforts(self, cursor, user):
+        """Load the efforts of a user whose efforts weren't loaded with it.
+
+        :param user: the :class:`User` to load efforts for
+        """
+        efforts = EffortColumns()
+        efforts.update(self._get_efforts(cursor, user))
+
+        return efforts
+
     def _get_efforts(self, cursor, user):
         """Get the efforts associated with an existing user in the database.
 
@@ -189,9 +719,47 @@ class UserRepository(Repository):
             'SELECT * FROM %s WHERE "user" = %%s' % self.efforts_table_name,
             (user.id,)
         )
-        for e in cursor:
+        # Creating an effort reuses the cursor, so the rows are read first.
+        for e in cursor.fetchall():
             yield self._create_effort(cursor, **e)
 
+    def _get_effort_totals(self, cursor, user):
+        """Get the number of efforts an existing user has in the database, and
+        their total duration in seconds.
+
+        :param user: the :class:`User` to total efforts for
+        """
+        cursor.execute(
+            'SELECT count(*) AS count, '
+                'coalesce(sum(extract(epoch FROM duration)), 0)::float8 '
+                'AS seconds '
+                'FROM %s WHERE "user" = %%s' % self.efforts_table_name,
+            (user.id,)
+        )
+        totals = cursor.fetchone()
+
+        return totals['count'], totals['seconds']
+
+    def _get_many_effort_totals(self, cursor, user_ids):
+        """Get the number of efforts each of many users has in the database,
+        and their total duration in seconds, as a dictionary of pairs by user
+        id. Users without efforts are left out.
+
+        :param user_ids: a list of integer user ids
+        """
+        cursor.execute(
+            'SELECT "user", count(*) AS count, '
+                'sum(extract(epoch FROM duration))::float8 AS seconds '
+                'FROM %s WHERE "user" = ANY(%%s) GROUP BY "user"' % (
+                    self.efforts_table_name
+                ),
+            (user_ids,)
+        )
+
+        return dict(
+            (r['user'], (r['count'], r['seconds'])) for r in cursor.fetchall()
+        )
+
     def _delete_efforts(self, cursor, user):
         """Delete the efforts associated with an existing user in the database.
 
@@ -205,7 +773,7 @@ class UserRepository(Repository):
     def _create_effort(self, cursor, **kwargs):
         """Create an effort from a database row."""
         location = self._get_location(cursor, kwargs['location'])
-        effort = Effort(
+        effort = Effort.from_row(
             start_time=kwargs['start_time'],
             duration=kwargs['duration'],
             location=location
@@ -222,19 +790,28 @@ class UserRepository(Repository):
         if not hasattr(effort.location, 'id'):
             self._save_location(cursor, effort.location)
 
-        try:
-            cursor.execute(
-                'INSERT INTO %s (start_time, duration, "user", location) '
-                    'VALUES (%%s, %%s, %%s, %%s)' % (self.efforts_table_name),
-                (
-                    effort.start_time,
-                    effort.duration,
-                    user.id,
-                    effort.location.id
-                )
+        # Efforts carry their user's competition so that leaderboard queries
+        # can be answered from a single competition's rows. An effort already
+        # saved, by a retried write, is skipped rather than failing, which
+        # would abort the transaction.
+        cursor.execute(
+            'INSERT INTO %s '
+                '(start_time, duration, "user", location, competition) '
+                'SELECT %%s, %%s, %%s, %%s, %%s '
+                'WHERE NOT EXISTS (SELECT 1 FROM %s '
+                    'WHERE start_time = %%s AND "user" = %%s)' % (
+                        self.efforts_table_name, self.efforts_table_name
+                    ),
+            (
+                effort.start_time,
+                effort.duration,
+                user.id,
+                effort.location.id,
+                self._competition_of(user),
+                effort.start_time,
+                user.id,
             )
-        except psycopg2.IntegrityError:
-            pass
+        )
 
     def _delete_effort(self, cursor, effort, user):
         """Delete an effort associated with a given user from the database.
@@ -263,27 +840,57 @@ class UserRepository(Repository):
         location_data = cursor.fetchone()
         if location_data:
             del location_data['id']
-            location = Location(**location_data)
+            location = Location.from_row(**location_data)
             location.id = location_id
 
             return location
 
+    def _get_locations(self, cursor, location_ids):
+        """Get many locations from the database at once, as a dictionary by
+        id.
+
+        :param location_ids: an iterable of location ids
+        """
+        location_ids = list(location_ids)
+        if not location_ids:
+            return {}
+
+        cursor.execute(
+            'SELECT * FROM %s WHERE id = ANY(%%s)' % self.locations_table_name,
+            (location_ids,)
+        )
+        locations = {}
+        for r in cursor.fetchall():
+            location_id = r.pop('id')
+            location = Location.from_row(**r)
+            location.id = location_id
+            locations[location_id] = location
+
+        return locations
+
     def _save_location(self, cursor, location):
         """Insert a location into the database and update its id.
 
         :param location: the :class:`Location` to be inserted
         """
-        try:
-            cursor.execute(
-                'INSERT INTO %s (latitude, longitude) VALUES (%%s, %%s) '
-                    'RETURNING id' % self.locations_table_name,
-                (location.latitude, location.longitude)
-            )
-        except psycopg2.IntegrityError:
+        # A location that's already saved is looked up instead; failing to
+        # insert it would abort the transaction.
+        cursor.execute(
+            'INSERT INTO %s (latitude, longitude) SELECT %%s, %%s '
+                'WHERE NOT EXISTS (SELECT 1 FROM %s '
+                    'WHERE latitude = %%s AND longitude = %%s) '
+                'RETURNING id' % (
+                    self.locations_table_name, self.locations_table_name
+                ),
+            (location.latitude, location.longitude) * 2
+        )
+        row = cursor.fetchone()
+        if row is None:
             cursor.execute(
                 'SELECT id FROM %s WHERE latitude = %%s AND longitude = %%s' % (
                     self.locations_table_name
                 ),
                 (location.latitude, location.longitude)
             )
-        location.id = cursor.fetchone()['id']
+            row = cursor.fetchone()
+        location.id = row['id']
@@ -0,0 +1,133 @@
+"""
+    leaderboard.pool
+    =================
+
+    Implements :class:`ConnectionPool`, a bounded pool of database
+    connections shared by threads or greenlets.
+
+    :author: Michael Browning
+"""
+
+from collections import deque
+from threading import Condition
+import os
+import time
+
+from .exceptions import PoolTimeoutError
+
+
+class ConnectionPool(object):
+    """Lends out up to `size` database connections at a time.
+
+    :meth:`get` takes an idle connection, or opens a new one if fewer than
+    `size` are open, and otherwise waits up to `timeout` seconds for one to
+    be returned with :meth:`put` before raising a :class:`PoolTimeoutError`.
+    Connections are opened only when first needed, and those closed while
+    they were lent out aren't taken back, so a failed connection is replaced
+    with a new one. After a fork, connections opened by the parent are
+    forgotten rather than shared.
+
+    :param connect: a callable returning a new database connection
+    :param size: the most connections open at once
+    :param timeout: how long :meth:`get` waits for a connection, in seconds,
+                    or `None` for as long as it takes
+    """
+
+    def __init__(self, connect, size=10, timeout=None):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._idle = deque()
+        self._cond = Condition()
+        self._pid = os.getpid()
+        self._opened = 0
+        self._busy = 0
+        self._waiting = 0
+        self._waits = 0
+        self._timeouts = 0
+
+    def get(self):
+        """Take a connection from the pool. It must be given back with
+        :meth:`put`.
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = deque()
+                self._opened = self._busy = self._waiting = 0
+
+            if not self._idle and self._opened >= self.size:
+                self._wait()
+            self._busy += 1
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self._cond:
+                self._busy -= 1
+                self._opened -= 1
+                self._cond.notify()
+            raise
+
+    def put(self, connection):
+        """Give a connection taken with :meth:`get` back to the pool, unless
+        it's been closed.
+
+        :param connection: the connection
+        """
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            self._busy -= 1
+            if connection.closed:
+                self._opened -= 1
+            else:
+                self._idle.append(connection)
+            self._cond.notify()
+
+    def close(self):
+        """Close every idle connection. The pool opens new ones as they're
+        needed.
+        """
+        with self._cond:
+            idle, self._idle = self._idle, deque()
+            self._opened -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def stats(self):
+        """Return a dictionary of the pool's counters, for monitoring."""
+        with self._cond:
+            return {
+                'size': self.size,
+                'connections': self._opened,
+                'busy': self._busy,
+                'waiting': self._waiting,
+                'waits': self._waits,
+                'timeouts': self._timeouts,
+            }
+
+    def _wait(self):
+        """Wait, holding the condition, until a connection is idle or another
+        may be opened.
+        """
+        self._waiting += 1
+        self._waits += 1
+        try:
+            deadline = None
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while not self._idle and self._opened >= self.size:
+                remaining = 1.0
+                if deadline is not None:
+                    remaining = min(remaining, deadline - time.time())
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(
+                            'no database connection is free'
+                        )
+                self._cond.wait(remaining)
+        finally:
+            self._waiting -= 1
@@ -0,0 +1,215 @@
+"""
+    leaderboard.profiling
+    ======================
+
+    Implements :class:`ProfilingMiddleware`, which runs chosen requests under
+    cProfile, and :class:`ProfileStore`, which keeps what they spent their
+    time in.
+
+    :author: Michael Browning
+"""
+
+from collections import deque
+from functools import partial
+from itertools import count
+from threading import Lock
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import time
+
+from werkzeug.wsgi import ClosingIterator
+
+from .cooperative import patched
+
+# The header that has a request profiled, when it carries the admin token,
+# and its key in the WSGI environment.
+PROFILE_HEADER = 'X-Profile'
+PROFILE_ENVIRON = 'HTTP_X_PROFILE'
+
+
+class ProfilingMiddleware(object):
+    """WSGI middleware that profiles a request if it carries the
+    `X-Profile` header with the admin `token`, or, failing that, with a
+    chance of `sample_percent` in a hundred, and adds its statistics to a
+    :class:`ProfileStore`.
+
+    The profile covers the app producing the response and the response
+    being iterated over, so the time a streamed response spends loading
+    data while it's sent is counted too. Requests that aren't profiled only
+    cost a header lookup and a random number; with neither a token nor a
+    sample rate the middleware shouldn't be installed at all.
+
+    A profile records everything its thread runs while it's enabled. Under
+    gevent a process's requests are all served on one thread, so the profile
+    of one would take in whichever others ran while it waited. No request
+    is profiled in a process gevent has patched.
+
+    :param app: the WSGI application to wrap
+    :param store: the :class:`ProfileStore` to add profiles to
+    :param token: the admin token, or `None` to only profile samples
+    :param sample_percent: the percentage of requests profiled at random
+    :param random: a callable returning a random number in [0, 1)
+    :param patched: a callable returning `True` if gevent has patched the
+                    process
+    """
+
+    def __init__(self, app, store, token=None, sample_percent=0.0,
+                 random=random.random, patched=patched):
+        self.app = app
+        self.store = store
+        self.token = token
+        self.sample_rate = sample_percent / 100.0
+        self.random = random
+        self.patched = patched
+
+    def __call__(self, environ, start_response):
+        if not self._chosen(environ):
+            return self.app(environ, start_response)
+
+        profile = cProfile.Profile()
+        done = partial(self._done, profile, environ, time.time())
+        try:
+            app_iter = profile.runcall(self.app, environ, start_response)
+        except Exception:
+            done()
+            raise
+
+        callbacks = [done]
+        if hasattr(app_iter, 'close'):
+            callbacks.insert(0, app_iter.close)
+
+        return ClosingIterator(self._iterate(profile, app_iter), callbacks)
+
+    def _chosen(self, environ):
+        """Return `True` if a request should be profiled.
+
+        :param environ: the request's WSGI environment
+        """
+        token = environ.get(PROFILE_ENVIRON)
+        chosen = (
+            token is not None and self.token is not None and
+            hmac.compare_digest(token, self.token)
+        ) or (self.sample_rate > 0 and self.random() < self.sample_rate)
+
+        return chosen and not self.patched()
+
+    def _iterate(self, profile, app_iter):
+        """Yield the chunks of a response, profiling the code producing each.
+
+        :param profile: the request's :class:`cProfile.Profile`
+        :param app_iter: the app's response iterable
+        """
+        chunks = iter(app_iter)
+        while True:
+            profile.enable()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            finally:
+                profile.disable()
+            yield chunk
+
+    def _done(self, profile, environ, started):
+        """Store a finished request's profile.
+
+        :param profile: the request's :class:`cProfile.Profile`
+        :param environ: the request's WSGI environment
+        :param started: when the request started, in seconds since the epoch
+        """
+        path = environ.get('PATH_INFO', '')
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        self.store.add(
+            profile, environ.get('REQUEST_METHOD'), path, started,
+            time.time() - started
+        )
+
+
+class ProfileStore(object):
+    """Keeps the `keep` latest request profiles of this process, each
+    reduced to the `top` functions with the most cumulative time, and if a
+    `directory` is given also writes each one there as a JSON file named for
+    its id, where the profiles of every process can be found.
+
+    :param keep: how many profiles are kept in memory
+    :param top: how many functions are kept of each profile
+    :param directory: a directory to write profiles to, or `None`
+    """
+
+    def __init__(self, keep=50, top=30, directory=None):
+        self.top = top
+        self.directory = directory
+        self._profiles = deque(maxlen=keep)
+        self._ids = count(1)
+        self._lock = Lock()
+
+    def add(self, profile, method, path, started, duration):
+        """Add a request's profile.
+
+        :param profile: the :class:`cProfile.Profile`
+        :param method: the request method
+        :param path: the request path and query
+        :param started: when the request started, in seconds since the epoch
+        :param duration: how long it took, in seconds
+        """
+        stats = pstats.Stats(profile).stats
+        functions = sorted(
+            stats.items(), key=lambda item: item[1][3], reverse=True
+        )[:self.top]
+        record = {
+            'id': '%d-%d' % (os.getpid(), next(self._ids)),
+            'method': method,
+            'path': path,
+            'started': started,
+            'duration': duration,
+            'functions': [
+                {
+                    'function': '%s:%d(%s)' % key,
+                    'calls': calls,
+                    'primitive_calls': primitive,
+                    'total_time': total,
+                    'cumulative_time': cumulative,
+                }
+                for key, (primitive, calls, total, cumulative, _) in functions
+            ],
+        }
+
+        with self._lock:
+            self._profiles.appendleft(record)
+        if self.directory is not None:
+            self._write(record)
+
+    def list(self):
+        """Return the kept profiles, newest first, without their functions."""
+        with self._lock:
+            return [
+                dict((k, v) for k, v in p.items() if k != 'functions')
+                for p in self._profiles
+            ]
+
+    def get(self, profile_id):
+        """Return a kept profile by id, or `None` if it isn't kept.
+
+        :param profile_id: the profile's id
+        """
+        with self._lock:
+            for p in self._profiles:
+                if p['id'] == profile_id:
+                    return p
+
+    def _write(self, record):
+        """Write a profile to the directory.
+
+        :param record: the profile dictionary
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '%s.json' % record['id'])
+        with open(path + '.tmp', 'wb') as f:
+            json.dump(record, f)
+        os.rename(path + '.tmp', path)
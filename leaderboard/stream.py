@@ -0,0 +1,482 @@
+"""
+    leaderboard.stream
+    ===================
+
+    Implements :class:`Publisher`, which fans leaderboard events out to the
+    clients streaming them as server-sent events, and :class:`Standings`,
+    which turns writes into those events.
+
+    :author: Michael Browning
+"""
+
+from binascii import hexlify
+from collections import deque
+from threading import Condition, Lock, Thread
+from Queue import Queue, Full, Empty
+import json
+import logging
+import os
+import time
+
+import psycopg2
+
+from .persistence import AnalyticsRepository
+
+logger = logging.getLogger(__name__)
+
+
+class Publisher(object):
+    """Delivers events to every subscriber in this process.
+
+    Each event is published to a scope, the id of the competition whose
+    leaderboard it concerns or `None` for the leaderboard spanning every
+    competition, and is delivered to the subscribers to that scope. Every
+    subscriber has a queue of at most `queue_size` events; a subscriber that
+    falls that far behind is cut off once it has read what's queued, rather
+    than being allowed to hold ever more events in memory.
+
+    The last `history` events are kept, so that a client reconnecting with
+    the id of the last event it saw gets the events it missed. A client that
+    has missed more than that, or whose id was issued by another process, is
+    sent a `reset` event instead, telling it to reload the leaderboard.
+
+    :param history: how many of the latest events are kept for resuming
+    :param queue_size: the most events that may wait for one subscriber
+    :param heartbeat: how long a stream may be idle before a comment is sent
+                      to keep it open, in seconds
+    :param retry: how long clients should wait before reconnecting, in
+                  milliseconds
+    """
+
+    def __init__(self, history=256, queue_size=64, heartbeat=15.0,
+                 retry=3000):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self._history = deque(maxlen=history)
+        self._subscriptions = set()
+        self._lock = Lock()
+        self._token = None
+        self._pid = None
+        self._last = 0
+        self._published = 0
+        self._cut_off = 0
+
+    @property
+    def token(self):
+        """A token identifying this process in the ids of the events it
+        publishes. It's regenerated after a fork, along with the history, so
+        that every worker's ids are its own.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._token = hexlify(os.urandom(4))
+            self._history.clear()
+            self._last = 0
+
+        return self._token
+
+    @property
+    def scopes(self):
+        """The set of scopes that have subscribers."""
+        with self._lock:
+            return set(s.scope for s in self._subscriptions)
+
+    def publish(self, kind, data, scope=None):
+        """Deliver an event to the subscribers to its scope.
+
+        :param kind: the event name, e.g. `'user'`
+        :param data: the JSON-serializable event data
+        :param scope: the id of the competition the event concerns, or `None`
+        """
+        with self._lock:
+            token = self.token
+            self._last += 1
+            event = ('%s-%d' % (token, self._last), kind, data, scope)
+            self._history.append((self._last, event))
+            self._published += 1
+            for subscription in self._subscriptions:
+                subscription.put(event)
+
+    def subscribe(self, scope=None, last_event_id=None):
+        """Return a new :class:`Subscription` to a scope's events.
+
+        :param scope: the id of a competition, or `None` for every event
+                      concerning the leaderboard spanning them all
+        :param last_event_id: the id of the last event the client saw, if
+                              it's reconnecting
+        """
+        subscription = Subscription(self, scope)
+        with self._lock:
+            if last_event_id is not None:
+                missed = self._since(last_event_id)
+                if missed is None:
+                    subscription.put((
+                        '%s-%d' % (self.token, self._last), 'reset', {}, scope
+                    ))
+                else:
+                    for event in missed:
+                        subscription.put(event)
+            self._subscriptions.add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Stop delivering events to a subscription.
+
+        :param subscription: the :class:`Subscription`
+        """
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            if subscription.cut_off:
+                self._cut_off += 1
+
+    def stats(self):
+        """Return a dictionary of the publisher's counters, for monitoring."""
+        with self._lock:
+            return {
+                'subscribers': len(self._subscriptions),
+                'published': self._published,
+                'cut_off': self._cut_off,
+                'history': len(self._history),
+            }
+
+    def _since(self, last_event_id):
+        """Return the list of events published after the one with an id, or
+        `None` if they aren't all in the history.
+
+        :param last_event_id: the id of the last event the client saw
+        """
+        token, _, number = last_event_id.rpartition('-')
+        try:
+            number = int(number)
+        except ValueError:
+            return None
+        if token != self.token or number > self._last:
+            return None
+
+        oldest = self._history[0][0] if self._history else self._last + 1
+        if number < oldest - 1:
+            return None
+
+        return [event for n, event in self._history if n > number]
+
+
+class Subscription(object):
+    """A client's stream of the events published to a scope.
+
+    :param publisher: the :class:`Publisher` it's subscribed to
+    :param scope: the id of a competition, or `None`
+    """
+
+    def __init__(self, publisher, scope):
+        self.publisher = publisher
+        self.scope = scope
+        self.cut_off = False
+        self._queue = Queue(publisher.queue_size)
+
+    def put(self, event):
+        """Queue an event for the client if it's in this subscription's scope,
+        cutting the client off if it has fallen too far behind.
+
+        :param event: an event id, name, data and scope tuple
+        """
+        if event[3] != self.scope or self.cut_off:
+            return
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self.cut_off = True
+
+    def events(self):
+        """Yield the client's stream in the `text/event-stream` format, until
+        it's closed or cut off. A client that was cut off reconnects and
+        resumes from the last event it read.
+        """
+        try:
+            yield 'retry: %d\n\n' % self.publisher.retry
+            while True:
+                try:
+                    if self.cut_off:
+                        event = self._queue.get_nowait()
+                    else:
+                        event = self._queue.get(
+                            timeout=self.publisher.heartbeat
+                        )
+                except Empty:
+                    if self.cut_off:
+                        return
+                    yield ': heartbeat\n\n'
+                    continue
+
+                event_id, kind, data, _ = event
+                yield 'id: %s\nevent: %s\ndata: %s\n\n' % (
+                    event_id, kind, json.dumps(data)
+                )
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the subscription."""
+        self.publisher.unsubscribe(self)
+
+
+class Standings(object):
+    """Keeps the total effort of every user and team in memory, for each
+    scope that has subscribers, so that a write can be published as the
+    change it made to the written user's and team's totals and ranks.
+
+    :meth:`track` loads a scope's totals when its first client subscribes.
+    :meth:`record` is then called after each write, on any thread, and only
+    queues it; a worker thread of the process's own reads the new totals of
+    the written user and team from the database, on a connection of its own,
+    and publishes a `user` and a `team` event for those that changed. Each
+    event's data is the `id`, `competition`, `effort` and `rank` of the user
+    or team, and its `delta` and `previous_rank`; a user's also has its
+    `team`. Ranks are computed as in the leaderboards, and a scope's totals
+    are dropped once it has no subscribers left.
+
+    If `max_pending` writes are waiting, they're dropped along with every
+    scope's totals, which are reloaded with the next write.
+
+    :param publisher: the :class:`Publisher` to publish events to
+    :param connect: a callable returning a new database connection
+    :param max_pending: the most writes that may wait to be published
+    """
+
+    def __init__(self, publisher, connect, max_pending=1000):
+        self.publisher = publisher
+        self.connect = connect
+        self.max_pending = max_pending
+        self._totals = {}
+        self._connection = None
+        self._lock = Lock()
+        self._pending = deque()
+        self._cond = Condition()
+        self._busy = False
+        self._missed = False
+        self._closing = False
+        self._thread = None
+        self._pid = None
+
+    def track(self, scope):
+        """Load a scope's totals, if they aren't already loaded.
+
+        :param scope: the id of a competition, or `None`
+        """
+        with self._lock:
+            if scope in self._totals:
+                return
+            try:
+                self._load(scope)
+            except psycopg2.Error:
+                logger.exception('loading the standings of %r failed', scope)
+                self._reset()
+
+    def record(self, competition_id, user_id, team_id=None):
+        """Queue the changes a write made to a user's and its team's totals to
+        be published.
+
+        :param competition_id: the integer id of the user's competition
+        :param user_id: the integer id of the written user
+        :param team_id: the integer id of the user's team, if known
+        """
+        # With no subscribers and nothing to drop, there's nothing to do.
+        if not self._totals and not self.publisher.scopes:
+            return
+
+        with self._cond:
+            self._start()
+            if len(self._pending) >= self.max_pending:
+                self._pending.clear()
+                self._missed = True
+            self._pending.append((competition_id, user_id, team_id))
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Wait until every write recorded so far has been published. Return
+        `False` if `timeout` seconds pass first.
+
+        :param timeout: the longest to wait, in seconds, or `None` for as long
+                        as it takes
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = 1.0
+                if deadline is not None:
+                    remaining = min(remaining, deadline - time.time())
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+
+            return True
+
+    def clear(self):
+        """Drop every scope's totals, for when writes may have been missed.
+        They're reloaded with the next write.
+        """
+        with self._lock:
+            self._totals.clear()
+
+    def close(self, timeout=None):
+        """Drop every queued write, stop the worker thread, and drop every
+        scope's totals and close the connection. The next write starts a new
+        worker.
+
+        :param timeout: the longest to wait for the worker to finish the
+                        write it's publishing, in seconds, or `None` for as
+                        long as it takes
+        """
+        with self._cond:
+            self._pending.clear()
+            self._closing = True
+            self._cond.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join(timeout)
+        with self._lock:
+            self._reset()
+
+    def _start(self):
+        """Start this process's worker thread, if it isn't running. Called
+        with the condition held.
+        """
+        self._closing = False
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+
+        # A forked process inherits the queue, but not the thread.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._busy = False
+        self._thread = Thread(target=self._run, name='standings')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """Publish queued writes, one at a time, until closed."""
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    # Waiting without a timeout would block signals.
+                    self._cond.wait(1.0)
+                if self._closing:
+                    return
+                record = self._pending.popleft()
+                missed, self._missed = self._missed, False
+                self._busy = True
+
+            try:
+                if missed:
+                    self.clear()
+                self._publish(*record)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _publish(self, competition_id, user_id, team_id):
+        """Publish the changes a write made to a user's and its team's totals.
+
+        :param competition_id: the integer id of the user's competition
+        :param user_id: the integer id of the written user
+        :param team_id: the integer id of the user's team, or `None`
+        """
+        scopes = self.publisher.scopes
+        with self._lock:
+            for scope in list(self._totals):
+                if scope not in scopes:
+                    del self._totals[scope]
+            try:
+                for scope in (competition_id, None):
+                    if scope not in scopes:
+                        continue
+                    if scope not in self._totals:
+                        # Without a baseline there's no change to publish.
+                        self._load(scope)
+                        continue
+                    self._update(scope, competition_id, user_id, team_id)
+            except psycopg2.Error:
+                logger.exception(
+                    'updating the standings of user %s failed', user_id
+                )
+                self._reset()
+
+    def _load(self, scope):
+        """Load a scope's totals.
+
+        :param scope: the id of a competition, or `None`
+        """
+        repository = self._repository(scope)
+        self._totals[scope] = {
+            'user': repository.user_totals(),
+            'team': repository.team_totals(),
+        }
+
+    def _update(self, scope, competition_id, user_id, team_id):
+        """Read a written user's and team's totals in a scope, and publish
+        the changes.
+
+        :param scope: the id of a competition, or `None`
+        :param competition_id: the integer id of the user's competition
+        :param user_id: the integer id of the user
+        :param team_id: the integer id of the user's team, or `None`
+        """
+        repository = self._repository(scope)
+        changed = [('user', user_id, repository.user_totals([user_id]))]
+        if team_id is not None:
+            changed.append(('team', team_id, repository.team_totals([team_id])))
+
+        for kind, id, read in changed:
+            totals = self._totals[scope][kind]
+            previous = totals.get(id, 0.0)
+            current = read.get(id, 0.0)
+            previous_rank = _rank(totals, previous)
+            totals[id] = current
+            if current == previous:
+                continue
+
+            data = {
+                'id': id,
+                'competition': competition_id,
+                'effort': int(current),
+                'delta': int(current) - int(previous),
+                'rank': _rank(totals, current),
+                'previous_rank': previous_rank,
+            }
+            if kind == 'user':
+                data['team'] = team_id
+            self.publisher.publish(kind, data, scope)
+
+    def _repository(self, scope):
+        """An :class:`AnalyticsRepository` for a scope, on the connection.
+
+        :param scope: the id of a competition, or `None`
+        """
+        if self._connection is None:
+            self._connection = self.connect()
+
+        return AnalyticsRepository(self._connection, scope)
+
+    def _reset(self):
+        """Drop every scope's totals and close the connection, so that the
+        next write reloads them on a new one.
+        """
+        self._totals.clear()
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+
+def _rank(totals, total):
+    """The rank of a total among others: one more than the number of strictly
+    greater totals, so that ties share a rank.
+
+    :param totals: a dictionary of totals
+    :param total: the total to rank
+    """
+    return 1 + sum(1 for t in totals.values() if t > total)
@@ -0,0 +1,80 @@
+"""
+    leaderboard.versions
+    =====================
+
+    Implements in-process data version counters, which let views answer
+    conditional requests without loading or serializing anything.
+
+    :author: Michael Browning
+"""
+
+from binascii import hexlify
+from collections import namedtuple
+from datetime import datetime
+from threading import Lock
+import os
+import time
+
+GLOBAL = 'global'
+
+Version = namedtuple('Version', ['etag', 'modified'])
+
+
+class VersionTable(object):
+    """Tracks a monotonically increasing data version. Every write bumps the
+    version and records it against the keys it touched, e.g.
+    `('user', user_id)`, `('team', team_id)`, `('competition', id)` and
+    :data:`GLOBAL`, so that each key's version only changes when its data
+    does.
+
+    Versions are only meaningful within this process, so every ETag carries a
+    token unique to it; a client presenting another process's ETag simply
+    gets a full response. The modification times are only informative: they
+    are whole seconds and carry no token, so they aren't used to validate
+    requests.
+
+    :param clock: a callable returning the current time in seconds
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.token = hexlify(os.urandom(4))
+        self.started = clock()
+        self._version = 0
+        self._versions = {}
+        self._lock = Lock()
+
+    def bump(self, *keys):
+        """Advance the data version and record it against the given keys,
+        which always include :data:`GLOBAL`.
+
+        :param keys: the keys whose data was written
+        """
+        with self._lock:
+            self._version += 1
+            stamp = (self._version, self.clock())
+            self._versions[GLOBAL] = stamp
+            for key in keys:
+                self._versions[key] = stamp
+
+    def reset(self):
+        """Forget every recorded version and start handing out ETags with a
+        new token, so that no ETag issued so far will match again. This is
+        for when writes may have gone unrecorded.
+        """
+        with self._lock:
+            self.token = hexlify(os.urandom(4))
+            self.started = self.clock()
+            self._versions.clear()
+
+    def get(self, key):
+        """Return the current :class:`Version` of a key.
+
+        :param key: the key to look up
+        """
+        version, modified = self._versions.get(key, (0, self.started))
+
+        return Version(
+            '%s-%d' % (self.token, version),
+            datetime.utcfromtimestamp(int(modified))
+        )
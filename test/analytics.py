@@ -0,0 +1,109 @@
+"""
+    test.analytics
+    ==============
+
+    Test the vectorized analytics path.
+
+    :author: Michael Browning
+"""
+
+import unittest
+from datetime import datetime
+
+from leaderboard import analytics
+from leaderboard.analytics import EffortArrays, top_k, ranks
+from leaderboard.model.columns import to_epoch
+
+
+class TestAnalyticsRepository(object):
+    """Serves fixed rows in place of :class:`AnalyticsRepository`."""
+
+    def __init__(self, rows, user_ids, team_ids, memberships):
+        self.rows = rows
+        self.user_ids = lambda: user_ids
+        self.team_ids = lambda: team_ids
+        self.memberships = lambda: memberships
+
+    def effort_batches(self):
+        yield self.rows[:2]
+        yield self.rows[2:]
+
+
+@unittest.skipIf(analytics.numpy is None, 'NumPy is not installed')
+class EffortArraysTest(unittest.TestCase):
+    """Test :class:`leaderboard.analytics.EffortArrays`"""
+
+    def setUp(self):
+        day = lambda d: to_epoch(datetime(2013, 1, d))
+        rows = [
+            (1, day(1), 100, 1),
+            (2, day(1), 300, 1),
+            (1, day(2), 50, 2),
+            (3, day(3), 300, 1),
+            (1, day(4), 200, 2),
+        ]
+        self.efforts = EffortArrays.load(TestAnalyticsRepository(
+            rows,
+            user_ids=[1, 2, 3, 4],
+            team_ids=[1, 2, 3],
+            memberships=[(1, 1), (2, 2), (3, 2), (4, 1)]
+        ))
+
+    def test_load(self):
+        """Test that :meth:`EffortArrays.load` reads every batch of efforts"""
+        self.assertEqual(len(self.efforts), 5)
+        self.assertEqual(list(self.efforts.users), [1, 2, 1, 3, 1])
+
+    def test_user_totals(self):
+        """Test that :meth:`EffortArrays.user_totals` totals every user's
+        efforts, including users without any
+        """
+        ids, totals = self.efforts.user_totals()
+
+        self.assertEqual(list(ids), [1, 2, 3, 4])
+        self.assertEqual(list(totals), [350, 300, 300, 0])
+
+    def test_team_totals(self):
+        """Test that :meth:`EffortArrays.team_totals` totals every team's
+        members' efforts, including teams without members
+        """
+        ids, totals = self.efforts.team_totals()
+
+        self.assertEqual(list(ids), [1, 2, 3])
+        self.assertEqual(list(totals), [350, 600, 0])
+
+    def test_windowed_totals(self):
+        """Test that totals can be limited to efforts starting in a window"""
+        ids, totals = self.efforts.user_totals(
+            start=datetime(2013, 1, 2), end=datetime(2013, 1, 4)
+        )
+        self.assertEqual(list(totals), [50, 0, 300, 0])
+
+        ids, totals = self.efforts.team_totals(start=datetime(2013, 1, 3))
+        self.assertEqual(list(totals), [200, 300, 0])
+
+    def test_top_k(self):
+        """Test that :func:`top_k` returns the largest totals in order, with
+        ties broken by id
+        """
+        ids, totals = self.efforts.user_totals()
+
+        top_ids, top_totals = top_k(ids, totals, 2)
+        self.assertEqual(list(top_ids), [1, 2])
+        self.assertEqual(list(top_totals), [350, 300])
+
+        top_ids, top_totals = top_k(ids, totals, 10)
+        self.assertEqual(list(top_ids), [1, 2, 3, 4])
+        self.assertEqual(len(top_k(ids, totals, 0)[0]), 0)
+
+    def test_ranks(self):
+        """Test that :func:`ranks` ranks the largest total first, with equal
+        totals sharing a rank
+        """
+        ids, totals = self.efforts.user_totals()
+
+        self.assertEqual(list(ranks(totals)), [1, 2, 2, 4])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
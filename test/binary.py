@@ -0,0 +1,95 @@
+"""
+    test.binary
+    ===========
+
+    Test the binary response encoding.
+
+    :author: Michael Browning
+"""
+
+import json
+import unittest
+
+from leaderboard import binary
+
+
+class BinaryTest(unittest.TestCase):
+    """Test :mod:`leaderboard.binary`"""
+
+    def setUp(self):
+        self.obj = {
+            'name': 'Red Team',
+            'members': [
+                {
+                    'username': 'dude',
+                    'efforts': [
+                        {
+                            'start_time': '2013-01-01T12:30:15',
+                            'duration': 5400,
+                            'location': {'latitude': 41.5, 'longitude': -73.5},
+                        },
+                    ],
+                },
+                {'username': u'caf\xe9', 'efforts': []},
+            ],
+            'error': False,
+            'active': True,
+            'missing': None,
+            'offsets': (-1, 0, 2 ** 40),
+        }
+
+    def test_round_trip(self):
+        """Test that decoding an encoding gives what decoding the object's JSON
+        would
+        """
+        self.assertEqual(
+            binary.decode(binary.encode(self.obj)),
+            json.loads(json.dumps(self.obj))
+        )
+
+    def test_keys_sent_once(self):
+        """Test that repeated keys are sent once, in the key table"""
+        data = binary.encode([{'username': i} for i in range(100)])
+
+        self.assertEqual(data.count('username'), 1)
+        self.assertEqual(
+            binary.decode(data), [{'username': i} for i in range(100)]
+        )
+
+    def test_times_sent_as_integers(self):
+        """Test that time strings are sent as integers, unless they wouldn't
+        come back out the same
+        """
+        data = binary.encode('2013-01-01T12:30:15')
+        self.assertEqual(data[len(binary.MAGIC) + 1], 'E')
+        self.assertEqual(binary.decode(data), '2013-01-01T12:30:15')
+
+        for value in ('2013-13-01T12:30:15', '2013-01-01T12:30:15Z'):
+            data = binary.encode(value)
+            self.assertEqual(data[len(binary.MAGIC) + 1], 'S')
+            self.assertEqual(binary.decode(data), value)
+
+    def test_smaller_than_json(self):
+        """Test that a listing encodes smaller than it does as JSON"""
+        listing = [self.obj] * 50
+
+        self.assertLess(
+            len(binary.encode(listing)), len(json.dumps(listing)) / 2
+        )
+
+    def test_rejects_invalid_data(self):
+        """Test that invalid encodings raise :class:`ValueError`"""
+        data = binary.encode(self.obj)
+
+        self.assertRaises(ValueError, binary.decode, 'not binary')
+        self.assertRaises(ValueError, binary.decode, data[:-1])
+        self.assertRaises(ValueError, binary.decode, data + 'N')
+
+    def test_rejects_unserializable_values(self):
+        """Test that values JSON couldn't hold raise :class:`TypeError`"""
+        self.assertRaises(TypeError, binary.encode, {'set': set()})
+        self.assertRaises(TypeError, binary.encode, {1: 'one'})
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,203 @@
+"""
+    test.cache
+    ==========
+
+    Test the in-process caches, data versions and their invalidation.
+
+    :author: Michael Browning
+"""
+
+import json
+import unittest
+
+from leaderboard.cache import LRUCache
+from leaderboard.versions import VersionTable, GLOBAL
+from leaderboard.invalidation import InvalidationBus, CHANNEL
+
+
+class TestClock(object):
+    """A manually advanced clock."""
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LRUCacheTest(unittest.TestCase):
+    """Test :class:`leaderboard.cache.LRUCache`"""
+
+    def setUp(self):
+        self.clock = TestClock()
+        self.cache = LRUCache(2, ttl=10, clock=self.clock)
+
+    def test_get_returns_cached_value(self):
+        """Test that :meth:`LRUCache.get` returns what was set and counts hits
+        and misses
+        """
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_evicts_least_recently_used(self):
+        """Test that :class:`LRUCache` evicts the least recently used entry
+        once full
+        """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        """Test that :class:`LRUCache` entries expire after the ttl"""
+        self.cache.set('a', 1)
+        self.clock.now = 9
+        self.assertEqual(self.cache.get('a'), 1)
+        self.clock.now = 10
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_by_tag(self):
+        """Test that :meth:`LRUCache.invalidate` removes only tagged entries"""
+        self.cache.set('a', 1, tags=['x'])
+        self.cache.set('b', 2, tags=['y'])
+        self.cache.invalidate('x', 'z')
+
+        self.assertNotIn('a', self.cache)
+        self.assertIn('b', self.cache)
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    def test_get_tagged(self):
+        """Test that :meth:`LRUCache.get_tagged` finds entries by tag"""
+        self.cache.set('a', 1, tags=['x'])
+
+        self.assertEqual(self.cache.get_tagged('x'), 1)
+        self.assertEqual(self.cache.get_tagged('y'), None)
+
+    def test_evicts_to_stay_under_max_bytes(self):
+        """Test that :class:`LRUCache` evicts entries to stay under its byte
+        limit
+        """
+        cache = LRUCache(10, max_bytes=10, sizeof=len)
+        cache.set('a', 'x' * 4)
+        cache.set('b', 'x' * 4)
+        self.assertEqual(cache.bytes, 8)
+
+        cache.set('c', 'x' * 4)
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.bytes, 8)
+
+        cache.delete('b')
+        self.assertEqual(cache.stats()['bytes'], 4)
+
+    def test_reset_replaces_tags(self):
+        """Test that setting an existing key drops its old tags"""
+        self.cache.set('a', 1, tags=['x'])
+        self.cache.set('a', 2, tags=['y'])
+        self.cache.invalidate('x')
+
+        self.assertEqual(self.cache.get('a'), 2)
+
+
+class VersionTableTest(unittest.TestCase):
+    """Test :class:`leaderboard.versions.VersionTable`"""
+
+    def setUp(self):
+        self.clock = TestClock()
+        self.versions = VersionTable(clock=self.clock)
+
+    def test_bump_changes_only_touched_keys(self):
+        """Test that :meth:`VersionTable.bump` only changes the versions of the
+        written keys and the global version
+        """
+        user = self.versions.get(('user', 1))
+        other = self.versions.get(('user', 2))
+        everything = self.versions.get(GLOBAL)
+
+        self.clock.now = 5
+        self.versions.bump(('user', 1))
+
+        self.assertNotEqual(self.versions.get(('user', 1)), user)
+        self.assertEqual(self.versions.get(('user', 2)), other)
+        self.assertNotEqual(self.versions.get(GLOBAL), everything)
+        self.assertEqual(
+            self.versions.get(('user', 1)).etag,
+            self.versions.get(GLOBAL).etag
+        )
+
+    def test_etags_unique_to_table(self):
+        """Test that two tables never hand out the same ETag"""
+        self.assertNotEqual(
+            self.versions.get(GLOBAL).etag,
+            VersionTable(clock=self.clock).get(GLOBAL).etag
+        )
+
+
+class InvalidationBusTest(unittest.TestCase):
+    """Test :class:`leaderboard.invalidation.InvalidationBus`"""
+
+    def setUp(self):
+        self.clock = TestClock()
+        self.bus = InvalidationBus(None, clock=self.clock)
+        self.messages = []
+        self.bus.subscribe(self.messages.append)
+
+    def test_notify(self):
+        """Test that :meth:`InvalidationBus.notify` sends the keys on the
+        writer's cursor
+        """
+        class TestCursor(object):
+            def execute(cursor, query, params=None):
+                self.assertEqual(query, 'SELECT pg_notify(%s, %s)')
+                self.assertEqual(params[0], CHANNEL)
+                cursor.message = json.loads(params[1])
+
+        cursor = TestCursor()
+        self.bus.notify(cursor, 'user', id=1)
+
+        self.assertEqual(cursor.message['kind'], 'user')
+        self.assertEqual(cursor.message['id'], 1)
+        self.assertEqual(cursor.message['origin'], self.bus.origin)
+
+    def test_dispatch_records_lag(self):
+        """Test that :meth:`InvalidationBus.dispatch` delivers other processes'
+        messages and records their lag
+        """
+        self.clock.now = 12
+        self.bus.dispatch(json.dumps(
+            {'kind': 'user', 'id': 1, 'origin': 'other', 'time': 10}
+        ))
+
+        self.assertEqual(self.messages[0]['id'], 1)
+        stats = self.bus.stats()
+        self.assertEqual(stats['received'], 1)
+        self.assertEqual(stats['lag_last'], 2)
+        self.assertEqual(stats['lag_max'], 2)
+
+    def test_dispatch_skips_own_messages(self):
+        """Test that :meth:`InvalidationBus.dispatch` ignores this process's
+        own messages and malformed payloads
+        """
+        self.bus.dispatch(json.dumps(
+            {'kind': 'user', 'id': 1, 'origin': self.bus.origin, 'time': 0}
+        ))
+        self.bus.dispatch('not json')
+
+        self.assertEqual(self.messages, [])
+        self.assertEqual(self.bus.stats()['received'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
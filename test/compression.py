@@ -0,0 +1,224 @@
+"""
+    test.compression
+    ================
+
+    Test the response compression middleware.
+
+    :author: Michael Browning
+"""
+
+import unittest
+import zlib
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from leaderboard.cache import LRUCache
+from leaderboard.compression import CompressionMiddleware
+
+BODY = '{"teams": [%s]}' % ', '.join(['{"name": "Red Team"}'] * 200)
+
+
+class TestApp(object):
+    """A WSGI app serving a fixed JSON body, which counts how much of it is
+    read and whether it's closed.
+
+    :param body: the body
+    :param chunk_size: the size of the chunks the body is served in
+    :param headers: headers to send on top of the content type
+    :param streamed: whether to leave out the `Content-Length`
+    """
+
+    def __init__(self, body=BODY, chunk_size=100, headers=(), streamed=False,
+                 status='200 OK'):
+        self.body = body
+        self.chunk_size = chunk_size
+        self.headers = [('Content-Type', 'application/json')] + list(headers)
+        if not streamed:
+            self.headers.append(('Content-Length', str(len(body))))
+        self.status = status
+        self.read = 0
+        self.closed = 0
+
+    def __call__(self, environ, start_response):
+        start_response(self.status, list(self.headers))
+
+        return TestAppIter(self)
+
+
+class TestAppIter(object):
+
+    def __init__(self, app):
+        self.app = app
+
+    def __iter__(self):
+        body = self.app.body
+        for i in xrange(0, len(body), self.app.chunk_size):
+            self.app.read += 1
+            yield body[i:i + self.app.chunk_size]
+
+    def close(self):
+        self.app.closed += 1
+
+
+def get(middleware, accept_encoding='gzip, deflate', method='GET',
+        if_none_match=None):
+    """Request a path from the middleware, returning the response."""
+    client = Client(middleware, BaseResponse)
+    headers = []
+    if accept_encoding is not None:
+        headers.append(('Accept-Encoding', accept_encoding))
+    if if_none_match is not None:
+        headers.append(('If-None-Match', if_none_match))
+
+    return client.open(
+        '/teams?x=1', method=method, headers=headers, buffered=True
+    )
+
+
+class CompressionMiddlewareTest(unittest.TestCase):
+    """Test :class:`leaderboard.compression.CompressionMiddleware`"""
+
+    def test_compresses_large_responses(self):
+        """Test that responses over the threshold are gzipped for clients that
+        accept it, with their compressed length
+        """
+        app = TestApp(headers=[('Vary', 'Accept')])
+        response = get(CompressionMiddleware(app, min_size=1024))
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept, Accept-Encoding')
+        self.assertEqual(
+            int(response.headers['Content-Length']), len(response.data)
+        )
+        self.assertLess(len(response.data), len(BODY) / 10)
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS), BODY
+        )
+        self.assertEqual(app.closed, 1)
+
+    def test_negotiates_encoding(self):
+        """Test that the encoding is the accepted one of highest quality,
+        explicit qualities override wildcards, and gzip wins ties
+        """
+        middleware = CompressionMiddleware(TestApp())
+
+        response = get(middleware, 'deflate')
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), BODY)
+
+        response = get(middleware, 'gzip;q=0, *;q=0.5')
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(
+            get(middleware, '*').headers['Content-Encoding'], 'gzip'
+        )
+
+        for accept_encoding in (None, 'identity', 'gzip;q=0, deflate;q=0'):
+            response = get(middleware, accept_encoding)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.data, BODY)
+
+    def test_leaves_small_and_other_responses(self):
+        """Test that responses under the threshold, to HEAD requests, with
+        errors or of other types are passed through
+        """
+        small = TestApp(body='{"error": false}')
+        self.assertEqual(
+            get(CompressionMiddleware(small)).data, '{"error": false}'
+        )
+        self.assertEqual(small.closed, 1)
+
+        streamed = TestApp(body='{"error": false}', streamed=True)
+        response = get(CompressionMiddleware(streamed))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, '{"error": false}')
+
+        for app in (
+            TestApp(status='404 NOT FOUND'),
+            TestApp(headers=[('Content-Type', 'text/html')]),
+        ):
+            app.headers = app.headers[-2:]
+            response = get(CompressionMiddleware(app))
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data, BODY)
+
+        response = get(CompressionMiddleware(TestApp()), method='HEAD')
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_compresses_streamed_responses(self):
+        """Test that responses without a length are compressed as they're
+        streamed, once the threshold is reached
+        """
+        app = TestApp(streamed=True)
+        middleware = CompressionMiddleware(app, min_size=1024)
+        response = get(middleware)
+
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertEqual(
+            zlib.decompress(response.data, 16 + zlib.MAX_WBITS), BODY
+        )
+        self.assertEqual(app.closed, 1)
+
+        environ = {
+            'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'
+        }
+        body = middleware(environ, lambda status, headers: None)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        first = decompressor.decompress(next(iter(body)))
+        # The first compressed chunk is flushed as soon as it's made.
+        self.assertEqual(first, BODY[:len(first)])
+        self.assertGreaterEqual(len(first), 1024)
+        body.close()
+        self.assertEqual(app.closed, 2)
+
+    def test_caches_versioned_responses(self):
+        """Test that compressed responses with an ETag are cached by request,
+        version, type and encoding, and served without reading the body
+        """
+        for streamed in (False, True):
+            app = TestApp(headers=[('ETag', '"v1"')], streamed=streamed)
+            middleware = CompressionMiddleware(app, cache=LRUCache(10))
+
+            first = get(middleware)
+            read = app.read
+            second = get(middleware)
+
+            self.assertEqual(second.data, first.data)
+            self.assertEqual(
+                int(second.headers['Content-Length']), len(second.data)
+            )
+            self.assertEqual(app.read, read)
+            self.assertEqual(app.closed, 2)
+
+            self.assertEqual(
+                zlib.decompress(get(middleware, 'deflate').data), BODY
+            )
+            app.headers[1] = ('ETag', '"v2"')
+            get(middleware)
+            self.assertGreater(app.read, read)
+
+    def test_weakens_etags(self):
+        """Test that compressed responses and the `304`s answering them carry
+        weak ETags, and others keep their strong ones
+        """
+        app = TestApp(headers=[('ETag', '"v1"')])
+        middleware = CompressionMiddleware(app)
+
+        self.assertEqual(get(middleware).headers['ETag'], 'W/"v1"')
+        self.assertEqual(get(middleware, None).headers['ETag'], '"v1"')
+
+        app.status = '304 Not Modified'
+        app.body = ''
+        for if_none_match, etag in (
+            ('W/"v1"', 'W/"v1"'),
+            ('"v1"', '"v1"'),
+            ('W/"v0", "v1"', '"v1"'),
+        ):
+            response = get(middleware, if_none_match=if_none_match)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.headers['ETag'], etag)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,163 @@
+"""
+    test.cooperative
+    ================
+
+    Test cooperative serving.
+
+    :author: Michael Browning
+"""
+
+import unittest
+
+from flask import Flask, Response
+import psycopg2
+from psycopg2 import extensions
+
+from leaderboard import cooperative
+from leaderboard.cooperative import RequestConnections, wait_callback
+
+
+class TestConnection(object):
+    """A connection that records its rollbacks, and polls through a script of
+    states.
+    """
+
+    def __init__(self, states=()):
+        self.closed = 0
+        self.rollbacks = 0
+        self.states = list(states)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+    def poll(self):
+        return self.states.pop(0)
+
+    def fileno(self):
+        return 3
+
+
+class TestPool(object):
+    """Lends out new :class:`TestConnection` objects, recording those given
+    back.
+    """
+
+    def __init__(self):
+        self.lent = []
+        self.returned = []
+
+    def get(self):
+        self.lent.append(TestConnection())
+        return self.lent[-1]
+
+    def put(self, connection):
+        self.returned.append(connection)
+
+
+class RequestConnectionsTest(unittest.TestCase):
+    """Test :class:`leaderboard.cooperative.RequestConnections`"""
+
+    def setUp(self):
+        self.pool = TestPool()
+        self.connections = RequestConnections(self.pool)
+        app = Flask(__name__)
+        self.connections.init_app(app)
+
+        @app.route('/none')
+        def none():
+            return 'none'
+
+        @app.route('/twice')
+        def twice():
+            first = self.connections.get()
+            self.assertTrue(self.connections.lent(first))
+            self.assertTrue(self.connections.get() is first)
+            return 'twice'
+
+        @app.route('/stream')
+        def stream():
+            connection = self.connections.get()
+
+            def chunks():
+                yield 'open' if connection not in self.pool.returned else ''
+            return Response(chunks())
+
+        @app.route('/error')
+        def error():
+            self.connections.get()
+            raise ValueError('error')
+
+        self.app = app.test_client()
+
+    def test_lends_one_connection_per_request(self):
+        """Test that a request is lent one connection, which is rolled back
+        and given back when the request ends
+        """
+        self.app.get('/twice')
+
+        self.assertEqual(self.pool.returned, self.pool.lent)
+        self.assertEqual(len(self.pool.lent), 1)
+        self.assertEqual(self.pool.lent[0].rollbacks, 1)
+
+    def test_only_lends_when_asked(self):
+        """Test that a request that doesn't use the database isn't lent a
+        connection
+        """
+        self.app.get('/none')
+
+        self.assertEqual(self.pool.lent, [])
+
+    def test_streams_keep_their_connection(self):
+        """Test that a streamed response's connection is only given back once
+        the response is closed
+        """
+        response = self.app.get('/stream')
+
+        self.assertEqual(self.pool.returned, [])
+        self.assertEqual(response.data, 'open')
+        response.close()
+        self.assertEqual(self.pool.returned, self.pool.lent)
+
+    def test_gives_back_connections_after_errors(self):
+        """Test that a request that fails gives its connection back"""
+        self.app.application.testing = False
+        self.app.get('/error')
+
+        self.assertEqual(self.pool.returned, self.pool.lent)
+
+
+@unittest.skipIf(cooperative.monkey is None, 'gevent is not installed')
+class WaitCallbackTest(unittest.TestCase):
+    """Test :func:`leaderboard.cooperative.wait_callback`"""
+
+    def setUp(self):
+        self.waits = []
+        for name in ('wait_read', 'wait_write'):
+            self.addCleanup(
+                setattr, cooperative, name, getattr(cooperative, name)
+            )
+        cooperative.wait_read = lambda fd, timeout: self.waits.append('read')
+        cooperative.wait_write = lambda fd, timeout: self.waits.append('write')
+
+    def test_waits_until_ready(self):
+        """Test that the callback waits on the socket until the connection is
+        ready
+        """
+        wait_callback(TestConnection([
+            extensions.POLL_WRITE, extensions.POLL_READ, extensions.POLL_OK
+        ]))
+
+        self.assertEqual(self.waits, ['write', 'read'])
+
+    def test_bad_states(self):
+        """Test that an unknown poll state raises"""
+        self.assertRaises(
+            psycopg2.OperationalError, wait_callback, TestConnection([-1])
+        )
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
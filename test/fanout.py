@@ -0,0 +1,104 @@
+"""
+    test.fanout
+    ===========
+
+    Test the concurrent running of loads.
+
+    :author: Michael Browning
+"""
+
+from threading import Event, Lock
+import time
+import unittest
+
+from leaderboard.fanout import FanOut
+
+
+class TestConnection(object):
+    """A connection that can be closed, as a failed load might."""
+
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+class FanOutTest(unittest.TestCase):
+    """Test :class:`leaderboard.fanout.FanOut`"""
+
+    def setUp(self):
+        self.connections = []
+
+        def connect():
+            self.connections.append(TestConnection())
+            return self.connections[-1]
+
+        self.fanout = FanOut(connect, parallelism=3)
+        self.addCleanup(self.fanout.close)
+
+    def test_preserves_order(self):
+        """Test that results come back in the order of the items, however
+        long each load takes
+        """
+        def load(connection, n):
+            time.sleep(0.01 * (5 - n))
+            return n * 10
+
+        self.assertEqual(self.fanout.map(load, range(5)), [0, 10, 20, 30, 40])
+
+    def test_bounds_parallelism(self):
+        """Test that no more than `parallelism` loads run at once, and that
+        each has a connection of its own
+        """
+        lock = Lock()
+        running = set()
+        seen = []
+        release = Event()
+
+        def load(connection, n):
+            with lock:
+                self.assertNotIn(connection, running)
+                running.add(connection)
+                seen.append(len(running))
+                if len(running) == 3:
+                    release.set()
+            release.wait(5)
+            time.sleep(0.01)
+            with lock:
+                running.remove(connection)
+
+        self.fanout.map(load, range(9))
+        self.assertEqual(max(seen), 3)
+        self.assertEqual(len(self.connections), 3)
+        self.assertEqual(self.fanout.stats()['loads'], 9)
+        self.assertEqual(self.fanout.stats()['busy'], 0)
+
+    def test_raises_and_replaces_closed_connections(self):
+        """Test that a failed load's exception is raised, and its connection
+        replaced if the failure closed it
+        """
+        def load(connection, n):
+            if n == 1:
+                connection.close()
+                raise ValueError(n)
+            return n
+
+        self.assertRaises(ValueError, self.fanout.map, load, [1])
+        self.assertEqual(self.fanout.stats()['connections'], 0)
+        self.assertEqual(self.fanout.map(load, [0]), [0])
+        self.assertEqual(len(self.connections), 2)
+
+    def test_close(self):
+        """Test that :meth:`FanOut.close` closes the idle connections, and
+        that the pool may be used again afterwards
+        """
+        self.fanout.map(lambda connection, n: n, [0])
+        self.fanout.close()
+
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(self.fanout.map(lambda connection, n: n, [1]), [1])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -9,12 +9,17 @@
 
 import unittest
 import os
+import shutil
 import subprocess
+import tempfile
 import json
 import time
+import zlib
 
 import leaderboard
-from leaderboard import app, get_connection
+from leaderboard import app, get_connection, analytics, binary
+from leaderboard.model.model import Entity
+from leaderboard.persistence import UserRepository, TeamRepository
 
 PSQL_ROOT = '/Applications/Postgres.app/Contents/MacOS/bin'
 
@@ -23,8 +28,9 @@ class FunctionalTestCase(unittest.TestCase):
     """Test app functionality from user perspective."""
 
     def setUp(self):
-        # We have to close our global connection so that dropdb will work.
+        # We have to close our global connections so that dropdb will work.
         leaderboard.connection.close()
+        leaderboard.standings.close()
 
         DEVNULL = open(os.devnull, 'wb')
         with open('test/schema') as f:
@@ -38,6 +44,13 @@ class FunctionalTestCase(unittest.TestCase):
 
         # Now we reopen it so that the repositories can use it again.
         leaderboard.connection = get_connection()
+        # Nothing cached against the previous test's data is valid any more.
+        leaderboard.response_cache.clear()
+        leaderboard.user_cache.clear()
+        leaderboard.compression_cache.clear()
+        leaderboard.idempotency_cache.clear()
+        # Every total read should agree with the efforts it summarizes.
+        Entity.check_totals = True
 
         app.config['TESTING'] = True
         self.app = app.test_client()
@@ -49,6 +62,202 @@ class FunctionalTestCase(unittest.TestCase):
         self.assertIn('teams', data)
         self.assertEquals(len(data['teams']), 3)
 
+    def test_get_teams_streamed(self):
+        """Test /teams streams a listing that spans several batches, and
+        matches the teams' own pages
+        """
+        TeamRepository.batch_size = 2
+        try:
+            response = self.app.get('/teams')
+        finally:
+            del TeamRepository.batch_size
+
+        self.assertTrue(response.is_streamed)
+        teams = dict(
+            (t['name'], t) for t in json.loads(response.data)['teams']
+        )
+        self.assertEqual(len(teams), 3)
+        for team_id in (1, 2, 3):
+            team = json.loads(self.app.get('/teams/%i' % team_id).data)
+            self.assertEqual(teams[team['name']], team)
+
+    def test_binary_responses(self):
+        """Test that clients asking for the binary encoding get the same data
+        as JSON clients, streamed listings included
+        """
+        headers = [('Accept', binary.MIMETYPE)]
+        for url in ('/teams', '/teams/1', '/users/1', '/users/best'):
+            response = self.app.get(url, headers=headers)
+            self.assertEqual(response.headers['Content-Type'], binary.MIMETYPE)
+            self.assertIn('Accept', response.headers['Vary'].split(', '))
+
+            data = json.loads(self.app.get(url).data)
+            self.assertEqual(binary.decode(response.data), data)
+
+    def test_binary_etags(self):
+        """Test that the binary and JSON representations of the same data
+        have different ETags, each only matching its own representation
+        """
+        headers = [('Accept', binary.MIMETYPE)]
+        binary_etag = self.app.get('/users/3', headers=headers).headers['ETag']
+        json_etag = self.app.get('/users/3').headers['ETag']
+        self.assertNotEqual(binary_etag, json_etag)
+
+        for accept, etag, status in (
+            (binary.MIMETYPE, binary_etag, 304),
+            (binary.MIMETYPE, json_etag, 200),
+            ('application/json', json_etag, 304),
+            ('application/json', binary_etag, 200),
+        ):
+            response = self.app.get('/users/3', headers=[
+                ('Accept', accept), ('If-None-Match', etag)
+            ])
+            self.assertEqual(response.status_code, status)
+
+    def test_compressed_responses(self):
+        """Test that clients accepting gzip get listings compressed, from the
+        compression cache until the data changes, with weak ETags they can
+        revalidate
+        """
+        # The test data is too small to be worth compressing otherwise.
+        self.addCleanup(
+            setattr, app.wsgi_app, 'min_size', app.wsgi_app.min_size
+        )
+        app.wsgi_app.min_size = 0
+
+        headers = [('Accept-Encoding', 'gzip')]
+        for url in ('/teams', '/users/best'):
+            response = self.app.get(url, headers=headers)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(
+                json.loads(
+                    zlib.decompress(response.data, 16 + zlib.MAX_WBITS)
+                ),
+                json.loads(self.app.get(url).data)
+            )
+
+            cached = self.app.get(url, headers=headers)
+            self.assertEqual(cached.data, response.data)
+
+            etag = response.headers['ETag']
+            self.assertTrue(etag.startswith('W/'))
+            not_modified = self.app.get(
+                url, headers=headers + [('If-None-Match', etag)]
+            )
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.headers['ETag'], etag)
+
+        stats = leaderboard.compression_cache.stats()
+        self.assertEqual(stats['hits'], 2)
+
+    def test_sparse_fieldsets(self):
+        """Test that ?fields= and ?include= limit what's returned, and that
+        requests not asking for efforts don't read them
+        """
+        def fail(*args):
+            raise AssertionError('efforts read')
+
+        full = json.loads(self.app.get('/teams/1').data)
+
+        for cls, name in (
+            (UserRepository, '_get_efforts'),
+            (UserRepository, '_get_effort_totals'),
+            (TeamRepository, '_get_effort_totals'),
+        ):
+            self.addCleanup(setattr, cls, name, getattr(cls, name))
+            setattr(cls, name, fail)
+
+        data = json.loads(self.app.get('/teams/1?include=members').data)
+        self.assertEqual(
+            data['members'],
+            [
+                dict((k, v) for k, v in m.items() if k != 'efforts')
+                for m in full['members']
+            ]
+        )
+
+        data = json.loads(self.app.get('/teams?fields=name').data)
+        self.assertEqual(
+            sorted(data['teams']),
+            [
+                {'name': 'Blue Team'},
+                {'name': 'Red Team'},
+                {'name': 'Yellow Team'},
+            ]
+        )
+
+        data = json.loads(
+            self.app.get('/users/3?fields=username,first_name').data
+        )
+        self.assertEqual(set(data), set(['username', 'first_name']))
+
+        data = json.loads(self.app.get('/users/3?fields=username,bogus').data)
+        self.assertTrue(data['error'])
+        self.assertIn('bogus', data['message'])
+
+    def test_best_listings_in_fixed_queries(self):
+        """Test that /users/best and /teams/best read the totals and teams of
+        all their users and teams at once, rather than one at a time
+        """
+        def fail(*args):
+            raise AssertionError('read one at a time')
+
+        users = json.loads(self.app.get('/users/best').data)
+        teams = json.loads(self.app.get('/teams/best').data)
+        leaderboard.response_cache.clear()
+
+        for cls, name in (
+            (UserRepository, '_get_efforts'),
+            (UserRepository, '_get_effort_totals'),
+            (UserRepository, '_team_of'),
+            (TeamRepository, '_get_effort_totals'),
+        ):
+            self.addCleanup(setattr, cls, name, getattr(cls, name))
+            setattr(cls, name, fail)
+
+        self.assertEqual(json.loads(self.app.get('/users/best').data), users)
+        self.assertEqual(json.loads(self.app.get('/teams/best').data), teams)
+
+    def test_sparse_fieldsets_with_totals(self):
+        """Test that ?fields= may ask for the totals"""
+        full = json.loads(self.app.get('/teams/best').data)
+        efforts = dict((t['name'], t['effort']) for t in full['teams'])
+
+        data = json.loads(self.app.get('/teams?fields=name,effort').data)
+        self.assertEqual(
+            dict((t['name'], t['effort']) for t in data['teams']), efforts
+        )
+
+        data = json.loads(
+            self.app.get('/teams/1?fields=name,effort,username,members').data
+        )
+        self.assertEqual(
+            data['effort'], sum(m['effort'] for m in data['members'])
+        )
+
+    def test_multi_get(self):
+        """Test that ?ids= gets the named users and teams in order, marking
+        the missing ones, and gets each the same as alone
+        """
+        data = json.loads(self.app.get('/users?ids=4,999,3').data)
+        self.assertEqual([u['id'] for u in data['users']], [4, 999, 3])
+        self.assertEqual(data['users'][1], {'id': 999, 'missing': True})
+        alone = json.loads(self.app.get('/users/3').data)
+        self.assertEqual(data['users'][2], dict(alone, id=3))
+
+        data = json.loads(self.app.get('/teams?ids=2,99,1').data)
+        self.assertEqual([t['id'] for t in data['teams']], [2, 99, 1])
+        self.assertTrue(data['teams'][1]['missing'])
+        alone = json.loads(self.app.get('/teams/1').data)
+        self.assertEqual(data['teams'][2], dict(alone, id=1))
+
+        data = json.loads(self.app.get('/teams?ids=1&fields=name,effort').data)
+        self.assertEqual(sorted(data['teams'][0]), ['effort', 'id', 'name'])
+
+        for ids in ('', 'a', ','.join(['1'] * 101)):
+            data = json.loads(self.app.get('/users?ids=%s' % ids).data)
+            self.assertTrue(data['error'])
+
     def test_get_team(self):
         """Test /teams/<int> endpoint"""
         team_id = 1
@@ -99,6 +308,303 @@ class FunctionalTestCase(unittest.TestCase):
         self.assertEqual(len(data['efforts']), 1)
         self.assertEqual(list(data['efforts'])[0], effort)
 
+    def test_save_effort_already_saved(self):
+        """Test that entries posted at a saved location reuse it, and that
+        saving an effort that's already saved skips it without aborting the
+        transaction
+        """
+        from leaderboard.persistence import UserRepository
+
+        for user_id in (3, 4):
+            response = json.loads(self.app.post(
+                '/users/%i' % user_id,
+                content_type='application/json',
+                data=json.dumps({
+                    'start_time': '2013-06-01T09:00:00',
+                    'duration': 600,
+                    'user': user_id,
+                    'latitude': 41.5,
+                    'longitude': 71.5,
+                })
+            ).data)
+            self.assertFalse(response['error'])
+
+        connection = get_connection()
+        self.addCleanup(connection.close)
+        repository = UserRepository(connection)
+        user = repository.get(user_id=3)
+        cursor = connection.cursor()
+        repository._save_effort(cursor, list(user.efforts)[0], user)
+        cursor.execute('SELECT count(*) FROM efforts WHERE "user" = 3')
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_get_user_efforts(self):
+        """Test that /users/<int> GET returns every one of the user's efforts
+        """
+        from datetime import datetime, timedelta
+        from leaderboard.helpers import DATETIME_FORMAT
+
+        user_id = 3
+        for hours in range(3):
+            self.app.post(
+                '/users/%i' % user_id,
+                content_type='application/json',
+                data=json.dumps({
+                    'start_time': datetime.strftime(
+                        datetime(2013, 1, 1) + timedelta(hours=hours),
+                        DATETIME_FORMAT
+                    ),
+                    'duration': 1000,
+                    'user': user_id,
+                    'latitude': 41.5 + hours,
+                    'longitude': 71.5,
+                })
+            )
+
+        data = json.loads(self.app.get('/users/%i' % user_id).data)
+        self.assertEqual(len(data['efforts']), 3)
+
+    def test_request_connections(self):
+        """Test that requests lent connections of their own read and write as
+        with the shared one, and give them back
+        """
+        from leaderboard.cooperative import RequestConnections
+        from leaderboard.pool import ConnectionPool
+
+        def get(url):
+            # Servers close responses once they're sent, and streamed ones
+            # only give their connections back then.
+            response = self.app.get(url)
+            data = response.data
+            response.close()
+            return data
+
+        urls = ('/users/3', '/teams', '/teams/1', '/users/best', '/teams/best')
+        expected = [get(url) for url in urls]
+
+        pool = ConnectionPool(get_connection, size=2)
+        self.addCleanup(pool.close)
+        connections = RequestConnections(pool)
+        connections.init_app(app)
+        self.addCleanup(setattr, leaderboard, 'request_connections', None)
+        leaderboard.request_connections = connections
+        leaderboard.response_cache.clear()
+        leaderboard.user_cache.clear()
+
+        self.assertEqual([get(url) for url in urls], expected)
+        response = json.loads(self.app.post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps({
+                'username': 'lent',
+                'first_name': 'Lent',
+                'last_name': 'Connection',
+                'email': 'lent@example.com',
+                'team': 1,
+            })
+        ).data)
+        self.assertFalse(response['error'])
+        self.assertEqual(
+            json.loads(get('/users/%d' % response['id']))['username'], 'lent'
+        )
+        self.assertEqual(pool.stats()['busy'], 0)
+        self.assertTrue(pool.stats()['connections'] > 0)
+
+    def test_fanout(self):
+        """Test that loading teams' members and users' efforts on a fan-out
+        gives the same listings, and lazy collections that load afterwards
+        """
+        from leaderboard import actions
+        from leaderboard.fanout import FanOut
+
+        expected = [
+            self.app.get(url).data
+            for url in ('/teams', '/teams/best', '/users/best')
+        ]
+
+        fanout = FanOut(get_connection, parallelism=3)
+        self.addCleanup(fanout.close)
+        self.addCleanup(setattr, actions, 'fanout', actions.fanout)
+        actions.fanout = fanout
+        leaderboard.response_cache.clear()
+        leaderboard.user_cache.clear()
+
+        self.assertEqual(
+            [
+                self.app.get(url).data
+                for url in ('/teams', '/teams/best', '/users/best')
+            ],
+            expected
+        )
+        self.assertTrue(fanout.stats()['loads'] > 0)
+
+        teams = actions.get_teams(eager=False)
+        fanout.close()
+        self.assertEqual(
+            [len(t.members) for t in teams],
+            [len(t.members) for t in actions.get_teams(eager=True)]
+        )
+
+    def test_leaderboard_stream(self):
+        """Test that /leaderboard/stream sends the changes an entry makes to
+        its user's and team's standing as server-sent events
+        """
+        response = self.app.get('/leaderboard/stream?competition=1')
+        self.addCleanup(response.close)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        stream = iter(response.response)
+        self.assertTrue(next(stream).startswith('retry: '))
+
+        self.app.post(
+            '/users/3',
+            content_type='application/json',
+            data=json.dumps({
+                'start_time': '2013-06-01T09:00:00',
+                'duration': 600,
+                'user': 3,
+                'latitude': 16.5,
+                'longitude': 17.5,
+            })
+        )
+
+        events = []
+        for message in (next(stream), next(stream)):
+            lines = dict(l.split(': ', 1) for l in message.strip().split('\n'))
+            events.append((lines['event'], json.loads(lines['data'])))
+        (user_event, user), (team_event, team) = events
+        self.assertEqual((user_event, team_event), ('user', 'team'))
+        self.assertEqual((user['id'], user['delta']), (3, 600))
+        self.assertEqual((team['id'], team['delta']), (user['team'], 600))
+
+    def test_add_entry_write_behind(self):
+        """Test that with write-behind ingestion running, /users/<int> POST
+        acknowledges entries before saving them, and that they're saved, in
+        batches, and shown once they are
+        """
+        from leaderboard import actions
+        from leaderboard.ingest import WriteBehindQueue
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        queue = WriteBehindQueue(directory, get_connection)
+        queue.start(actions.write_entries)
+        self.addCleanup(queue.close, 5)
+        self.addCleanup(setattr, actions, 'entry_queue', actions.entry_queue)
+        actions.entry_queue = queue
+
+        before = json.loads(self.app.get('/users/3').data)
+        entries = [
+            (3, '2013-06-01T09:00:00', 3600, 12.5, 13.5),
+            (3, '2013-06-02T09:00:00', 1800, 14.5, 15.5),
+            (4, '2013-06-01T09:00:00', 600, 12.5, 13.5),
+        ]
+        for user_id, start_time, duration, latitude, longitude in entries:
+            response = json.loads(self.app.post(
+                '/users/%i' % user_id,
+                content_type='application/json',
+                data=json.dumps({
+                    'start_time': start_time,
+                    'duration': duration,
+                    'user': user_id,
+                    'latitude': latitude,
+                    'longitude': longitude,
+                })
+            ).data)
+            self.assertFalse(response['error'])
+            self.assertTrue(response['queued'])
+
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(queue.stats()['written'], 3)
+
+        after = json.loads(self.app.get('/users/3').data)
+        self.assertEqual(len(after['efforts']), len(before['efforts']) + 2)
+        self.assertIn(
+            {
+                u'start_time': u'2013-06-02T09:00:00',
+                u'duration': 1800,
+                u'location': {u'latitude': 14.5, u'longitude': 15.5},
+            },
+            after['efforts']
+        )
+        data = json.loads(self.app.get('/users/4?fields=effort').data)
+        self.assertEqual(data['effort'], 600)
+
+    def test_write_behind_rejects_overlaps(self):
+        """Test that entries overlapping one queued for the same user are
+        refused when posted, that queued entries overlapping each other or a
+        saved effort are set aside as rejected, and counted at /metrics, and
+        that entries already saved are skipped rather than rejected
+        """
+        from datetime import datetime
+        from leaderboard import actions
+        from leaderboard.ingest import WriteBehindQueue
+        from leaderboard.model.columns import to_epoch
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        queue = WriteBehindQueue(directory, get_connection)
+        queue.start(actions.write_entries)
+        self.addCleanup(queue.close, 5)
+        self.addCleanup(setattr, actions, 'entry_queue', actions.entry_queue)
+        actions.entry_queue = queue
+        self.addCleanup(
+            setattr, leaderboard, 'entry_queue', leaderboard.entry_queue
+        )
+        leaderboard.entry_queue = queue
+
+        def rejected():
+            for line in self.app.get('/metrics').data.splitlines():
+                if line.startswith('leaderboard_ingest_rejected_total '):
+                    return float(line.split()[1])
+
+        before = json.loads(self.app.get('/users/3').data)
+        entries = [
+            (3, '2013-06-01T09:00:00', 3600, True),
+            (3, '2013-06-01T09:30:00', 3600, False),
+            (4, '2013-06-01T09:30:00', 3600, True),
+        ]
+        for user_id, start_time, duration, queued in entries:
+            response = json.loads(self.app.post(
+                '/users/%i' % user_id,
+                content_type='application/json',
+                data=json.dumps({
+                    'start_time': start_time,
+                    'duration': duration,
+                    'user': user_id,
+                    'latitude': 12.5,
+                    'longitude': 13.5,
+                })
+            ).data)
+            self.assertEqual(response['error'], not queued)
+            self.assertEqual(response.get('queued', False), queued)
+
+        # Entries queued by another process aren't checked until written.
+        queue.submit({
+            'user': 3, 'start_time': to_epoch(datetime(2013, 6, 1, 9, 30)),
+            'duration': 3600, 'latitude': 12.5, 'longitude': 13.5,
+        })
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(queue.stats()['rejected'], 1)
+        self.assertEqual(rejected(), 1)
+        with open(queue.path + '.rejected') as rejected_entries:
+            self.assertEqual(
+                [json.loads(l)['user'] for l in rejected_entries], [3]
+            )
+
+        after = json.loads(self.app.get('/users/3').data)
+        self.assertEqual(len(after['efforts']), len(before['efforts']) + 1)
+
+        # A journal taken over after a crash replays entries already saved.
+        connection = get_connection()
+        self.addCleanup(connection.close)
+        actions.write_entries(connection, [{
+            'user': 3, 'start_time': to_epoch(datetime(2013, 6, 1, 9)),
+            'duration': 3600, 'latitude': 12.5, 'longitude': 13.5,
+        }])
+        connection.commit()
+        after = json.loads(self.app.get('/users/3').data)
+        self.assertEqual(len(after['efforts']), len(before['efforts']) + 1)
+
     def test_add_user(self):
         """Test /users POST endpoint"""
         post_data = {
@@ -124,6 +630,71 @@ class FunctionalTestCase(unittest.TestCase):
 
         self.assertEqual(user_data, user)
 
+    def test_idempotency_keys(self):
+        """Test that retries of /users and /users/<int> POSTs with the same
+        Idempotency-Key get the original response without writing again, in
+        this process or another
+        """
+        post = lambda url, data, key: json.loads(self.app.post(
+            url,
+            content_type='application/json',
+            data=json.dumps(data),
+            headers={'Idempotency-Key': key}
+        ).data)
+        user_data = {
+            'username': 'rmonkey',
+            'first_name': 'Robert',
+            'last_name': 'Monkey',
+            'email': 'rmonkey@monkeys.com',
+            'team': 1,
+        }
+
+        first = post('/users', user_data, 'user-key')
+        self.assertFalse(first['error'])
+        self.assertEqual(post('/users', user_data, 'user-key'), first)
+        leaderboard.idempotency_cache.clear()
+        self.assertEqual(post('/users', user_data, 'user-key'), first)
+
+        retry = post('/users', dict(user_data, username='other'), 'user-key')
+        self.assertTrue(retry['error'])
+        retry = post('/users?competition=2', user_data, 'user-key')
+        self.assertTrue(retry['error'])
+        # Without a key the write is made again, and fails.
+        self.assertTrue(post('/users', user_data, '')['error'])
+
+        entry_data = {
+            'start_time': '2013-06-03T09:00:00',
+            'duration': 1800,
+            'user': 3,
+            'latitude': 16.5,
+            'longitude': 17.5,
+        }
+        before = json.loads(self.app.get('/users/3').data)
+        first = post('/users/3', entry_data, 'entry-key')
+        self.assertFalse(first['error'])
+        self.assertEqual(post('/users/3', entry_data, 'entry-key'), first)
+
+        after = json.loads(self.app.get('/users/3').data)
+        self.assertEqual(len(after['efforts']), len(before['efforts']) + 1)
+
+    def test_failed_requests_may_be_retried(self):
+        """Test that an Idempotency-Key isn't kept for a failed request"""
+        post = lambda data: json.loads(self.app.post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps(data),
+            headers={'Idempotency-Key': 'retry-key'}
+        ).data)
+        user_data = {
+            'username': 'rmonkey',
+            'first_name': 'Robert',
+            'last_name': 'Monkey',
+            'email': 'rmonkey@monkeys.com',
+        }
+
+        self.assertTrue(post(user_data)['error'])
+        self.assertFalse(post(dict(user_data, team=1))['error'])
+
     def test_add_team(self):
         """Test /teams POST endpoint"""
         post_data = {u'name': u'Dweeblezorks'}
@@ -163,6 +734,23 @@ class FunctionalTestCase(unittest.TestCase):
 
         self.assertEqual(len(data['teams']), 2)
         self.assertEqual(data['teams'][0]['name'], 'Red Team')
+        self.assertEqual(data['teams'][0]['effort'], 1000)
+
+        self.app.post(
+            '/users/%i' % user_id,
+            content_type='application/json',
+            data=json.dumps(dict(
+                post_data,
+                start_time=datetime.strftime(
+                    datetime(2013, 1, 1), DATETIME_FORMAT
+                )
+            ))
+        )
+        data = json.loads(self.app.get('/teams/best?num_teams=1').data)
+        self.assertEqual(data['teams'][0]['effort'], 2000)
+
+        team = json.loads(self.app.get('/teams/1').data)
+        self.assertEqual(len(team['members'][0]['efforts']), 2)
 
     def test_best_users(self):
         """Test /users/best endpoint"""
@@ -189,6 +777,377 @@ class FunctionalTestCase(unittest.TestCase):
         self.assertEqual(len(data['users']), 2)
         self.assertEqual(data['users'][0]['username'], 'mbrowning')
 
+    def test_user_cache_expires(self):
+        """Test that a cached user is loaded again once its time-to-live is
+        up, even if no notification of a write to it ever arrived
+        """
+        self.app.get('/users/3')
+        # Another worker's write, whose notification was lost.
+        connection = get_connection()
+        cursor = connection.cursor()
+        cursor.execute("UPDATE users SET first_name = 'Renamed' WHERE id = 3")
+        connection.commit()
+        connection.close()
+
+        data = json.loads(self.app.get('/users/3').data)
+        self.assertNotEqual(data['first_name'], 'Renamed')
+
+        cache = leaderboard.user_cache
+        self.addCleanup(setattr, cache, 'clock', cache.clock)
+        cache.clock = lambda: time.time() + cache.ttl
+        data = json.loads(self.app.get('/users/3').data)
+        self.assertEqual(data['first_name'], 'Renamed')
+
+    def test_cached_users_load_on_their_requests_connection(self):
+        """Test that a user cached unloaded by one request loads its efforts
+        on the connection lent to the request using it, rather than the one
+        it was loaded on, which may since have been lent to another request
+        """
+        from leaderboard.cooperative import RequestConnections
+
+        class TestPool(object):
+            """Lends new connections and closes those given back."""
+
+            def get(self):
+                return get_connection()
+
+            def put(self, connection):
+                connection.close()
+
+        self.addCleanup(
+            setattr, leaderboard, 'request_connections',
+            leaderboard.request_connections
+        )
+        connections = leaderboard.request_connections = RequestConnections(
+            TestPool()
+        )
+
+        with app.test_request_context():
+            UserRepository().get(user_id=3)
+            connections._teardown_request()
+        with app.test_request_context():
+            user = UserRepository().get(user_id=3)
+            self.assertFalse(user.efforts.loaded)
+            efforts = len(user.efforts)
+            connections._teardown_request()
+
+        data = json.loads(self.app.get('/users/3').data)
+        self.assertEqual(efforts, len(data['efforts']))
+
+    def test_invalidation_messages_name_teams(self):
+        """Test that the bus messages for a user's writes carry their team,
+        and the team they left, so that other workers invalidate them
+        """
+        from leaderboard import actions
+
+        messages = []
+        bus = leaderboard.bus
+        self.addCleanup(setattr, bus, 'notify', bus.notify)
+        bus.notify = lambda cursor, kind, **keys: messages.append(
+            dict(keys, kind=kind)
+        )
+
+        self.app.post(
+            '/users/3',
+            content_type='application/json',
+            data=json.dumps({
+                'start_time': '2013-06-01T09:00:00',
+                'duration': 600,
+                'user': 3,
+                'latitude': 16.5,
+                'longitude': 17.5,
+            })
+        )
+        repository = UserRepository()
+        user = repository.get(user_id=3)
+        team_id = repository.get_team(user)
+        self.assertEqual(messages[-1]['team'], team_id)
+
+        other_id = 1 if team_id != 1 else 2
+        repository.set_team(user, other_id)
+        message = messages[-1]
+        self.assertEqual(
+            (message['team'], message['old_team']), (other_id, team_id)
+        )
+
+        # Another worker applying it bumps both teams' versions.
+        before = [
+            leaderboard.versions.get(('team', t)).etag
+            for t in (team_id, other_id)
+        ]
+        actions.apply_invalidation(message)
+        after = [
+            leaderboard.versions.get(('team', t)).etag
+            for t in (team_id, other_id)
+        ]
+        self.assertNotEqual(before[0], after[0])
+        self.assertNotEqual(before[1], after[1])
+
+    def test_best_users_cache_invalidated(self):
+        """Test that a cached /users/best is invalidated by new entries"""
+        from datetime import datetime
+        from leaderboard.helpers import DATETIME_FORMAT
+
+        data = json.loads(self.app.get('/users/best?num_users=1').data)
+        self.assertEqual(data['users'][0]['effort'], 0)
+        self.app.get('/users/best?num_users=1')
+
+        stats = json.loads(self.app.get('/cache/stats').data)['responses']
+        self.assertEqual(stats['hits'], 1)
+
+        user_id = 4
+        self.app.post(
+            '/users/%i' % user_id,
+            content_type='application/json',
+            data=json.dumps({
+                'start_time': datetime.strftime(datetime.now(), DATETIME_FORMAT),
+                'duration': 1000,
+                'user': user_id,
+                'latitude': 41.5,
+                'longitude': 71.5,
+            })
+        )
+
+        data = json.loads(self.app.get('/users/best?num_users=1').data)
+        self.assertEqual(data['users'][0]['username'], 'rmcneely')
+        self.assertEqual(data['users'][0]['effort'], 1000)
+
+    def test_best_users_cache_races_writes(self):
+        """Test that a /users/best read before another worker's write, but
+        cached after the write invalidated the cache, isn't served as the
+        written version
+        """
+        from leaderboard import actions
+
+        get_users = actions.get_users
+        self.addCleanup(setattr, actions, 'get_users', get_users)
+
+        def racing(*args, **kwargs):
+            users = get_users(*args, **kwargs)
+            actions.get_users = get_users
+            # Another worker saves an effort and announces it on the bus.
+            connection = get_connection()
+            cursor = connection.cursor()
+            cursor.execute(
+                'INSERT INTO locations (latitude, longitude) '
+                'VALUES (41.5, 71.5) RETURNING id'
+            )
+            cursor.execute(
+                'INSERT INTO efforts '
+                '(start_time, duration, "user", location, competition) '
+                "VALUES (now(), '1000 seconds', 4, %s, 1)",
+                cursor.fetchone()
+            )
+            connection.commit()
+            connection.close()
+            actions.apply_invalidation(
+                {'kind': 'user', 'id': 4, 'competition': 1}
+            )
+            return users
+
+        actions.get_users = racing
+        stale = self.app.get('/users/best?num_users=1')
+        self.assertEqual(json.loads(stale.data)['users'][0]['effort'], 0)
+
+        fresh = self.app.get('/users/best?num_users=1')
+        self.assertNotEqual(fresh.headers['ETag'], stale.headers['ETag'])
+        self.assertEqual(json.loads(fresh.data)['users'][0]['effort'], 1000)
+
+    def test_conditional_get(self):
+        """Test that unchanged data is answered with 304 Not Modified"""
+        from datetime import datetime
+        from leaderboard.helpers import DATETIME_FORMAT
+
+        user_id = 3
+        response = self.app.get('/users/%i' % user_id)
+        etag = response.headers['ETag']
+        self.assertIn('Last-Modified', response.headers)
+
+        response = self.app.get(
+            '/users/%i' % user_id, headers={'If-None-Match': etag}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, '')
+        # Dates can't tell apart writes in the same second, so they're ignored.
+        response = self.app.get(
+            '/users/%i' % user_id,
+            headers={'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'}
+        )
+        self.assertEqual(response.status_code, 200)
+
+        best_etag = self.app.get('/users/best').headers['ETag']
+        other_etag = self.app.get('/users/4').headers['ETag']
+
+        self.app.post(
+            '/users/%i' % user_id,
+            content_type='application/json',
+            data=json.dumps({
+                'start_time': datetime.strftime(datetime.now(), DATETIME_FORMAT),
+                'duration': 1000,
+                'user': user_id,
+                'latitude': 41.5,
+                'longitude': 71.5,
+            })
+        )
+
+        for url, tag, status in (
+            ('/users/%i' % user_id, etag, 200),
+            ('/users/best', best_etag, 200),
+            ('/users/4', other_etag, 304),
+        ):
+            response = self.app.get(url, headers={'If-None-Match': tag})
+            self.assertEqual(response.status_code, status)
+
+    def test_competitions_partition_leaderboards(self):
+        """Test that leaderboards only rank their own competition and that
+        archived competitions can't be written to
+        """
+        from datetime import datetime
+        from leaderboard.helpers import DATETIME_FORMAT
+
+        competition_id = json.loads(self.app.post(
+            '/competitions',
+            content_type='application/json',
+            data=json.dumps({'name': 'Season2'})
+        ).data)['id']
+        team_id = json.loads(self.app.post(
+            '/teams',
+            content_type='application/json',
+            data=json.dumps({'name': 'Red Team', 'competition': competition_id})
+        ).data)['id']
+        user_id = json.loads(self.app.post(
+            '/users',
+            content_type='application/json',
+            data=json.dumps({
+                'username': 'mbrowning',
+                'first_name': 'Michael',
+                'last_name': 'Browning',
+                'email': 'invitapriore@gmail.com',
+                'team': team_id,
+                'competition': competition_id,
+            })
+        ).data)['id']
+        # Users may only join teams in their own competition.
+        for team, competition in ((1, competition_id), (team_id, None)):
+            data = json.loads(self.app.post(
+                '/users',
+                content_type='application/json',
+                data=json.dumps({
+                    'username': 'elsewhere',
+                    'first_name': 'Else',
+                    'last_name': 'Where',
+                    'email': 'elsewhere@example.com',
+                    'team': team,
+                    'competition': competition,
+                })
+            ).data)
+            self.assertTrue(data['error'])
+            self.assertIn('is not in competition', data['message'])
+
+        data = json.loads(
+            self.app.get('/users/best?competition=%i' % competition_id).data
+        )
+        self.assertEqual(len(data['users']), 1)
+        self.assertEqual(data['users'][0]['team'], 'Red Team')
+        data = json.loads(
+            self.app.get('/teams/best?competition=%i' % competition_id).data
+        )
+        self.assertEqual([t['id'] for t in data['teams']], [team_id])
+        self.assertEqual(len(json.loads(self.app.get('/teams').data)['teams']), 4)
+
+        self.app.post('/competitions/%i/archive' % competition_id)
+        data = json.loads(self.app.get('/competitions').data)
+        self.assertEqual([c['name'] for c in data['competitions']], ['Default'])
+
+        data = json.loads(self.app.post(
+            '/users/%i' % user_id,
+            content_type='application/json',
+            data=json.dumps({
+                'start_time': datetime.strftime(datetime.now(), DATETIME_FORMAT),
+                'duration': 1000,
+                'user': user_id,
+                'latitude': 41.5,
+                'longitude': 71.5,
+            })
+        ).data)
+        self.assertTrue(data['error'])
+
+    @unittest.skipIf(analytics.numpy is None, 'NumPy is not installed')
+    def test_analytics_match_leaderboards(self):
+        """Test that the vectorized analytics path agrees with the leaderboard
+        endpoints
+        """
+        from datetime import datetime, timedelta
+        from leaderboard.helpers import DATETIME_FORMAT
+
+        for user_id, hours in ((3, 1), (4, 2), (3, 3)):
+            self.app.post(
+                '/users/%i' % user_id,
+                content_type='application/json',
+                data=json.dumps({
+                    'start_time': datetime.strftime(
+                        datetime(2013, 1, 1) + timedelta(hours=hours),
+                        DATETIME_FORMAT
+                    ),
+                    'duration': 1000 * hours,
+                    'user': user_id,
+                    'latitude': 41.5 + hours,
+                    'longitude': 71.5,
+                })
+            )
+
+        efforts = analytics.EffortArrays.load(competition_id=1)
+        ids, totals = analytics.top_k(*efforts.user_totals(), k=3)
+        data = json.loads(self.app.get('/users/best').data)
+        self.assertEqual(
+            list(totals), [u['effort'] for u in data['users']]
+        )
+
+        ids, totals = analytics.top_k(*efforts.team_totals(), k=3)
+        data = json.loads(self.app.get('/teams/best').data)
+        self.assertEqual(list(ids), [t['id'] for t in data['teams']])
+        self.assertEqual(list(totals), [t['effort'] for t in data['teams']])
+
+
+    def test_metrics(self):
+        """Test that requests, including those answered with an error
+        response, and their database time are counted at /metrics
+        """
+        # The registry doesn't hide the module it's defined in.
+        self.assertIsInstance(
+            leaderboard.registry, leaderboard.metrics.Registry
+        )
+
+        def samples():
+            return dict(
+                line.rsplit(' ', 1)
+                for line in self.app.get('/metrics').data.splitlines()
+                if not line.startswith('#')
+            )
+
+        route = 'method="GET",route="/users/<int:user_id>"'
+        before = samples()
+        self.app.get('/users/3')
+        self.app.get('/users/99')
+        after = samples()
+
+        def delta(name):
+            return float(after[name]) - float(before.get(name, 0))
+
+        self.assertEqual(delta(
+            'leaderboard_requests_total{%s,status="200"}' % route
+        ), 2)
+        self.assertEqual(delta(
+            'leaderboard_request_errors_total{handled="true",%s}' % route
+        ), 1)
+        self.assertEqual(
+            delta('leaderboard_request_duration_seconds_count{%s}' % route), 2
+        )
+        self.assertGreater(
+            delta('leaderboard_request_db_seconds_sum{%s}' % route), 0
+        )
+        self.assertIn('leaderboard_cache_hit_ratio{cache="users"}', after)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
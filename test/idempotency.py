@@ -0,0 +1,116 @@
+"""
+    test.idempotency
+    ================
+
+    Test the store behind idempotency keys.
+
+    :author: Michael Browning
+"""
+
+import unittest
+
+from leaderboard.cache import LRUCache
+from leaderboard.idempotency import IdempotencyStore
+from leaderboard.exceptions import IdempotencyError
+
+
+class TestIdempotencyRepository(object):
+    """Keeps keys in a dictionary in place of the database table, counting
+    the calls made to it.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.calls = []
+
+    def get(self, key):
+        self.calls.append('get')
+        return self.rows.get(key)
+
+    def reserve(self, key, fingerprint):
+        self.calls.append('reserve')
+        if key in self.rows:
+            return False
+        self.rows[key] = (fingerprint, None)
+        return True
+
+    def complete(self, key, response):
+        self.calls.append('complete')
+        self.rows[key] = (self.rows[key][0], response)
+
+    def release(self, key):
+        self.calls.append('release')
+        if self.rows.get(key, (None, None))[1] is None:
+            self.rows.pop(key, None)
+
+    def purge(self):
+        self.calls.append('purge')
+
+
+class TestIdempotencyStore(IdempotencyStore):
+    """An :class:`IdempotencyStore` on a :class:`TestIdempotencyRepository`."""
+
+    def __init__(self, *args, **kwargs):
+        super(TestIdempotencyStore, self).__init__(*args, **kwargs)
+        self.repository = TestIdempotencyRepository()
+
+    def _repository(self):
+        return self.repository
+
+
+class IdempotencyStoreTest(unittest.TestCase):
+    """Test :class:`leaderboard.idempotency.IdempotencyStore`"""
+
+    def setUp(self):
+        self.store = TestIdempotencyStore(LRUCache(10), purge_every=2)
+
+    def test_answers_retries(self):
+        """Test that a key's first request reserves it, and that retries get
+        its response back from the cache
+        """
+        self.assertEqual(self.store.begin('key', 'request'), None)
+        self.store.finish('key', 'request', {'id': 5})
+
+        calls = len(self.store.repository.calls)
+        self.assertEqual(self.store.begin('key', 'request'), {'id': 5})
+        self.assertEqual(len(self.store.repository.calls), calls)
+
+    def test_answers_retries_from_other_processes(self):
+        """Test that a response stored by another process is read from the
+        table, and then cached
+        """
+        self.store.repository.rows['key'] = ('request', {'id': 5})
+
+        self.assertEqual(self.store.begin('key', 'request'), {'id': 5})
+        self.assertEqual(self.store.begin('key', 'request'), {'id': 5})
+        self.assertEqual(self.store.repository.calls, ['get'])
+
+    def test_refuses_reused_keys(self):
+        """Test that a key can't be used for a different request, or while
+        its request is in progress
+        """
+        self.store.begin('key', 'request')
+        self.assertRaises(IdempotencyError, self.store.begin, 'key', 'request')
+
+        self.store.finish('key', 'request', {'id': 5})
+        self.assertRaises(IdempotencyError, self.store.begin, 'key', 'other')
+
+    def test_abandoned_keys_may_be_retried(self):
+        """Test that a key given up on may be reserved again"""
+        self.store.begin('key', 'request')
+        self.store.abandon('key')
+
+        self.assertEqual(self.store.begin('key', 'request'), None)
+
+    def test_purges_expired_keys(self):
+        """Test that expired keys are purged every `purge_every`
+        reservations
+        """
+        for n in range(4):
+            self.store.begin('key%d' % n, 'request')
+
+        self.assertEqual(self.store.repository.calls.count('purge'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
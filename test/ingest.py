@@ -0,0 +1,233 @@
+"""
+    test.ingest
+    ===========
+
+    Test the write-behind queue.
+
+    :author: Michael Browning
+"""
+
+from threading import Event
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import psycopg2
+
+from leaderboard.ingest import WriteBehindQueue
+from leaderboard.exceptions import QueueFullError
+
+
+class TestConnection(object):
+    """A connection that counts its commits."""
+
+    def __init__(self):
+        self.commits = 0
+        self.closed = False
+
+    def commit(self):
+        self.commits += 1
+
+    def close(self):
+        self.closed = True
+
+
+class TestWriter(object):
+    """Records the batches it's asked to write, optionally holding each one
+    until released or failing with the errors it's given.
+    """
+
+    def __init__(self, hold=False, errors=()):
+        self.batches = []
+        self.errors = list(errors)
+        self.release = Event()
+        if not hold:
+            self.release.set()
+
+    def __call__(self, connection, entries):
+        self.release.wait(5)
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None:
+                raise error
+        for entry in entries:
+            if entry.get('bad'):
+                raise psycopg2.IntegrityError('bad entry')
+        self.batches.append(entries)
+
+    @property
+    def written(self):
+        return [e['n'] for batch in self.batches for e in batch]
+
+
+class WriteBehindQueueTest(unittest.TestCase):
+    """Test :class:`leaderboard.ingest.WriteBehindQueue`"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.connections = []
+
+    def make_queue(self, **kwargs):
+        def connect():
+            self.connections.append(TestConnection())
+            return self.connections[-1]
+
+        kwargs.setdefault('max_backoff', 0.01)
+        queue = WriteBehindQueue(self.directory, connect, **kwargs)
+        self.addCleanup(queue.close, 5)
+
+        return queue
+
+    def test_writes_entries_behind(self):
+        """Test that submitted entries are journaled, written on one
+        connection and then dropped from the journal
+        """
+        writer = TestWriter(hold=True)
+        queue = self.make_queue()
+        queue.start(writer)
+        for n in range(3):
+            queue.submit({'n': n})
+
+        with open(queue.path) as journal:
+            self.assertEqual(
+                [json.loads(l)['n'] for l in journal], [0, 1, 2]
+            )
+
+        writer.release.set()
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(writer.written, [0, 1, 2])
+        self.assertEqual(len(self.connections), 1)
+        self.assertEqual(os.path.getsize(queue.path), 0)
+        self.assertEqual(queue.stats()['written'], 3)
+
+    def test_batches_waiting_entries(self):
+        """Test that entries that arrive while a batch is written are written
+        together, at most `batch_size` at a time
+        """
+        writer = TestWriter(hold=True)
+        queue = self.make_queue(batch_size=3)
+        queue.start(writer)
+        for n in range(7):
+            queue.submit({'n': n})
+
+        writer.release.set()
+        queue.flush(5)
+        self.assertEqual(writer.written, range(7))
+        self.assertTrue(all(len(b) <= 3 for b in writer.batches))
+        self.assertTrue(len(writer.batches) <= 4)
+
+    def test_backpressure(self):
+        """Test that :meth:`WriteBehindQueue.submit` refuses entries once
+        `max_pending` are waiting
+        """
+        writer = TestWriter(hold=True)
+        queue = self.make_queue(batch_size=1, max_pending=2, block=0.05)
+        queue.start(writer)
+        queue.submit({'n': 0})
+        queue.submit({'n': 1})
+
+        self.assertRaises(QueueFullError, queue.submit, {'n': 2})
+        writer.release.set()
+        queue.flush(5)
+        queue.submit({'n': 2})
+
+    def test_close_writes_everything(self):
+        """Test that :meth:`WriteBehindQueue.close` writes every queued entry
+        and then removes the empty journal
+        """
+        writer = TestWriter()
+        queue = self.make_queue()
+        queue.start(writer)
+        for n in range(5):
+            queue.submit({'n': n})
+        path = queue.path
+        queue.close()
+
+        self.assertEqual(writer.written, range(5))
+        self.assertFalse(os.path.exists(path))
+        self.assertRaises(QueueFullError, queue.submit, {'n': 5})
+
+    def test_takes_over_orphaned_journals(self):
+        """Test that a starting queue writes the unwritten entries of a dead
+        process's journal, and removes it
+        """
+        orphan = os.path.join(self.directory, 'ingest-dead-1.journal')
+        with open(orphan, 'wb') as f:
+            f.write('{"n": 0}\n{"n": 1}\n{"n": 2}\n{"n": 3')
+        with open(orphan + '.pos', 'wb') as f:
+            f.write(str(len('{"n": 0}\n')))
+
+        writer = TestWriter()
+        queue = self.make_queue()
+        queue.start(writer)
+        queue.flush(5)
+
+        # The torn last line was never acknowledged.
+        self.assertEqual(writer.written, [1, 2])
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(orphan + '.pos'))
+
+    def test_retries_failed_batches(self):
+        """Test that a batch that fails is retried on a new connection"""
+        writer = TestWriter(errors=[psycopg2.OperationalError('down')])
+        queue = self.make_queue()
+        queue.start(writer)
+        queue.submit({'n': 0})
+        queue.flush(5)
+
+        self.assertEqual(writer.written, [0])
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(queue.stats()['failures'], 1)
+
+    def test_rejects_entries_that_cannot_be_written(self):
+        """Test that the entries of a batch that fails permanently are written
+        one at a time, and the ones that fail alone are set aside
+        """
+        writer = TestWriter(hold=True)
+        queue = self.make_queue()
+        queue.start(writer)
+        queue.submit({'n': 0})
+        queue.submit({'n': 1, 'bad': True})
+        queue.submit({'n': 2})
+        writer.release.set()
+        queue.flush(5)
+
+        self.assertEqual(writer.written, [0, 2])
+        with open(queue.path + '.rejected') as rejected:
+            self.assertEqual(json.loads(rejected.read())['n'], 1)
+        self.assertEqual(queue.stats()['rejected'], 1)
+
+    def test_check_refuses_entries(self):
+        """Test that a check passed to :meth:`WriteBehindQueue.submit` sees
+        the entries still waiting and can refuse an entry before it's
+        journaled
+        """
+        writer = TestWriter(hold=True)
+        queue = self.make_queue()
+        queue.start(writer)
+        queue.submit({'n': 0})
+        queue.submit({'n': 1})
+
+        seen = []
+
+        def check(entry):
+            seen.append(entry['n'])
+            if entry['n'] == 1:
+                raise ValueError('conflicts with a waiting entry')
+
+        self.assertRaises(ValueError, queue.submit, {'n': 2}, check)
+        queue.submit({'n': 3}, check=lambda entry: None)
+        self.assertEqual(seen, [0, 1])
+
+        writer.release.set()
+        self.assertTrue(queue.flush(5))
+        self.assertEqual(writer.written, [0, 1, 3])
+        self.assertEqual(queue.stats()['rejected'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
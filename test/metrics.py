@@ -0,0 +1,163 @@
+"""
+    test.metrics
+    ============
+
+    Test the metrics registry.
+
+    :author: Michael Browning
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from leaderboard.metrics import Registry
+
+
+def make_registry(**kwargs):
+    registry = Registry(**kwargs)
+    registry.counter('requests_total', 'Requests.')
+    registry.counter('hits_total', 'Hits.')
+    registry.counter('misses_total', 'Misses.')
+    registry.gauge('busy', 'Busy connections.')
+    registry.histogram('seconds', 'Latency.', buckets=(0.1, 1.0))
+    registry.ratio(
+        'hit_ratio', 'Hit ratio.', 'hits_total', ('hits_total', 'misses_total')
+    )
+
+    return registry
+
+
+def lines(registry):
+    return [
+        line for line in registry.render().splitlines()
+        if not line.startswith('#')
+    ]
+
+
+class RegistryTest(unittest.TestCase):
+    """Test :class:`leaderboard.metrics.Registry`"""
+
+    def test_counters(self):
+        """Test that counters are rendered per set of labels, with label
+        values escaped
+        """
+        registry = make_registry()
+        registry.inc('requests_total', route='/users', status=200)
+        registry.inc('requests_total', 2, route='/users', status=200)
+        registry.inc('requests_total', route='/a "b"\n', status=500)
+
+        self.assertEqual(lines(registry), [
+            'requests_total{route="/a \\"b\\"\\n",status="500"} 1',
+            'requests_total{route="/users",status="200"} 3',
+        ])
+        self.assertIn('# TYPE requests_total counter', registry.render())
+
+    def test_histograms(self):
+        """Test that histograms are rendered with cumulative buckets, a sum
+        and a count
+        """
+        registry = make_registry()
+        for value in (0.05, 0.1, 0.5, 2):
+            registry.observe('seconds', value, route='/users')
+
+        self.assertEqual(lines(registry), [
+            'seconds_bucket{route="/users",le="0.1"} 2',
+            'seconds_bucket{route="/users",le="1.0"} 3',
+            'seconds_bucket{route="/users",le="+Inf"} 4',
+            'seconds_sum{route="/users"} 2.65',
+            'seconds_count{route="/users"} 4',
+        ])
+
+    def test_collectors_and_ratios(self):
+        """Test that collected samples are rendered, and ratios worked out
+        from them
+        """
+        registry = make_registry()
+        registry.collect(lambda: [
+            ('hits_total', {'cache': 'users'}, 3),
+            ('misses_total', {'cache': 'users'}, 1),
+            ('misses_total', {'cache': 'empty'}, 0),
+            ('busy', {}, 2),
+        ])
+
+        self.assertEqual(lines(registry), [
+            'hits_total{cache="users"} 3',
+            'misses_total{cache="empty"} 0',
+            'misses_total{cache="users"} 1',
+            'busy 2',
+            'hit_ratio{cache="users"} 0.75',
+        ])
+
+    def test_timings(self):
+        """Test that time spent is only added up between `begin` and `end`"""
+        registry = make_registry()
+        registry.spend('db', 1.0)
+        registry.begin()
+        registry.spend('db', 0.25)
+        registry.spend('db', 0.5)
+
+        self.assertEqual(registry.end(), {'db': 0.75})
+        self.assertEqual(registry.end(), {})
+
+    def test_sums_workers(self):
+        """Test that the metrics of every worker writing to the directory are
+        summed, without the gauges of workers that have exited
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def write(pid, samples):
+            with open(os.path.join(directory, '%d.json' % pid), 'w') as f:
+                json.dump({'pid': pid, 'samples': samples}, f)
+
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+        write(exited.pid, {
+            'requests_total': {'route="/users"': 2},
+            'busy': {'': 5},
+            'seconds': {'': [1, 0, 0, 0.05]},
+        })
+        write(os.getppid(), {
+            'requests_total': {'route="/users"': 1},
+            'busy': {'': 1},
+        })
+
+        registry = make_registry(directory=directory)
+        registry.inc('requests_total', route='/users')
+        registry.observe('seconds', 0.5)
+        registry.collect(lambda: [('busy', {}, 1)])
+        # Its own file is stale; it counts its metrics as they are now.
+        registry.flush()
+        registry.inc('requests_total', route='/users')
+
+        self.assertEqual(lines(registry), [
+            'requests_total{route="/users"} 5',
+            'busy 2',
+            'seconds_bucket{le="0.1"} 1',
+            'seconds_bucket{le="1.0"} 2',
+            'seconds_bucket{le="+Inf"} 2',
+            'seconds_sum 0.55',
+            'seconds_count 2',
+        ])
+
+    def test_forked_workers_start_over(self):
+        """Test that a process forked from one that recorded metrics doesn't
+        report them as its own
+        """
+        registry = make_registry()
+        registry.inc('requests_total')
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if lines(registry) == [] else 1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(lines(registry), ['requests_total 1'])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -7,15 +7,20 @@
     :author: Michael Browning
 """
 
+import pickle
 import unittest
+from copy import copy
 from datetime import datetime, timedelta
 
-from leaderboard.model import User, Team, re_validator, type_validator
-from leaderboard.model.model import Model, Value
+from leaderboard.model import User, Team, Competition, re_validator, \
+    type_validator
+from leaderboard.model.model import Model, Entity, Value
+from leaderboard.model.columns import EffortColumns
+from leaderboard.model.lazy import LazyCollection, loaded
 from leaderboard.model.effort import Effort
 from leaderboard.model.location import Location
 from leaderboard.exceptions import ValidationError, MissingFieldError, \
-    DefinitionError, ConstraintError
+    DefinitionError, ConstraintError, ConsistencyError
 
 
 class ReValidatorTest(unittest.TestCase):
@@ -94,6 +99,53 @@ class ModelTest(unittest.TestCase):
         self.fields['extra'] = 'extra'
         self.assertRaises(DefinitionError, self.TestClass, **self.fields)
 
+    def test_validates_with_compiled_function(self):
+        """Test that :class:`Model` subclasses get validation compiled for their
+        own fields, which still reports errors raised by the rules
+        """
+        class TestClass(Model):
+            _validation_rules = {
+                'field': lambda x: x.upper(),
+                'other': lambda x: x + 1,
+            }
+
+        self.assertIn('_validate', TestClass.__dict__)
+
+        test_model = TestClass(field='value', other=1)
+        self.assertEqual((test_model.field, test_model.other), ('VALUE', 2))
+        self.assertRaises(TypeError, TestClass, field='value', other='1')
+
+    def test_from_row_skips_validation(self):
+        """Test that :meth:`Model.from_row` stores fields without validating
+        them, but still requires exactly the model's fields
+        """
+        class TestClass(Model):
+            _validation_rules = {'field': re_validator(r'^[a-z]+$')}
+
+        test_model = TestClass.from_row(field='VALUE')
+        self.assertEqual(test_model.field, 'VALUE')
+        self.assertRaises(ValidationError, TestClass, field='VALUE')
+        self.assertRaises(MissingFieldError, TestClass.from_row)
+        self.assertRaises(
+            DefinitionError, TestClass.from_row, field='value', extra='extra'
+        )
+
+    def test_serializes_with_compiled_function(self):
+        """Test that :class:`Model` subclasses get serialization compiled for
+        their own fields, through the serializers given for any of them
+        """
+        class TestClass(Model):
+            _validation_rules = {
+                'field': lambda x: x,
+                'other': lambda x: x,
+            }
+            _serializers = {'other': str}
+
+        self.assertIn('_serialize', TestClass.__dict__)
+        self.assertEqual(
+            TestClass(field=1, other=2).to_dict(), {'field': 1, 'other': '2'}
+        )
+
 
 class ValueTest(unittest.TestCase):
     """Test :class:`leaderboard.model.model.Value`"""
@@ -167,6 +219,49 @@ class ValueTest(unittest.TestCase):
         test_value2 = DTTestClass(**self.fields.copy())
         self.assertNotEqual(test_value1, test_value2)
 
+    def test_no_instance_dict(self):
+        """Test that :class:`Value` objects keep their fields in slots rather
+        than a per-instance dictionary
+        """
+        test_value = self.TestClass(**self.fields)
+
+        self.assertFalse(hasattr(test_value, '__dict__'))
+        self.assertEqual(self.TestClass.__slots__, ('field',))
+        self.assertRaises(TypeError, setattr, test_value, 'other', 'value')
+
+    def test_hash_ignores_id(self):
+        """Test that :class:`Value` objects with equal data hash equally,
+        whatever their ids
+        """
+        test_value1 = self.TestClass(**self.fields)
+        test_value2 = self.TestClass(**self.fields.copy())
+        test_value1.id = 5
+
+        self.assertEqual(hash(test_value1), hash(test_value2))
+        self.assertEqual(len({test_value1, test_value2}), 1)
+
+    def test_from_row(self):
+        """Test that :class:`Value` objects built from rows equal and hash like
+        validated ones
+        """
+        test_value1 = self.TestClass(**self.fields)
+        test_value2 = self.TestClass.from_row(**self.fields)
+
+        self.assertEqual(test_value1, test_value2)
+        self.assertEqual(hash(test_value1), hash(test_value2))
+        self.assertRaises(MissingFieldError, self.TestClass.from_row)
+
+    def test_pickles(self):
+        """Test that :class:`Value` objects survive pickling and copying"""
+        # Pickling needs a class importable by name.
+        test_value = Location(latitude=41.5, longitude=71.5)
+        test_value.id = 5
+
+        for other in (pickle.loads(pickle.dumps(test_value)), copy(test_value)):
+            self.assertEqual(test_value, other)
+            self.assertEqual(hash(test_value), hash(other))
+            self.assertEqual(other.id, 5)
+
 
 class UserTest(unittest.TestCase):
     """Test :class:`leaderboard.model.User`"""
@@ -276,6 +371,180 @@ class UserTest(unittest.TestCase):
 
         self.assertRaises(ConstraintError, user.add_effort, **fields)
 
+    def test_add_effort_overlap_cases(self):
+        """Test that :meth:`User.add_effort` rejects efforts that contain,
+        are contained by or share a start with an existing one, and accepts
+        ones that only meet it end to start
+        """
+        user = User(**self.fields)
+        start = datetime(2013, 1, 1, 12)
+        user.add_effort(
+            start_time=start, duration=timedelta(hours=2),
+            latitude=41.5, longitude=73.5
+        )
+
+        for start_time, duration in (
+            (start, timedelta(minutes=1)),
+            (start - timedelta(hours=1), timedelta(hours=4)),
+            (start + timedelta(minutes=30), timedelta(minutes=30)),
+            (start + timedelta(hours=1), timedelta(hours=2)),
+            (start - timedelta(hours=1), timedelta(hours=1, seconds=1)),
+        ):
+            self.assertRaises(
+                ConstraintError, user.add_effort,
+                start_time=start_time, duration=duration,
+                latitude=41.5, longitude=73.5
+            )
+
+        for start_time in (
+            start - timedelta(hours=1), start + timedelta(hours=2)
+        ):
+            user.add_effort(
+                start_time=start_time, duration=timedelta(hours=1),
+                latitude=41.5, longitude=73.5
+            )
+        self.assertEqual(len(user.efforts), 3)
+
+    def test_add_efforts(self):
+        """Test that :meth:`User.add_efforts` adds a batch of efforts, or none
+        of them if any overlap each other or an existing effort
+        """
+        location = Location(latitude=41.5, longitude=73.5)
+        start = datetime(2013, 1, 1, 12)
+        efforts = [
+            Effort(
+                start_time=start + timedelta(hours=h),
+                duration=timedelta(hours=1),
+                location=location
+            )
+            for h in (4, 0, 2)
+        ]
+        user = User(**self.fields)
+        user.add_efforts(efforts[:1])
+        user.add_efforts(efforts[1:])
+
+        self.assertEqual(
+            list(user.efforts), sorted(efforts, key=lambda e: e.start_time)
+        )
+
+        contained = Effort(
+            start_time=start + timedelta(minutes=10),
+            duration=timedelta(minutes=10),
+            location=location
+        )
+        adjacent = Effort(
+            start_time=start + timedelta(hours=1),
+            duration=timedelta(hours=1),
+            location=location
+        )
+        for batch in ([adjacent, contained], [adjacent, adjacent], efforts[:1]):
+            self.assertRaises(ConstraintError, user.add_efforts, batch)
+            self.assertEqual(len(user.efforts), 3)
+
+        user.add_efforts([adjacent])
+        self.assertEqual(len(user.efforts), 4)
+
+
+class TotalsTest(unittest.TestCase):
+    """Test the running effort totals of :class:`leaderboard.model.User` and
+    :class:`leaderboard.model.Team`
+    """
+
+    def setUp(self):
+        Entity.check_totals = True
+        self.location = Location(latitude=41.5, longitude=73.5)
+        self.user = User(
+            username='test', first_name='first', last_name='last',
+            email='test@test.com'
+        )
+
+    def tearDown(self):
+        Entity.check_totals = False
+
+    def effort(self, hour, minutes):
+        return Effort(
+            start_time=datetime(2013, 1, 1, hour),
+            duration=timedelta(minutes=minutes),
+            location=self.location
+        )
+
+    def test_user_totals(self):
+        """Test that :class:`User` keeps its totals as efforts are added, once
+        each
+        """
+        self.assertEqual(self.user.time_worked(), 0)
+
+        self.user.add_effort(self.effort(1, 30))
+        self.user.add_effort(self.effort(1, 30))
+        self.user.add_efforts([self.effort(2, 10), self.effort(3, 20)])
+        self.user.add_efforts([self.effort(2, 10)], check=False)
+
+        self.assertEqual(self.user.time_worked(), 3600)
+        self.assertEqual(self.user.effort_count, 3)
+
+    def test_team_totals(self):
+        """Test that :class:`Team` totals its members' efforts"""
+        self.user.add_effort(self.effort(1, 30))
+        other = User(
+            username='other', first_name='first', last_name='last',
+            email='other@test.com'
+        )
+        other.add_effort(self.effort(1, 15))
+
+        team = Team(name='Team')
+        team.add_user(self.user)
+        team.add_user(other)
+
+        self.assertEqual(team.time_worked(), 45 * 60)
+        self.assertEqual(team.effort_count, 2)
+
+    def test_check_totals(self):
+        """Test that a total that disagrees with the efforts is caught when
+        checking is on
+        """
+        self.user.add_effort(self.effort(1, 30))
+        self.user.efforts.add(self.effort(2, 30))
+        self.assertRaises(ConsistencyError, self.user.time_worked)
+
+        Entity.check_totals = False
+        self.assertEqual(self.user.time_worked(), 30 * 60)
+
+    def test_unknown_totals(self):
+        """Test that a team's totals are unknown if any member's are"""
+        self.user.effort_count = self.user.effort_seconds = None
+        team = Team(name='Team')
+        team.add_user(self.user)
+
+        self.assertEqual(team.effort_count, None)
+        self.assertEqual(team.time_worked(), None)
+
+    def test_sparse_to_dict(self):
+        """Test that :meth:`Team.to_dict` and :meth:`User.to_dict` can be
+        limited to some fields and relations, and may include the totals
+        """
+        self.user.add_effort(self.effort(1, 30))
+        team = Team(name='Team')
+        team.add_user(self.user)
+
+        full = team.to_dict()
+        self.assertEqual(set(full), set(['name', 'members']))
+        self.assertEqual(len(full['members'][0]['efforts']), 1)
+
+        self.assertEqual(
+            team.to_dict(fields=set(['name', 'effort']), include=set()),
+            {'name': 'Team', 'effort': 1800}
+        )
+        self.assertEqual(
+            team.to_dict(
+                fields=set(['username', 'effort']), include=set(['members'])
+            ),
+            {'effort': 1800, 'members': [{'username': 'test', 'effort': 1800}]}
+        )
+        self.assertEqual(
+            set(self.user.to_dict(include=set())),
+            set(['username', 'first_name', 'last_name', 'email'])
+        )
+
 
 class TeamTest(unittest.TestCase):
     """Test :class:`leaderboard.model.Team`"""
@@ -323,6 +592,24 @@ class TeamTest(unittest.TestCase):
         self.assertRaises(ConstraintError, team.add_user, user2)
 
 
+class CompetitionTest(unittest.TestCase):
+    """Test :class:`leaderboard.model.Competition`"""
+
+    def test_competition_initializes(self):
+        """Test that :class:`Competition` initializes live when fields are
+        valid
+        """
+        competition = Competition(name='Chicago2013')
+        self.assertEqual(competition.name, 'Chicago2013')
+        self.assertFalse(competition.archived)
+
+    def test_competition_name_validated(self):
+        """Test that :class:`Competition` requires a name starting with a
+        letter
+        """
+        self.assertRaises(ValidationError, Competition, name='2013')
+
+
 class EffortTest(unittest.TestCase):
     """Test :class:`leaderboard.model.effort.Effort`"""
 
@@ -363,6 +650,36 @@ class EffortTest(unittest.TestCase):
         self.fields['duration'] = timedelta(0)
         self.assertRaises(ValidationError, Effort, **self.fields)
 
+    def test_overlaps(self):
+        """Test that :meth:`Effort.overlaps` detects overlap, containment and
+        identical starts, but not efforts meeting end to start
+        """
+        effort = Effort(**self.fields)
+        start = self.fields['start_time']
+        duration = self.fields['duration']
+
+        def other(start_time, duration):
+            return Effort(
+                start_time=start_time, duration=duration,
+                location=self.fields['location']
+            )
+
+        for o in (
+            other(start, timedelta(1)),
+            other(start + timedelta(1), timedelta(1)),
+            other(start - timedelta(1), duration * 2),
+            other(start - timedelta(1), timedelta(2)),
+        ):
+            self.assertTrue(effort.overlaps(o))
+            self.assertTrue(o.overlaps(effort))
+
+        for o in (
+            other(start + duration, timedelta(1)),
+            other(start - timedelta(1), timedelta(1)),
+        ):
+            self.assertFalse(effort.overlaps(o))
+            self.assertFalse(o.overlaps(effort))
+
     def test_create_effort(self):
         """Test that :meth:`Effort.create_effort` properly initializes an object
         of type :class:`Effort`
@@ -412,5 +729,181 @@ class LocationTest(unittest.TestCase):
         self.assertRaises(ValidationError, Location, **self.fields)
 
 
+    def test_to_dict(self):
+        """Test that :meth:`Effort.to_dict` gives JSON-ready fields, and is
+        only computed once
+        """
+        effort = Effort(
+            start_time=datetime(2013, 1, 1, 12, 30, 15),
+            duration=timedelta(minutes=90),
+            location=Location(latitude=41.5, longitude=73.5)
+        )
+
+        self.assertEqual(effort.to_dict(), {
+            'start_time': '2013-01-01T12:30:15',
+            'duration': 5400,
+            'location': {'latitude': 41.5, 'longitude': 73.5},
+        })
+        self.assertIs(effort.to_dict(), effort.to_dict())
+        self.assertIs(
+            effort.to_dict()['location'], effort.location.to_dict()
+        )
+
+
+class EffortColumnsTest(unittest.TestCase):
+    """Test :class:`leaderboard.model.columns.EffortColumns`"""
+
+    def setUp(self):
+        self.location = Location(latitude=41.5, longitude=73.5)
+        self.efforts = [
+            Effort(
+                start_time=datetime(2013, 1, day, 12, 30, 15),
+                duration=timedelta(hours=day),
+                location=self.location
+            )
+            for day in (3, 1, 2)
+        ]
+
+    def test_holds_efforts(self):
+        """Test that :class:`EffortColumns` holds distinct efforts and builds
+        equal ones back, in order of start time
+        """
+        columns = EffortColumns(self.efforts + self.efforts[:1])
+
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(
+            list(columns),
+            sorted(self.efforts, key=lambda e: e.start_time)
+        )
+        for e in self.efforts:
+            self.assertIn(e, columns)
+        self.assertNotIn('effort', columns)
+
+    def test_shares_locations(self):
+        """Test that :class:`EffortColumns` keeps one copy of each location, so
+        that built efforts carry the location's id
+        """
+        self.location.id = 5
+        columns = EffortColumns(self.efforts)
+
+        self.assertEqual(len(columns._locations), 1)
+        for e in columns:
+            self.assertEqual(e.location.id, 5)
+
+    def test_set_operations(self):
+        """Test that :class:`EffortColumns` supports removal and the set
+        differences used when saving users
+        """
+        columns = EffortColumns(self.efforts)
+        other = copy(columns)
+        other.discard(self.efforts[0])
+
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(list(columns - other), [self.efforts[0]])
+        self.assertEqual(list(other - columns), [])
+        self.assertEqual(other, EffortColumns(self.efforts[1:]))
+
+    def test_totals(self):
+        """Test that :class:`EffortColumns` sums durations overall and over
+        windows of start time
+        """
+        columns = EffortColumns(self.efforts)
+
+        self.assertEqual(columns.total_seconds(), 6 * 3600)
+        self.assertEqual(
+            columns.window_seconds(
+                datetime(2013, 1, 2, 12, 30, 15), datetime(2013, 1, 3)
+            ),
+            2 * 3600
+        )
+        self.assertEqual(
+            columns.window_seconds(start=datetime(2013, 1, 2)), 5 * 3600
+        )
+        self.assertEqual(columns.window_seconds(end=datetime(2013, 1, 1)), 0)
+
+    def test_to_dicts(self):
+        """Test that :meth:`EffortColumns.to_dicts` serializes the efforts in
+        order as :meth:`Effort.to_dict` does, and only once for each effort
+        """
+        columns = EffortColumns(self.efforts)
+        dicts = columns.to_dicts()
+
+        self.assertEqual(dicts, [e.to_dict() for e in columns])
+        self.assertIs(columns.to_dicts()[0], dicts[0])
+
+        new = Effort(
+            start_time=datetime(2013, 1, 2, 6),
+            duration=timedelta(hours=1),
+            location=self.location
+        )
+        columns.add(new)
+        self.assertIs(columns.to_dicts()[2], dicts[1])
+        columns.update([Effort(
+            start_time=datetime(2013, 1, 5),
+            duration=timedelta(hours=1),
+            location=self.location
+        )])
+        self.assertIs(columns.to_dicts()[0], dicts[0])
+        self.assertEqual(columns.to_dicts(), [e.to_dict() for e in columns])
+
+    def test_copies_share_serialized_efforts(self):
+        """Test that copies of :class:`EffortColumns` share serialized efforts
+        until one of them changes
+        """
+        columns = EffortColumns(self.efforts)
+        other = copy(columns)
+        dicts = other.to_dicts()
+
+        self.assertIs(columns.to_dicts()[0], dicts[0])
+
+        other.discard(self.efforts[1])
+        self.assertEqual(len(columns.to_dicts()), 3)
+        self.assertEqual(len(other.to_dicts()), 2)
+        self.assertEqual(other.to_dicts(), [e.to_dict() for e in other])
+
+
+class LazyCollectionTest(unittest.TestCase):
+    """Test :class:`leaderboard.model.lazy.LazyCollection`"""
+
+    def setUp(self):
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return set([1, 2])
+
+    def test_loads_once_when_used(self):
+        """Test that :class:`LazyCollection` loads its collection on first use
+        only, and then behaves like it
+        """
+        collection = LazyCollection(self.load)
+        self.assertEqual(self.loads, 0)
+        self.assertFalse(loaded(collection))
+
+        self.assertIn(1, collection)
+        self.assertEqual(len(collection), 2)
+        collection.add(3)
+        self.assertEqual(collection - set([1]), set([2, 3]))
+        self.assertEqual(collection, set([1, 2, 3]))
+        self.assertEqual(self.loads, 1)
+        self.assertTrue(loaded(collection))
+        self.assertTrue(loaded(set()))
+
+    def test_copy(self):
+        """Test that copying a :class:`LazyCollection` doesn't load it, and
+        that copies of a loaded one don't share its collection
+        """
+        collection = LazyCollection(self.load)
+        other = copy(collection)
+        self.assertEqual(self.loads, 0)
+
+        collection.add(3)
+        other = copy(collection)
+        other.add(4)
+        self.assertEqual(collection, set([1, 2, 3]))
+        self.assertEqual(other, set([1, 2, 3, 4]))
+        self.assertEqual(self.loads, 1)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
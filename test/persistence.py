@@ -8,12 +8,15 @@
 """
 
 import unittest
+from datetime import datetime, timedelta
 
-import psycopg2
-
+from leaderboard.cache import LRUCache
 from leaderboard.persistence.repository import Repository
-from leaderboard.persistence import UserRepository, TeamRepository
+from leaderboard.persistence import opens_cursor, UserRepository, \
+    TeamRepository, CompetitionRepository, AnalyticsRepository
+from leaderboard.model.effort import Effort
 from leaderboard.model.location import Location
+from leaderboard.model.lazy import LazyCollection
 from leaderboard.exceptions import ConstraintError
 
 
@@ -34,6 +37,80 @@ class RepositoryTestCase(unittest.TestCase):
         repository = TestRepository(TestConnection(TestAllCursor, self))
         all_objs = repository.all()
 
+    def test_all_scoped_to_competition(self):
+        """Test :meth:`Repository.all` only lists a scoped competition"""
+        class TestAllCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query, 'SELECT * FROM test WHERE competition = %s'
+                )
+                self.test_case.assertEqual(params, (2,))
+
+            def fetchall(self):
+                return [1]
+
+        repository = TestRepository(
+            TestConnection(TestAllCursor, self), competition_id=2
+        )
+        self.assertEqual(repository.all(), [1])
+
+    def test_all_ignores_fanout(self):
+        """Test that :meth:`Repository.all` builds objects one after another
+        when given a fan-out, unless the repository takes in
+        :class:`FanOutMixin`
+        """
+        class TestAllCursor(TestCursor):
+            def fetchall(self):
+                return [1, 2]
+
+        class TestFanOut(object):
+            def map(self, fn, objs):
+                raise AssertionError('fanned out')
+
+        repository = TestRepository(
+            TestConnection(TestAllCursor, self), fanout=TestFanOut()
+        )
+        self.assertEqual(repository.all(), [1, 2])
+
+    def test_iter_all(self):
+        """Test that :meth:`Repository.iter_all` reads rows in batches from a
+        held server-side cursor, and closes it once they're exhausted
+        """
+        class TestIterCursor(TestCursor):
+            rows = [1, 2, 3, 4, 5]
+            closed = []
+
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query, 'SELECT * FROM test WHERE competition = %s'
+                )
+                self.test_case.assertEqual(params, (2,))
+
+            def fetchmany(self, size):
+                batch, self.rows = self.rows[:size], self.rows[size:]
+                return batch
+
+            def close(self):
+                self.closed.append(True)
+
+        class TestNamedConnection(TestConnection):
+            def cursor(self, name=None, cursor_factory=None, withhold=False):
+                if name is not None:
+                    self.test_case.assertTrue(name.startswith('test_all_'))
+                    self.test_case.assertTrue(withhold)
+                return TestConnection.cursor(self)
+
+        repository = TestRepository(
+            TestNamedConnection(TestIterCursor, self), competition_id=2
+        )
+        repository.batch_size = 2
+        objs = repository.iter_all()
+
+        self.assertEqual(next(objs), 1)
+        self.assertEqual(list(objs), [2, 3, 4, 5])
+        # One cursor per batch of objects created, and then the named one.
+        self.assertEqual(len(TestIterCursor.closed), 4)
+
     def test__get(self):
         """Test :meth:`Repository._get`"""
         class TestGetCursor(TestCursor):
@@ -46,6 +123,70 @@ class RepositoryTestCase(unittest.TestCase):
         repository = TestRepository(TestConnection(TestCursor, self))
         get = repository._get(TestGetCursor(self), 'field', 'value')
 
+    def test__get_scoped_to_competition(self):
+        """Test :meth:`Repository._get` only searches a scoped competition"""
+        class TestGetCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query,
+                    'SELECT * FROM test WHERE field = %s AND competition = %s'
+                )
+                self.test_case.assertEqual(params, ('value', 2))
+
+        repository = TestRepository(
+            TestConnection(TestCursor, self), competition_id=2
+        )
+        get = repository._get(TestGetCursor(self), 'field', 'value')
+
+    def test_opens_cursor_rolls_back(self):
+        """Test that :func:`opens_cursor` rolls back the transaction of a
+        function that raises
+        """
+        def fail(cursor):
+            raise ConstraintError('failed')
+
+        connection = TestConnection(TestCursor, self)
+        self.assertRaises(ConstraintError, opens_cursor(fail, connection))
+        self.assertEqual(connection.rollbacks, 1)
+
+    def test__get_any(self):
+        """Test that :meth:`Repository._get_any` searches for many values in
+        one query
+        """
+        class TestGetAnyCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query,
+                    'SELECT * FROM test WHERE id = ANY(%s) AND competition = %s'
+                )
+                self.test_case.assertEqual(params, ([1, 2], 2))
+
+        repository = TestRepository(
+            TestConnection(TestCursor, self), competition_id=2
+        )
+        repository._get_any(TestGetAnyCursor(self), 'id', [1, 2])
+
+    def test__competition_of(self):
+        """Test :meth:`Repository._competition_of` falls back to the
+        repository's competition, then the default one
+        """
+        class TestObject(object):
+            competition_id = None
+
+        obj = TestObject()
+        connection = TestConnection(TestCursor, self)
+
+        self.assertEqual(TestRepository(connection)._competition_of(obj), 1)
+        self.assertEqual(
+            TestRepository(connection, competition_id=2)._competition_of(obj),
+            2
+        )
+        obj.competition_id = 3
+        self.assertEqual(
+            TestRepository(connection, competition_id=2)._competition_of(obj),
+            3
+        )
+
 
 class UserRepositoryTestCase(unittest.TestCase):
     """Test :class:`leaderboard.persistence.UserRepository`"""
@@ -81,32 +222,38 @@ class UserRepositoryTestCase(unittest.TestCase):
         )
 
     def test__save_location(self):
-        """Test that :meth:`UserRepository._save_location` saves a location"""
+        """Test that :meth:`UserRepository._save_location` saves a location,
+        or looks it up if it's already saved
+        """
         class TestSaveLocationCursor(TestCursor):
             fields = {'latitude': 41.5, 'longitude': 73.5}
             id = 10
 
             def execute(self, query, params=None):
+                point = (self.fields['latitude'], self.fields['longitude'])
                 if query.startswith('INSERT'):
                     self.test_case.assertEqual(
                         query,
                         'INSERT INTO locations (latitude, longitude) '
-                            'VALUES (%s, %s) RETURNING id'
+                            'SELECT %s, %s WHERE NOT EXISTS '
+                            '(SELECT 1 FROM locations '
+                            'WHERE latitude = %s AND longitude = %s) '
+                            'RETURNING id'
                     )
-                    raise psycopg2.IntegrityError()
+                    self.test_case.assertEqual(params, point * 2)
+                    # The location is already saved.
+                    self.row = None
                 else:
                     self.test_case.assertEqual(
                         query,
                         'SELECT id FROM locations WHERE '
                             'latitude = %s AND longitude = %s'
                     )
-                self.test_case.assertEqual(
-                    params,
-                    (self.fields['latitude'], self.fields['longitude'])
-                )
+                    self.test_case.assertEqual(params, point)
+                    self.row = {'id': self.id}
 
             def fetchone(self):
-                return {'id': self.id}
+                return self.row
 
         connection = TestConnection(TestSaveLocationCursor, self)
         repository = UserRepository(connection)
@@ -136,12 +283,8 @@ class UserRepositoryTestCase(unittest.TestCase):
                     params, (1,)
                 )
 
-            def __iter__(self):
-                self.iter = iter([self.fields])
-                return self.iter
-
-            def next(self):
-                return self.iter.next()
+            def fetchall(self):
+                return [self.fields]
 
         class TestUser(object):
             def __init__(self):
@@ -168,6 +311,8 @@ class UserRepositoryTestCase(unittest.TestCase):
             def __init__(self, **kwargs):
                 self.test_case.assertEqual(kwargs, self.fields)
 
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
         class TestLocation(object):
             def __init__(self):
                 self.id = 1
@@ -200,7 +345,9 @@ class UserRepositoryTestCase(unittest.TestCase):
         self.assertIsInstance(effort, TestEffort)
 
     def test__save_effort(self):
-        """Test that :meth:`User._save_effort` saves an effort properly"""
+        """Test that :meth:`User._save_effort` saves an effort properly,
+        unless it's already saved
+        """
         class TestRepository(UserRepository):
             def _save_location(self, cursor, location):
                 location.id = 1
@@ -210,14 +357,18 @@ class UserRepositoryTestCase(unittest.TestCase):
                 'start_time': 'test_st',
                 'duration': 'test_d',
                 'user': 2,
-                'location': 1
+                'location': 1,
+                'competition': 3,
             }
 
             def execute(self, query, params=None):
                 self.test_case.assertEqual(
                     query,
-                    'INSERT INTO efforts (start_time, duration, "user", location)'
-                        ' VALUES (%s, %s, %s, %s)'
+                    'INSERT INTO efforts '
+                        '(start_time, duration, "user", location, competition)'
+                        ' SELECT %s, %s, %s, %s, %s WHERE NOT EXISTS '
+                        '(SELECT 1 FROM efforts '
+                        'WHERE start_time = %s AND "user" = %s)'
                 )
                 self.test_case.assertEqual(
                     params,
@@ -226,6 +377,9 @@ class UserRepositoryTestCase(unittest.TestCase):
                         self.fields['duration'],
                         self.fields['user'],
                         self.fields['location'],
+                        self.fields['competition'],
+                        self.fields['start_time'],
+                        self.fields['user'],
                     )
                 )
 
@@ -239,6 +393,7 @@ class UserRepositoryTestCase(unittest.TestCase):
 
         class TestUser(object):
             id = TestSaveEffortCursor.fields['user']
+            competition_id = TestSaveEffortCursor.fields['competition']
 
         repository = TestRepository(TestConnection(TestCursor, self))
         repository._save_effort(TestSaveEffortCursor(self), TestEffort(), TestUser())
@@ -297,8 +452,8 @@ class UserRepositoryTestCase(unittest.TestCase):
                 self.test_case.assertEqual(
                     query,
                     'INSERT INTO users '
-                        '(username, first_name, last_name, email) VALUES '
-                        '(%s, %s, %s, %s) RETURNING id'
+                        '(username, first_name, last_name, email, competition) '
+                        'VALUES (%s, %s, %s, %s, %s) RETURNING id'
                 )
                 self.test_case.assertEqual(
                     params,
@@ -307,6 +462,7 @@ class UserRepositoryTestCase(unittest.TestCase):
                         TestUser.first_name,
                         TestUser.last_name,
                         TestUser.email,
+                        1,
                     )
                 )
 
@@ -454,8 +610,13 @@ class UserRepositoryTestCase(unittest.TestCase):
                 for kw in kwargs:
                     setattr(self, kw, kwargs[kw])
 
-            def add_effort(self, effort):
-                self.test_case.assertEqual(effort, TestRepository.effort)
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+            def add_efforts(self, efforts, check=True):
+                self.test_case.assertEqual(
+                    list(efforts), [TestRepository.effort]
+                )
+                self.test_case.assertFalse(check)
 
             def __eq__(self, other):
                 return self.__dict__ == other.__dict__
@@ -471,8 +632,11 @@ class UserRepositoryTestCase(unittest.TestCase):
         del user_fields['id']
         user = TestUser(**user_fields)
         user.id = 1
+        user.competition_id = None
 
-        repository = TestRepository(TestConnection(TestCursor, self))
+        repository = TestRepository(
+            TestConnection(TestCursor, self), eager=True
+        )
 
         returned_user = repository.get(user_id=1)
 
@@ -483,6 +647,319 @@ class UserRepositoryTestCase(unittest.TestCase):
         self.assertEqual(repository.get(username='test_username'), user)
         self.assertRaises(ValueError, repository.get, user_id=1, username='u')
 
+    def test_get_many(self):
+        """Test that :meth:`UserRepository.get_many` loads any number of users
+        and their totals in two queries, in the requested order
+        """
+        class TestUser(object):
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+        import leaderboard.persistence.user as ur_module
+        ur_module.User = TestUser
+
+        row = lambda user_id: {
+            'id': user_id, 'username': 'user%d' % user_id, 'first_name': 'f',
+            'last_name': 'l', 'email': 'e', 'competition': 1,
+        }
+        TestScriptedCursor.script = [
+            [row(3), row(4)],
+            [{'user': 3, 'count': 2, 'seconds': 60.0}],
+        ]
+        TestScriptedCursor.queries = []
+
+        repository = UserRepository(TestConnection(TestScriptedCursor, self))
+        users = repository.get_many([4, 9, 3])
+
+        queries = TestScriptedCursor.queries
+        self.assertEqual(len(queries), 2)
+        self.assertIn('FROM users WHERE id = ANY(%s)', queries[0][0])
+        self.assertEqual(sorted(queries[0][1][0]), [3, 4, 9])
+        self.assertIn('WHERE "user" = ANY(%s) GROUP BY "user"', queries[1][0])
+        self.assertEqual([u and u.id for u in users], [4, None, 3])
+        self.assertEqual(
+            (users[0].effort_count, users[0].effort_seconds), (0, 0)
+        )
+        self.assertEqual(
+            (users[2].effort_count, users[2].effort_seconds), (2, 60.0)
+        )
+        self.assertFalse(users[2].efforts.loaded)
+
+    def test_get_many_cached(self):
+        """Test that :meth:`UserRepository.get_many` takes users from the
+        cache, unless they belong to another competition than the one the
+        repository is scoped to
+        """
+        class TestUser(object):
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+        import leaderboard.persistence.user as ur_module
+        ur_module.User = TestUser
+
+        cache = LRUCache(10)
+        for user_id, competition_id in ((3, 1), (4, 2)):
+            cache.set(('user', user_id), TestUser(
+                id=user_id, competition_id=competition_id, efforts=set()
+            ))
+        TestScriptedCursor.script = [[], []]
+        TestScriptedCursor.queries = []
+
+        repository = UserRepository(
+            TestConnection(TestScriptedCursor, self), competition_id=1,
+            cache=cache
+        )
+        users = repository.get_many([3, 4])
+
+        queries = TestScriptedCursor.queries
+        self.assertEqual(queries[0][1][0], [4])
+        self.assertIn('competition = %s', queries[0][0])
+        self.assertEqual([u and u.id for u in users], [3, None])
+
+    def test_get_many_eager(self):
+        """Test that :meth:`UserRepository.get_many` loads any number of users,
+        their efforts and the efforts' locations in three queries
+        """
+        class TestUser(object):
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+            def add_efforts(self, efforts, check=True):
+                self.efforts = list(efforts)
+
+        import leaderboard.persistence.user as ur_module
+        ur_module.User = TestUser
+        ur_module.Effort = Effort
+        ur_module.Location = Location
+
+        row = lambda user_id: {
+            'id': user_id, 'username': 'user%d' % user_id, 'first_name': 'f',
+            'last_name': 'l', 'email': 'e', 'competition': 1,
+        }
+        effort = lambda user_id: {
+            'user': user_id, 'start_time': datetime(2013, 1, 1),
+            'duration': timedelta(hours=1), 'location': 7,
+        }
+        TestScriptedCursor.script = [
+            [row(3), row(4)],
+            [effort(3), effort(3), effort(4)],
+            [{'id': 7, 'latitude': 1.0, 'longitude': 2.0}],
+        ]
+        TestScriptedCursor.queries = []
+
+        repository = UserRepository(
+            TestConnection(TestScriptedCursor, self), eager=True
+        )
+        users = repository.get_many([3, 4])
+
+        queries = TestScriptedCursor.queries
+        self.assertEqual(len(queries), 3)
+        self.assertIn('FROM efforts WHERE "user" = ANY(%s)', queries[1][0])
+        self.assertIn('FROM locations WHERE id = ANY(%s)', queries[2][0])
+        self.assertEqual(queries[2][1], ([7],))
+        self.assertEqual([len(u.efforts) for u in users], [2, 1])
+        self.assertEqual(users[0].efforts[0].location.latitude, 1.0)
+
+    def test_get_cached(self):
+        """Test that :meth:`UserRepository.get` answers repeat lookups from the
+        cache, and that writes evict the cached user
+        """
+        class TestUser(object):
+            id = 1
+            username = 'test_username'
+            competition_id = 2
+            effort_count = 0
+
+            def __init__(self):
+                self.efforts = set()
+
+        class TestRepository(UserRepository):
+            loads = 0
+
+            def get(self, cursor, username=None, user_id=None):
+                TestRepository.loads += 1
+                return TestUser()
+
+            def delete(self, cursor, user):
+                pass
+
+        repository = TestRepository(
+            TestConnection(TestCursor, self), competition_id=2,
+            cache=LRUCache(10)
+        )
+        user = repository.get(user_id=1)
+        user.efforts.add('effort')
+
+        self.assertEqual(repository.get(user_id=1).efforts, set())
+        self.assertEqual(repository.get(username='test_username').id, 1)
+        self.assertEqual(TestRepository.loads, 1)
+
+        repository.delete(user)
+        repository.get(user_id=1)
+        self.assertEqual(TestRepository.loads, 2)
+
+        # Users cached from another competition are loaded again, where the
+        # scoped query won't find them.
+        other = TestRepository(
+            TestConnection(TestCursor, self), competition_id=3,
+            cache=repository.cache
+        )
+        other.get(user_id=1)
+        self.assertEqual(TestRepository.loads, 3)
+
+    def test_get_lazy(self):
+        """Test that :meth:`UserRepository.get` only loads a user's efforts
+        when they're first used, unless asked to load them eagerly
+        """
+        class TestUser(object):
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+            def add_efforts(self, efforts, check=True):
+                self.efforts = list(efforts)
+
+        class TestRepository(UserRepository):
+            loads = 0
+
+            def _get(self, cursor, field, value):
+                return [{'id': 1, 'username': 'test_username'}]
+
+            def _get_efforts(self, cursor, user):
+                TestRepository.loads += 1
+                return []
+
+            def _get_effort_totals(self, cursor, user):
+                return 2, 3600.0
+
+        import leaderboard.persistence.user as ur_module
+        ur_module.User = TestUser
+
+        repository = TestRepository(TestConnection(TestCursor, self))
+        user = repository.get(user_id=1)
+
+        self.assertEqual(TestRepository.loads, 0)
+        self.assertEqual((user.effort_count, user.effort_seconds), (2, 3600.0))
+        self.assertFalse(user.efforts.loaded)
+        self.assertEqual(len(user.efforts), 0)
+        self.assertEqual(list(user.efforts), [])
+        self.assertEqual(TestRepository.loads, 1)
+
+        repository = TestRepository(
+            TestConnection(TestCursor, self), eager=True
+        )
+        self.assertEqual(repository.get(user_id=1).efforts, [])
+        self.assertEqual(TestRepository.loads, 2)
+
+    def test_get_without_totals(self):
+        """Test that :meth:`UserRepository.get` reads neither the efforts nor
+        their totals when asked not to, and doesn't cache the partial user
+        """
+        class TestUser(object):
+            competition_id = 2
+
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+        class TestRepository(UserRepository):
+            loads = 0
+
+            def _get(self, cursor, field, value):
+                TestRepository.loads += 1
+                return [{'id': 1, 'username': 'test_username'}]
+
+            def _get_efforts(self, cursor, user):
+                raise AssertionError('efforts read')
+
+            def _get_effort_totals(self, cursor, user):
+                raise AssertionError('totals read')
+
+        import leaderboard.persistence.user as ur_module
+        ur_module.User = TestUser
+
+        cache = LRUCache(10)
+        repository = TestRepository(
+            TestConnection(TestCursor, self), cache=cache, totals=False
+        )
+        user = repository.get(user_id=1)
+
+        self.assertEqual(user.effort_count, None)
+        self.assertFalse(user.efforts.loaded)
+        repository.get(user_id=1)
+        self.assertEqual(TestRepository.loads, 2)
+        self.assertEqual(len(cache), 0)
+
+        # A fully loaded user serves the lookup just as well.
+        cached = TestUser(
+            id=1, username='test_username', effort_count=0, efforts=set()
+        )
+        cache.set(('user', 1), cached)
+        self.assertEqual(repository.get(user_id=1).effort_count, 0)
+        self.assertEqual(TestRepository.loads, 2)
+
+    def test__get_effort_totals(self):
+        """Test that :meth:`UserRepository._get_effort_totals` totals a user's
+        efforts in the database
+        """
+        class TestUser(object):
+            id = 1
+
+        class TestTotalsCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query,
+                    'SELECT count(*) AS count, '
+                        'coalesce(sum(extract(epoch FROM duration)), 0)'
+                        '::float8 AS seconds FROM efforts WHERE "user" = %s'
+                )
+                self.test_case.assertEqual(params, (1,))
+
+            def fetchone(self):
+                return {'count': 2, 'seconds': 3600.0}
+
+        repository = UserRepository(TestConnection(TestTotalsCursor, self))
+        self.assertEqual(
+            repository._get_effort_totals(TestTotalsCursor(self), TestUser()),
+            (2, 3600.0)
+        )
+
+    def test__update_skips_unloaded_efforts(self):
+        """Test that :meth:`UserRepository._update` leaves efforts that were
+        never loaded alone
+        """
+        class TestUser(object):
+            id = 1
+            username = 'test_username'
+            first_name = 'first'
+            last_name = 'last'
+            email = 'test@test.com'
+
+            def __init__(self):
+                self.efforts = LazyCollection(self.fail_load)
+
+            def fail_load(self):
+                raise AssertionError('efforts loaded')
+
+        class TestRepository(UserRepository):
+            def get(self, cursor, user_id=None):
+                return TestUser()
+
+        class TestUpdateCursor(TestCursor):
+            def execute(self, query, params=None):
+                raise AssertionError('unexpected query %s' % query)
+
+        repository = TestRepository(TestConnection(TestUpdateCursor, self))
+        repository._update(TestUpdateCursor(self), TestUser())
+
     def test_set_team(self):
         """Test that :meth:`UserRepository.set_team` sets a user's team"""
         class TestTeam(object):
@@ -492,12 +969,24 @@ class UserRepositoryTestCase(unittest.TestCase):
             id = 2
 
         class TestSetTeamCursor(TestCursor):
+            rowcount = 1
+
             def execute(self, query, params=None):
+                # The user's previous team is looked up first.
+                if query.startswith('SELECT'):
+                    self.test_case.assertEqual(
+                        query, 'SELECT team FROM users2teams WHERE "user" = %s'
+                    )
+                    self.test_case.assertEqual(params, (2,))
+                    return
                 self.test_case.assertEqual(
                     query, 'UPDATE users2teams SET team = %s WHERE "user" = %s'
                 )
                 self.test_case.assertEqual(params, (1, 2))
 
+            def fetchone(self):
+                return {'team': 3}
+
         repository = UserRepository(TestConnection(TestSetTeamCursor, self))
         repository.set_team(TestUser(), TestTeam())
         repository.set_team(TestUser(), 1)
@@ -525,6 +1014,8 @@ class TeamRepositoryTestCase(unittest.TestCase):
                 self.name = name
                 self.members = []
 
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
             def add_user(self, user):
                 self.members.append(user)
 
@@ -555,7 +1046,9 @@ class TeamRepositoryTestCase(unittest.TestCase):
 
         TestRepository.test_case = self
 
-        repository = TestRepository(TestConnection(TestCursor, self))
+        repository = TestRepository(
+            TestConnection(TestCursor, self), eager=True
+        )
         team = TestTeam('name')
         team.members = [TestUser(1), TestUser(2)]
 
@@ -568,6 +1061,132 @@ class TeamRepositoryTestCase(unittest.TestCase):
         self.assertEqual(repository.get(name='name'), team)
         self.assertRaises(ValueError, repository.get, team_id=1, name='name')
 
+    def test_get_lazy(self):
+        """Test that :meth:`TeamRepository.get` only loads a team's members
+        when they're first used
+        """
+        class TestUser(object):
+            def __init__(self, username):
+                self.username = username
+
+        class TestTeam(object):
+            def __init__(self, name):
+                self.name = name
+                self.members = {}
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+        import leaderboard.persistence.team as tr_module
+        tr_module.Team = TestTeam
+
+        class TestRepository(TeamRepository):
+            loads = 0
+
+            def _get(self, cursor, field, value):
+                return [{'id': 1, 'name': 'name'}]
+
+            def _get_users(self, cursor, team):
+                TestRepository.loads += 1
+                return [TestUser('one'), TestUser('two')]
+
+            def _get_effort_totals(self, cursor, team):
+                return 4, 7200.0
+
+        repository = TestRepository(TestConnection(TestCursor, self))
+        team = repository.get(team_id=1)
+
+        self.assertEqual(team.name, 'name')
+        self.assertEqual((team.effort_count, team.effort_seconds), (4, 7200.0))
+        self.assertEqual(TestRepository.loads, 0)
+        self.assertEqual(sorted(team.members.keys()), ['one', 'two'])
+        self.assertEqual(team.members['one'].username, 'one')
+        self.assertEqual(TestRepository.loads, 1)
+
+    def test_get_many(self):
+        """Test that :meth:`TeamRepository.get_many` loads any number of teams
+        and their totals in two queries, in the requested order
+        """
+        class TestTeam(object):
+            def __init__(self, name):
+                self.name = name
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+        import leaderboard.persistence.team as tr_module
+        tr_module.Team = TestTeam
+        tr_module.UserRepository = UserRepository
+
+        TestScriptedCursor.script = [
+            [{'id': 1, 'name': 'one', 'competition': 1}],
+            [{'team': 1, 'count': 4, 'seconds': 7200.0}],
+        ]
+        TestScriptedCursor.queries = []
+
+        repository = TeamRepository(TestConnection(TestScriptedCursor, self))
+        teams = repository.get_many([2, 1])
+
+        queries = TestScriptedCursor.queries
+        self.assertEqual(len(queries), 2)
+        self.assertIn('FROM teams WHERE id = ANY(%s)', queries[0][0])
+        self.assertIn('ut.team = ANY(%s) GROUP BY ut.team', queries[1][0])
+        self.assertEqual(teams[0], None)
+        self.assertEqual(teams[1].name, 'one')
+        self.assertEqual(
+            (teams[1].effort_count, teams[1].effort_seconds), (4, 7200.0)
+        )
+
+    def test_get_many_eager(self):
+        """Test that :meth:`TeamRepository.get_many` loads the members of any
+        number of teams with one query for the memberships and one multi-get
+        of the users
+        """
+        class TestUser(object):
+            def __init__(self, user_id):
+                self.id = user_id
+
+        class TestTeam(object):
+            def __init__(self, name):
+                self.name = name
+                self.members = []
+
+            from_row = classmethod(lambda cls, **kwargs: cls(**kwargs))
+
+            def add_user(self, user):
+                self.members.append(user)
+
+        import leaderboard.persistence.team as tr_module
+        tr_module.Team = TestTeam
+        tr_module.UserRepository = UserRepository
+
+        TestScriptedCursor.script = [
+            [
+                {'id': 1, 'name': 'one', 'competition': 1},
+                {'id': 2, 'name': 'two', 'competition': 1},
+            ],
+            [{'user': 3, 'team': 1}, {'user': 4, 'team': 2},
+             {'user': 5, 'team': 1}],
+        ]
+        TestScriptedCursor.queries = []
+
+        repository = TeamRepository(
+            TestConnection(TestScriptedCursor, self), eager=True
+        )
+        requested = []
+
+        def get_many(user_ids):
+            requested.append(user_ids)
+            return [TestUser(i) for i in user_ids]
+        repository.user_repository.get_many = get_many
+
+        teams = repository.get_many([1, 2])
+
+        queries = TestScriptedCursor.queries
+        self.assertEqual(len(queries), 2)
+        self.assertIn('FROM users2teams WHERE team = ANY(%s)', queries[1][0])
+        self.assertEqual(requested, [[3, 4, 5]])
+        self.assertEqual([u.id for u in teams[0].members], [3, 5])
+        self.assertEqual([u.id for u in teams[1].members], [4])
+
     def test_save(self):
         """Test that :meth:`TeamRepository.save` saves a user to the database"""
         class TestUser(object):
@@ -583,6 +1202,7 @@ class TeamRepositoryTestCase(unittest.TestCase):
         class TestTeam(object):
             name = 'name'
             users = [TestUser(1)]
+            members = users
 
             def __iter__(self):
                 self.iter = iter(self.users)
@@ -596,15 +1216,16 @@ class TeamRepositoryTestCase(unittest.TestCase):
                 if query.startswith('INSERT'):
                     self.test_case.assertEqual(
                         query,
-                        'INSERT INTO teams (name) VALUES (%s) RETURNING id'
+                        'INSERT INTO teams (name, competition) VALUES (%s, %s) '
+                            'RETURNING id'
                     )
-                    self.test_case.assertEqual(params, ('name',))
+                    self.test_case.assertEqual(params, ('name', 1))
 
             def fetchone(self):
                 return {'id': 1}
 
         class TestUserRepository(object):
-            def __init__(self, connection):
+            def __init__(self, connection, eager=False, totals=True):
                 pass
 
             def save(self, user):
@@ -700,7 +1321,7 @@ class TeamRepositoryTestCase(unittest.TestCase):
         TestTeamRepository.test_case = self
 
         class TestUserRepository(object):
-            def __init__(self, connection):
+            def __init__(self, connection, eager=False, totals=True):
                 pass
 
             def save(self, user):
@@ -720,6 +1341,44 @@ class TeamRepositoryTestCase(unittest.TestCase):
         repository = TestTeamRepository(TestConnection(TestUpdateCursor, self))
         repository._update(TestUpdateCursor(self), TestTeam('name', [TestUser(2), TestUser(3)]))
 
+    def test__get_effort_totals(self):
+        """Test that :meth:`TeamRepository._get_effort_totals` totals the
+        efforts of a team's members in the database
+        """
+        class TestTeam(object):
+            id = 1
+
+        class TestTotalsCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query,
+                    'SELECT count(*) AS count, '
+                        'coalesce(sum(extract(epoch FROM e.duration)), 0)'
+                        '::float8 AS seconds '
+                        'FROM efforts e JOIN users2teams ut '
+                        'ON ut."user" = e."user" WHERE ut.team = %s'
+                )
+                self.test_case.assertEqual(params, (1,))
+
+            def fetchone(self):
+                return {'count': 4, 'seconds': 7200.0}
+
+        class TestUserRepository(object):
+            efforts_table_name = 'efforts'
+            users2teams_table_name = 'users2teams'
+
+            def __init__(self, connection, eager=False, totals=True):
+                pass
+
+        import leaderboard.persistence.team as tr_module
+        tr_module.UserRepository = TestUserRepository
+
+        repository = TeamRepository(TestConnection(TestTotalsCursor, self))
+        self.assertEqual(
+            repository._get_effort_totals(TestTotalsCursor(self), TestTeam()),
+            (4, 7200.0)
+        )
+
     def test__get_users(self):
         """Test that :meth:`TeamRepository._get_users` returns the users
         associated with a team
@@ -743,7 +1402,7 @@ class TeamRepositoryTestCase(unittest.TestCase):
         class TestUserRepository(object):
             users2teams_table_name = 'users2teams'
 
-            def __init__(self, connection):
+            def __init__(self, connection, eager=False, totals=True):
                 pass
 
             def get(self, user_id=None):
@@ -760,6 +1419,55 @@ class TeamRepositoryTestCase(unittest.TestCase):
                 ]
 
 
+class CompetitionRepositoryTestCase(unittest.TestCase):
+    """Test :class:`leaderboard.persistence.CompetitionRepository`"""
+
+    def test_archive(self):
+        """Test that :meth:`CompetitionRepository.archive` only flags the
+        archived competition
+        """
+        class TestCompetition(object):
+            id = 2
+            archived = False
+
+        class TestArchiveCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query,
+                    'UPDATE competitions SET archived = true WHERE id = %s'
+                )
+                self.test_case.assertEqual(params, (2,))
+
+        repository = CompetitionRepository(
+            TestConnection(TestArchiveCursor, self)
+        )
+        competition = TestCompetition()
+        repository.archive(competition)
+
+        self.assertTrue(competition.archived)
+
+    def test_live(self):
+        """Test that :meth:`CompetitionRepository.live` skips archived
+        competitions
+        """
+        class TestLiveCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query, 'SELECT * FROM competitions WHERE NOT archived'
+                )
+
+            def fetchall(self):
+                return [{'id': 1, 'name': 'Default', 'archived': False}]
+
+        repository = CompetitionRepository(TestConnection(TestLiveCursor, self))
+        competitions = repository.live()
+
+        self.assertEqual(len(competitions), 1)
+        self.assertEqual(competitions[0].id, 1)
+        self.assertEqual(competitions[0].name, 'Default')
+        self.assertFalse(competitions[0].archived)
+
+
 class TestRepository(Repository):
     table_name = 'test'
 
@@ -767,16 +1475,116 @@ class TestRepository(Repository):
         return row
 
 
+class AnalyticsRepositoryTestCase(unittest.TestCase):
+    """Test :class:`leaderboard.persistence.AnalyticsRepository`"""
+
+    def test_memberships(self):
+        """Test that :meth:`AnalyticsRepository.memberships` reads the team
+        memberships of a competition's users
+        """
+        class TestMembershipsCursor(TestCursor):
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query,
+                    'SELECT ut."user", ut.team FROM users2teams ut '
+                        'JOIN users u ON u.id = ut."user" '
+                        'WHERE u.competition = %s'
+                )
+                self.test_case.assertEqual(params, (2,))
+
+            def fetchall(self):
+                return [{'user': 1, 'team': 3}]
+
+        repository = AnalyticsRepository(
+            TestConnection(TestMembershipsCursor, self), competition_id=2
+        )
+        self.assertEqual(repository.memberships(), [(1, 3)])
+
+    def test_effort_batches(self):
+        """Test that :meth:`AnalyticsRepository.effort_batches` reads efforts
+        in batches from a server-side cursor
+        """
+        class TestBatchCursor(TestCursor):
+            rows = [(1, 0.0, 60.0, 1)] * 5
+
+            def execute(self, query, params=None):
+                self.test_case.assertEqual(
+                    query,
+                    'SELECT "user", extract(epoch FROM start_time)::float8, '
+                        'extract(epoch FROM duration)::float8, location '
+                        'FROM efforts'
+                )
+                self.test_case.assertEqual(params, None)
+
+            def fetchmany(self, size):
+                batch, self.rows = self.rows[:size], self.rows[size:]
+                return batch
+
+        class TestNamedConnection(TestConnection):
+            def cursor(self, name=None, cursor_factory=None):
+                self.test_case.assertEqual(name, 'analytics_efforts')
+                return TestConnection.cursor(self)
+
+        repository = AnalyticsRepository(
+            TestNamedConnection(TestBatchCursor, self)
+        )
+        repository.batch_size = 2
+        self.assertEqual(
+            [len(b) for b in repository.effort_batches()], [2, 2, 1]
+        )
+
+    def test_totals(self):
+        """Test that :meth:`AnalyticsRepository.user_totals` and
+        :meth:`AnalyticsRepository.team_totals` total the efforts of a
+        competition's users and teams, optionally only those named
+        """
+        TestScriptedCursor.script = [
+            [{'id': 1, 'seconds': 60.0}, {'id': 2, 'seconds': 0.0}],
+            [{'id': 3, 'seconds': 60.0}],
+        ]
+        TestScriptedCursor.queries = []
+        repository = AnalyticsRepository(
+            TestConnection(TestScriptedCursor, self), competition_id=2
+        )
+
+        self.assertEqual(repository.user_totals(), {1: 60.0, 2: 0.0})
+        self.assertEqual(repository.team_totals([3]), {3: 60.0})
+        self.assertEqual(TestScriptedCursor.queries, [
+            (
+                'SELECT u.id, '
+                    'coalesce(sum(extract(epoch FROM e.duration)), 0)::float8 '
+                    'AS seconds FROM users u '
+                    'LEFT JOIN efforts e ON e."user" = u.id '
+                    'WHERE u.competition = %s GROUP BY u.id',
+                (2,)
+            ),
+            (
+                'SELECT t.id, '
+                    'coalesce(sum(extract(epoch FROM e.duration)), 0)::float8 '
+                    'AS seconds FROM teams t '
+                    'LEFT JOIN users2teams ut ON ut.team = t.id '
+                    'LEFT JOIN efforts e ON e."user" = ut."user" '
+                    'WHERE t.competition = %s AND t.id = ANY(%s) '
+                    'GROUP BY t.id',
+                (2, [3])
+            ),
+        ])
+
+
 class TestConnection(object):
     """Mock :class:`connection`"""
 
     def __init__(self, cursor, test_case):
         self.Cursor = cursor
         self.test_case = test_case
+        self.rollbacks = 0
 
     def commit(self):
         pass
 
+    def rollback(self):
+        self.rollbacks += 1
+
     def cursor(self, cursor_factory=None):
         """Return a mock database cursor"""
         return self.Cursor(self.test_case)
@@ -803,5 +1611,19 @@ class TestCursor(object):
         pass
 
 
+class TestScriptedCursor(TestCursor):
+    """Mock :class:`cursor` that records its queries and answers each with the
+    next result in a script shared by all its instances.
+    """
+    script = []
+    queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append((query, params))
+
+    def fetchall(self):
+        return self.script.pop(0)
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
@@ -0,0 +1,98 @@
+"""
+    test.pool
+    =========
+
+    Test the database connection pool.
+
+    :author: Michael Browning
+"""
+
+from threading import Thread
+import time
+import unittest
+
+from leaderboard.pool import ConnectionPool
+from leaderboard.exceptions import PoolTimeoutError
+
+
+class TestConnection(object):
+    """A connection that can be closed."""
+
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    """Test :class:`leaderboard.pool.ConnectionPool`"""
+
+    def setUp(self):
+        self.connections = []
+
+    def make_pool(self, **kwargs):
+        def connect():
+            self.connections.append(TestConnection())
+            return self.connections[-1]
+
+        return ConnectionPool(connect, **kwargs)
+
+    def test_reuses_connections(self):
+        """Test that connections given back are lent out again, and that new
+        ones are only opened when none is idle
+        """
+        pool = self.make_pool(size=2)
+        first = pool.get()
+        second = pool.get()
+        pool.put(first)
+
+        self.assertTrue(pool.get() is first)
+        self.assertEqual(len(self.connections), 2)
+        self.assertEqual(pool.stats()['busy'], 2)
+
+    def test_waits_for_connections(self):
+        """Test that once `size` connections are lent out, :meth:`get` waits
+        for one to be given back
+        """
+        pool = self.make_pool(size=1)
+        connection = pool.get()
+        Thread(target=lambda: (time.sleep(0.05), pool.put(connection))).start()
+
+        self.assertTrue(pool.get() is connection)
+        self.assertEqual(pool.stats()['waits'], 1)
+        self.assertEqual(pool.stats()['waiting'], 0)
+
+    def test_times_out(self):
+        """Test that :meth:`get` gives up after `timeout` seconds"""
+        pool = self.make_pool(size=1, timeout=0.05)
+        pool.get()
+
+        self.assertRaises(PoolTimeoutError, pool.get)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_replaces_closed_connections(self):
+        """Test that a connection closed while lent out isn't taken back, and
+        that a new one may be opened in its place
+        """
+        pool = self.make_pool(size=1, timeout=0.05)
+        connection = pool.get()
+        connection.close()
+        pool.put(connection)
+
+        self.assertFalse(pool.get() is connection)
+        self.assertEqual(pool.stats()['connections'], 1)
+
+    def test_close(self):
+        """Test that :meth:`ConnectionPool.close` closes idle connections"""
+        pool = self.make_pool(size=2)
+        connection = pool.get()
+        pool.put(connection)
+        pool.close()
+
+        self.assertTrue(connection.closed)
+        self.assertEqual(pool.stats()['connections'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,199 @@
+"""
+    test.profiling
+    ==============
+
+    Test request profiling.
+
+    :author: Michael Browning
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import Flask
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from leaderboard.helpers import admin
+from leaderboard.profiling import ProfilingMiddleware, ProfileStore
+
+
+def load_user():
+    return 'user'
+
+
+def load_team():
+    return 'team'
+
+
+def app(environ, start_response):
+    """A WSGI app whose body is produced while it's iterated over."""
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    if environ['PATH_INFO'] == '/error':
+        raise ValueError('error')
+    yield load_user()
+    yield load_team()
+
+
+def get(client, path, **kwargs):
+    """Make a request and close its response, as servers do once they've
+    sent it, which is when its profile is stored.
+    """
+    response = client.get(path, **kwargs)
+    response.data
+    response.close()
+
+    return response
+
+
+class ProfilingMiddlewareTest(unittest.TestCase):
+    """Test :class:`leaderboard.profiling.ProfilingMiddleware`"""
+
+    def setUp(self):
+        self.store = ProfileStore(top=50)
+        self.chance = 0.5
+
+    def client(self, **kwargs):
+        kwargs.setdefault('random', lambda: self.chance)
+        return Client(
+            ProfilingMiddleware(app, self.store, **kwargs), BaseResponse
+        )
+
+    def functions(self):
+        return [
+            f['function']
+            for f in self.store.get(self.store.list()[0]['id'])['functions']
+        ]
+
+    def test_profiles_on_request(self):
+        """Test that a request carrying the admin token in `X-Profile` is
+        profiled, including the iteration of its body
+        """
+        client = self.client(token='secret')
+        response = get(client, '/users?x=1', headers={'X-Profile': 'secret'})
+
+        self.assertEqual(response.data, 'userteam')
+        profiles = self.store.list()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(
+            (profiles[0]['method'], profiles[0]['path']), ('GET', '/users?x=1')
+        )
+        self.assertTrue(any('(load_team)' in f for f in self.functions()))
+
+    def test_ignores_other_requests(self):
+        """Test that requests without the token, or with a wrong one, aren't
+        profiled
+        """
+        client = self.client(token='secret')
+        get(client, '/users')
+        get(client, '/users', headers={'X-Profile': 'guess'})
+
+        self.assertEqual(self.store.list(), [])
+
+    def test_samples(self):
+        """Test that a percentage of requests is profiled at random"""
+        client = self.client(sample_percent=10)
+        get(client, '/users')
+        self.chance = 0.05
+        get(client, '/users')
+
+        self.assertEqual(len(self.store.list()), 1)
+
+    def test_refuses_under_gevent(self):
+        """Test that no request is profiled once gevent has patched the
+        process, since other requests would run under its profile
+        """
+        client = self.client(
+            token='secret', sample_percent=100, patched=lambda: True
+        )
+        get(client, '/users', headers={'X-Profile': 'secret'})
+
+        self.assertEqual(self.store.list(), [])
+
+    def test_profiles_failed_requests(self):
+        """Test that a request that raises is still profiled"""
+        client = self.client(sample_percent=100)
+        self.assertRaises(ValueError, client.get, '/error', buffered=True)
+
+        self.assertEqual(self.store.list()[0]['path'], '/error')
+
+
+class ProfileStoreTest(unittest.TestCase):
+    """Test :class:`leaderboard.profiling.ProfileStore`"""
+
+    def profile(self, store, path):
+        client = Client(
+            ProfilingMiddleware(app, store, sample_percent=100), BaseResponse
+        )
+        get(client, path)
+
+    def test_keeps_the_top_functions(self):
+        """Test that each profile keeps its `top` functions with the most
+        cumulative time, in order
+        """
+        store = ProfileStore(top=3)
+        self.profile(store, '/users')
+        functions = store.get(store.list()[0]['id'])['functions']
+
+        self.assertEqual(len(functions), 3)
+        self.assertEqual(
+            [f['cumulative_time'] for f in functions],
+            sorted([f['cumulative_time'] for f in functions], reverse=True)
+        )
+
+    def test_keeps_the_latest_profiles(self):
+        """Test that only the latest `keep` profiles are kept, newest first"""
+        store = ProfileStore(keep=2)
+        for path in ('/a', '/b', '/c'):
+            self.profile(store, path)
+
+        self.assertEqual([p['path'] for p in store.list()], ['/c', '/b'])
+        self.assertEqual(store.get('missing'), None)
+
+    def test_writes_profiles(self):
+        """Test that profiles are written to the directory, if one is given"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store = ProfileStore(directory=os.path.join(directory, 'profiles'))
+        self.profile(store, '/users')
+
+        profile_id = store.list()[0]['id']
+        with open(os.path.join(
+            directory, 'profiles', '%s.json' % profile_id
+        )) as f:
+            self.assertEqual(json.load(f)['path'], '/users')
+
+
+class AdminTest(unittest.TestCase):
+    """Test :func:`leaderboard.helpers.admin`"""
+
+    def client(self, token):
+        app = Flask(__name__)
+
+        @app.route('/admin')
+        @admin(token)
+        def view():
+            return 'admin'
+
+        return app.test_client()
+
+    def test_admin(self):
+        """Test that admin views need the admin token, and don't exist without
+        one
+        """
+        client = self.client('secret')
+        self.assertEqual(
+            client.get('/admin', headers={'X-Admin-Token': 'secret'}).data,
+            'admin'
+        )
+        response = client.get('/admin', headers={'X-Admin-Token': 'guess'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(client.get('/admin').status_code, 403)
+        self.assertEqual(self.client(None).get('/admin').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,244 @@
+"""
+    test.stream
+    ===========
+
+    Test the publishing of leaderboard changes to streaming clients.
+
+    :author: Michael Browning
+"""
+
+import json
+import threading
+import unittest
+
+from leaderboard.stream import Publisher, Standings
+
+
+def read(subscription, n):
+    """Read the next `n` messages of a subscription's stream, parsing events
+    into name and data pairs.
+
+    :param subscription: the :class:`leaderboard.stream.Subscription`
+    :param n: how many messages to read
+    """
+    messages = []
+    for _ in range(n):
+        message = next(subscription.stream)
+        fields = dict(
+            l.split(': ', 1) for l in message.strip().split('\n')
+            if not l.startswith(':')
+        )
+        if 'event' in fields:
+            messages.append((fields['event'], json.loads(fields['data'])))
+        else:
+            messages.append(message)
+
+    return messages
+
+
+def subscribe(publisher, *args):
+    """Subscribe to a publisher and start reading the stream past its
+    `retry` message.
+    """
+    subscription = publisher.subscribe(*args)
+    subscription.stream = subscription.events()
+    next(subscription.stream)
+
+    return subscription
+
+
+class PublisherTest(unittest.TestCase):
+    """Test :class:`leaderboard.stream.Publisher`"""
+
+    def setUp(self):
+        self.publisher = Publisher(history=3, queue_size=2, heartbeat=0.01)
+
+    def test_fans_out_by_scope(self):
+        """Test that events go to every subscriber to their scope"""
+        first = subscribe(self.publisher)
+        second = subscribe(self.publisher)
+        scoped = subscribe(self.publisher, 2)
+        self.publisher.publish('user', {'id': 1})
+        self.publisher.publish('user', {'id': 2}, 2)
+
+        self.assertEqual(read(first, 1), [('user', {'id': 1})])
+        self.assertEqual(read(second, 1), [('user', {'id': 1})])
+        self.assertEqual(read(scoped, 1), [('user', {'id': 2})])
+        self.assertEqual(self.publisher.scopes, set([None, 2]))
+
+    def test_heartbeats(self):
+        """Test that an idle stream is sent comments"""
+        subscription = subscribe(self.publisher)
+
+        self.assertEqual(read(subscription, 1), [': heartbeat\n\n'])
+
+    def test_resumes_from_history(self):
+        """Test that a client reconnecting with the id of the last event it
+        saw gets the events published since
+        """
+        subscription = subscribe(self.publisher)
+        self.publisher.publish('user', {'id': 1})
+        event = next(subscription.stream)
+        last_event_id = event.split('\n')[0][4:]
+        subscription.stream.close()
+        self.publisher.publish('user', {'id': 2})
+        self.publisher.publish('team', {'id': 3})
+
+        resumed = subscribe(self.publisher, None, last_event_id)
+        self.assertEqual(
+            read(resumed, 2), [('user', {'id': 2}), ('team', {'id': 3})]
+        )
+
+    def test_resets_clients_too_far_behind(self):
+        """Test that a client that missed more events than are kept, or whose
+        event id is unknown, is told to reset
+        """
+        subscription = subscribe(self.publisher)
+        self.publisher.publish('user', {'id': 1})
+        last_event_id = next(subscription.stream).split('\n')[0][4:]
+        for n in range(4):
+            self.publisher.publish('user', {'id': n})
+
+        resumed = subscribe(self.publisher, None, last_event_id)
+        self.assertEqual(read(resumed, 1), [('reset', {})])
+        unknown = subscribe(self.publisher, None, 'elsewhere-1')
+        self.assertEqual(read(unknown, 1), [('reset', {})])
+
+    def test_cuts_off_slow_clients(self):
+        """Test that a subscriber whose queue is full stops being sent events,
+        and its stream ends once it has read those queued
+        """
+        subscription = subscribe(self.publisher)
+        for n in range(3):
+            self.publisher.publish('user', {'id': n})
+
+        self.assertEqual(
+            read(subscription, 2), [('user', {'id': 0}), ('user', {'id': 1})]
+        )
+        self.assertRaises(StopIteration, next, subscription.stream)
+        self.assertEqual(self.publisher.stats()['subscribers'], 0)
+        self.assertEqual(self.publisher.stats()['cut_off'], 1)
+
+
+class TestAnalyticsRepository(object):
+    """Serves totals from dictionaries in place of
+    :class:`AnalyticsRepository`.
+    """
+
+    def __init__(self, users, teams):
+        self.users = users
+        self.teams = teams
+
+    def user_totals(self, user_ids=None):
+        return self._select(self.users, user_ids)
+
+    def team_totals(self, team_ids=None):
+        return self._select(self.teams, team_ids)
+
+    def _select(self, totals, ids):
+        if ids is None:
+            return dict(totals)
+        return dict((i, totals[i]) for i in ids if i in totals)
+
+
+class TestStandings(Standings):
+    """:class:`Standings` on a :class:`TestAnalyticsRepository` per scope."""
+
+    def __init__(self, publisher, repositories):
+        super(TestStandings, self).__init__(publisher, None)
+        self.repositories = repositories
+
+    def _repository(self, scope):
+        return self.repositories[scope]
+
+
+class StandingsTest(unittest.TestCase):
+    """Test :class:`leaderboard.stream.Standings`"""
+
+    def setUp(self):
+        self.publisher = Publisher(heartbeat=0.01)
+        self.repository = TestAnalyticsRepository(
+            {1: 100.0, 2: 50.0, 3: 0.0}, {1: 100.0, 2: 50.0}
+        )
+        self.standings = TestStandings(self.publisher, {1: self.repository})
+        self.addCleanup(self.standings.close, 5)
+
+    def test_publishes_changes(self):
+        """Test that a write is published as the changes to its user's and
+        team's totals and ranks
+        """
+        subscription = subscribe(self.publisher, 1)
+        self.standings.track(1)
+        self.repository.users[2] = 150.0
+        self.repository.teams[2] = 150.0
+        self.standings.record(1, 2, 2)
+        self.assertTrue(self.standings.flush(5))
+
+        self.assertEqual(read(subscription, 2), [
+            ('user', {
+                'id': 2, 'competition': 1, 'team': 2, 'effort': 150,
+                'delta': 100, 'rank': 1, 'previous_rank': 2,
+            }),
+            ('team', {
+                'id': 2, 'competition': 1, 'effort': 150, 'delta': 100,
+                'rank': 1, 'previous_rank': 2,
+            }),
+        ])
+
+    def test_skips_unchanged_totals(self):
+        """Test that nothing is published for totals a write didn't change,
+        such as a new user's
+        """
+        subscription = subscribe(self.publisher, 1)
+        self.standings.track(1)
+        self.repository.users[4] = 0.0
+        self.standings.record(1, 4, 1)
+        self.assertTrue(self.standings.flush(5))
+
+        self.assertEqual(read(subscription, 1), [': heartbeat\n\n'])
+
+    def test_tracks_only_subscribed_scopes(self):
+        """Test that writes aren't read unless their scope has subscribers,
+        and that a scope's totals are dropped once it has none
+        """
+        self.standings.record(1, 2, 2)
+        self.assertTrue(self.standings.flush(5))
+        self.assertEqual(self.standings._totals, {})
+
+        subscription = subscribe(self.publisher, 1)
+        self.standings.track(1)
+        subscription.stream.close()
+        self.standings.record(1, 2, 2)
+        self.assertTrue(self.standings.flush(5))
+        self.assertEqual(self.standings._totals, {})
+
+    def test_records_behind_writes(self):
+        """Test that recording a write doesn't wait for its totals to be read,
+        and that writes that overflow the queue are dropped along with the
+        totals, which are reloaded with the next write
+        """
+        release = threading.Event()
+        totals = self.repository.user_totals
+
+        def user_totals(*args):
+            release.wait(5)
+            return totals(*args)
+
+        self.repository.user_totals = user_totals
+        self.standings.max_pending = 2
+        subscription = subscribe(self.publisher, 1)
+        self.standings._totals[1] = {
+            'user': {1: 100.0, 2: 50.0, 3: 0.0}, 'team': {1: 100.0, 2: 50.0}
+        }
+        for user_id in (1, 2, 3, 1):
+            self.standings.record(1, user_id, 1)
+        self.assertFalse(self.standings.flush(0.05))
+
+        release.set()
+        self.assertTrue(self.standings.flush(5))
+        self.assertEqual(read(subscription, 1), [': heartbeat\n\n'])
+        self.assertIn(1, self.standings._totals)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)